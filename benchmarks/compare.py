@@ -0,0 +1,77 @@
+from typing import Dict
+from typing import List
+from typing import Tuple
+import argparse
+import json
+import sys
+
+
+"""
+Compare two result files of `benchmarks/run.py`, e.g. of two releases:
+
+    python benchmarks/compare.py baseline.json results.json --threshold 1.2
+
+Prints the ratio of median times (new / baseline) of every result both files share,
+and exits with status 1 if any got slower than `--threshold` times the baseline.
+"""
+
+
+_ResultKey = Tuple[str, str, str]
+
+
+def _load(path: str) -> Dict[_ResultKey, dict]:
+    with open(path) as f:
+        report = json.load(f)
+    return {
+        (
+            result['scenario'],
+            result['metric'],
+            json.dumps(result['params'], sort_keys=True),
+        ): result
+        for result in report['results']
+    }
+
+
+def compare(baseline_path: str, new_path: str, threshold: float) -> List[str]:
+    """Print the comparison, returning the descriptions of regressions."""
+
+    baseline = _load(baseline_path)
+    new = _load(new_path)
+    regressions = []
+    for key in sorted(baseline.keys() & new.keys()):
+        ratio = new[key]['median'] / max(baseline[key]['median'], 1e-12)
+        scenario, metric, params = key
+        description = f'{scenario:12} {metric:20} {params}'
+        flag = ' REGRESSION' if ratio > threshold else ''
+        print(
+            f"{description}  {baseline[key]['median']:.6f}s -> "
+            f"{new[key]['median']:.6f}s  x{ratio:.2f}{flag}"
+        )
+        if flag:
+            regressions.append(description)
+    for key in sorted(baseline.keys() ^ new.keys()):
+        which = 'baseline' if key in baseline else 'new results'
+        print(f'{key[0]:12} {key[1]:20} {key[2]}  only in {which}')
+    return regressions
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('baseline')
+    parser.add_argument('new')
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=1.2,
+        help='slowdown ratio counted as a regression',
+    )
+    args = parser.parse_args(argv)
+    regressions = compare(args.baseline, args.new, args.threshold)
+    if regressions:
+        print(f'{len(regressions)} regression(s) beyond x{args.threshold}')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,374 @@
+from derpcache._cache import reset_cache_config
+from derpcache._cache import update_cache_config
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import List
+import argparse
+import concurrent.futures
+import contextlib
+import datetime
+import derpcache
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+"""
+Benchmarks of the cache's hot paths, saving machine-readable results.
+
+    python benchmarks/run.py --output results.json
+    python benchmarks/compare.py baseline.json results.json
+
+Every result is the time one operation took, summarized over `--repeat` runs.  The
+default sizes finish in about a minute; `--full` goes up to million-entry indexes and
+multi-GB payloads (which need that much free memory and disk).
+
+Only the public API is used, so any installed version of derpcache can be measured
+(run from a checkout with `PYTHONPATH=.` to measure the checkout instead).  Options a
+version does not document (e.g. "index_backend") are left out of its results, as are
+scenarios it cannot run.  Versions without `cache_map` fill indexes one call at a
+time, which takes a while at the larger sizes.
+"""
+
+
+_BACKENDS = ('json', 'journal', 'sqlite')
+_SIZES = {
+    'entries': ([100, 1000, 10_000], [100, 1000, 10_000, 100_000, 1_000_000]),
+    'payload_bytes': (
+        [10**2, 10**4, 10**6, 10**7],
+        [10**2, 10**4, 10**6, 10**8, 4 << 30],
+    ),
+    'workers': ([1, 2, 4], [1, 2, 4, 8, 16]),
+}
+
+
+# payloads by size, built ahead of their timed (cached) calls
+_payloads: Dict[int, Any] = {}
+
+
+def _identity(x: Any) -> Any:
+    return x
+
+
+def _get_payload(nbytes: int, i: int) -> Any:
+    """The payload of `nbytes`; `i` only tells calls apart."""
+
+    return _payloads[nbytes]
+
+
+def _none(*args: Any) -> None:
+    return None
+
+
+def _supports(option: str) -> bool:
+    """Whether the installed version has config `option`, as documented."""
+
+    return f'"{option}"' in (update_cache_config.__doc__ or '')
+
+
+def _backends() -> List[str]:
+    return list(_BACKENDS) if _supports('index_backend') else ['json']
+
+
+def _summarize(times: List[float], number: int) -> Dict[str, float]:
+    return {
+        'min': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.fmean(times),
+        'repeat': len(times),
+        'number': number,
+    }
+
+
+def _measure(f: Callable[[], Any], repeat: int, number: int = 1) -> Dict[str, float]:
+    """Seconds per operation, over `repeat` runs of `number` operations (calls of
+    `f`, unless `f` makes `number` of them itself) each."""
+
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        f()
+        times.append((time.perf_counter() - started) / number)
+    return _summarize(times, number)
+
+
+@contextlib.contextmanager
+def _fresh_cache(**config: Any) -> Iterator[str]:
+    """A configured, empty cache directory for the duration."""
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache_dir = os.path.join(tmp, 'cache')
+        update_cache_config(cache_dir=cache_dir, **config)
+        try:
+            yield cache_dir
+        finally:
+            derpcache.clear_cache()
+            reset_cache_config()
+
+
+def _populate(n: int) -> None:
+    """Add `n` filler entries (of tiny objects), in a single batch where supported."""
+
+    if hasattr(derpcache, 'cache_map'):
+        for _ in derpcache.cache_map(_identity, range(n)):
+            pass
+    else:
+        for i in range(n):
+            derpcache.cache(_identity, i)
+
+
+def bench_hit_miss(sizes: Dict[str, List[int]], repeat: int) -> Iterator[Dict]:
+    """Hit and miss latency of :func:`cache` by index size and backend."""
+
+    for backend in _backends():
+        for n in sizes['entries']:
+            with _fresh_cache(**_backend_config(backend)):
+                _populate(n)
+                derpcache.cache(_identity, -1)
+                params = {'backend': backend, 'entries': n}
+                yield {
+                    'params': params,
+                    'metric': 'hit_seconds',
+                    **_measure(
+                        lambda: [derpcache.cache(_identity, -1) for _ in range(10)],
+                        repeat,
+                        number=10,
+                    ),
+                }
+                misses = iter(range(n, n + repeat))
+                yield {
+                    'params': params,
+                    'metric': 'miss_seconds',
+                    **_measure(
+                        lambda: derpcache.cache(_identity, next(misses)), repeat
+                    ),
+                }
+
+
+def _backend_config(backend: str) -> Dict[str, Any]:
+    return {'index_backend': backend} if _supports('index_backend') else {}
+
+
+def _make_payload(nbytes: int) -> Any:
+    try:
+        import numpy
+    except ImportError:
+        return bytes(nbytes)
+    return numpy.zeros(nbytes, dtype=numpy.uint8)
+
+
+def bench_payload(sizes: Dict[str, List[int]], repeat: int) -> Iterator[Dict]:
+    """Storing values by size (as misses returning them), and loading them by hash,
+    pickled whole or with buffers mmapped."""
+
+    mmap_thresholds = [None, 1 << 20] if _supports('mmap_threshold') else [None]
+    for mmap_threshold in mmap_thresholds:
+        for nbytes in sizes['payload_bytes']:
+            config = (
+                {} if mmap_threshold is None else {'mmap_threshold': mmap_threshold}
+            )
+            with _fresh_cache(**config):
+                _payloads[nbytes] = _make_payload(nbytes)
+                keys = iter(range(repeat))
+                params = {'payload_bytes': nbytes, 'mmap_threshold': mmap_threshold}
+                yield {
+                    'params': params,
+                    'metric': 'write_seconds',
+                    **_measure(
+                        lambda: derpcache.cache(_get_payload, nbytes, next(keys)),
+                        repeat,
+                    ),
+                }
+                (hash, *_) = derpcache.get_index()
+                yield {
+                    'params': params,
+                    'metric': 'read_seconds',
+                    **_measure(lambda: derpcache.get_by_hash(hash), repeat),
+                }
+                _payloads.clear()
+
+
+def _make_args() -> Dict[str, Any]:
+    args = {
+        'scalars': (1, 2.5, 'three', None, True),
+        'nested_dict': {str(i): {'a': [i, str(i)], 'b': {'c': i}} for i in range(1000)},
+        'long_list': list(range(100_000)),
+        'strings': [f'item-{i}' for i in range(100_000)],
+        'bytes_1mb': bytes(1 << 20),
+    }
+    try:
+        import numpy
+    except ImportError:
+        return args
+    args['ndarray_8mb'] = numpy.zeros(1 << 20, dtype=numpy.float64)
+    return args
+
+
+def bench_hash_args(sizes: Dict[str, List[int]], repeat: int) -> Iterator[Dict]:
+    """Hits by argument complexity, per hash engine: mostly the time taken to key the
+    call."""
+
+    engines = ['blake2b', 'sha256', 'legacy'] if _supports('hash_engine') else [None]
+    for engine in engines:
+        with _fresh_cache(**({} if engine is None else {'hash_engine': engine})):
+            for name, value in _make_args().items():
+                derpcache.cache(_none, value)
+                yield {
+                    'params': {'hash_engine': engine, 'args': name},
+                    'metric': 'hit_seconds',
+                    **_measure(lambda: derpcache.cache(_none, value), repeat),
+                }
+
+
+def _worker_calls(n_calls: int, offset: int) -> None:
+    """Half the calls miss (on keys of their own), half hit (a few shared keys)."""
+
+    for i in range(n_calls):
+        derpcache.cache(_identity, offset + i if i % 2 else -1 - i % 10)
+
+
+def _init_worker(config: Dict[str, Any]) -> None:
+    update_cache_config(**config)
+
+
+def bench_concurrency(sizes: Dict[str, List[int]], repeat: int) -> Iterator[Dict]:
+    """Latency of calls made by concurrent workers sharing a cache."""
+
+    n_calls = 200
+    for backend in _backends():
+        for kind in ('thread', 'process'):
+            for workers in sizes['workers']:
+                with _fresh_cache(**_backend_config(backend)) as cache_dir:
+                    config = {'cache_dir': cache_dir, **_backend_config(backend)}
+                    if kind == 'thread':
+                        executor: concurrent.futures.Executor
+                        executor = concurrent.futures.ThreadPoolExecutor(workers)
+                    else:
+                        executor = concurrent.futures.ProcessPoolExecutor(
+                            workers, initializer=_init_worker, initargs=(config,)
+                        )
+                    offsets = itertools.count(0, n_calls)
+
+                    def _run() -> None:
+                        futures = [
+                            executor.submit(_worker_calls, n_calls, next(offsets))
+                            for _ in range(workers)
+                        ]
+                        for future in futures:
+                            future.result()
+
+                    with executor:
+                        _run()  # start the workers
+                        result = _measure(_run, repeat, number=workers * n_calls)
+                    yield {
+                        'params': {
+                            'backend': backend,
+                            'executor': kind,
+                            'workers': workers,
+                        },
+                        'metric': 'seconds_per_call',
+                        **result,
+                    }
+
+
+def bench_index(sizes: Dict[str, List[int]], repeat: int) -> Iterator[Dict]:
+    """:func:`get_index` and :func:`clear_cache` by index size and backend."""
+
+    for backend in _backends():
+        for n in sizes['entries']:
+            params = {'backend': backend, 'entries': n}
+            with _fresh_cache(**_backend_config(backend)):
+                _populate(n)
+                yield {
+                    'params': params,
+                    'metric': 'get_index_seconds',
+                    **_measure(derpcache.get_index, repeat),
+                }
+            times = []
+            for _ in range(repeat):
+                with _fresh_cache(**_backend_config(backend)):
+                    _populate(n)
+                    started = time.perf_counter()
+                    derpcache.clear_cache()
+                    times.append(time.perf_counter() - started)
+            yield {
+                'params': params,
+                'metric': 'clear_cache_seconds',
+                **_summarize(times, 1),
+            }
+
+
+SCENARIOS = {
+    'hit_miss': bench_hit_miss,
+    'payload': bench_payload,
+    'hash_args': bench_hash_args,
+    'concurrency': bench_concurrency,
+    'index': bench_index,
+}
+# config options marking the versions able to run a scenario: sharing a cache between
+# workers became safe along with leases
+_REQUIREMENTS = {'concurrency': 'lease_timeout'}
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            capture_output=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument(
+        '--scenarios', default=','.join(SCENARIOS), help='comma-separated'
+    )
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--full', action='store_true', help='run the largest sizes')
+    args = parser.parse_args(argv)
+
+    sizes = {name: options[args.full] for name, options in _SIZES.items()}
+    results = []
+    for scenario in args.scenarios.split(','):
+        requirement = _REQUIREMENTS.get(scenario)
+        if requirement is not None and not _supports(requirement):
+            print(f'{scenario:12} skipped: needs "{requirement}"', flush=True)
+            continue
+        for result in SCENARIOS[scenario](sizes, args.repeat):
+            result = {'scenario': scenario, **result}
+            print(
+                f"{scenario:12} {result['metric']:20} {result['median']:.6f}s "
+                f"{json.dumps(result['params'])}",
+                flush=True,
+            )
+            results.append(result)
+    report = {
+        'derpcache_version': derpcache.__version__,
+        'git_commit': _git_commit(),
+        'python': sys.version,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'created_at': datetime.datetime.utcnow().isoformat(),
+        'full': args.full,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
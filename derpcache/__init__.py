@@ -1,8 +1,21 @@
+from ._cache import add_stats_hook
 from ._cache import cache
+from ._cache import cache_async
+from ._cache import cache_map
 from ._cache import cache_wrapper
 from ._cache import clear_cache
+from ._cache import export_cache
 from ._cache import get_by_hash
+from ._cache import get_cost_report
 from ._cache import get_index
+from ._cache import get_stats
+from ._cache import import_cache
+from ._cache import iter_index
+from ._cache import migrate_cache_layout
+from ._cache import register_key_encoder
+from ._cache import register_serializer
+from ._cache import remove_stats_hook
+from ._cache import reset_stats
 
 
 """
@@ -16,9 +29,22 @@ __version__ = '0.1.0'
 __author__ = 'Ben Johnson'
 __credits__ = 'Silver Zinc Beetle'
 __all__ = [
+    'add_stats_hook',
     'cache',
+    'cache_async',
+    'cache_map',
     'cache_wrapper',
     'clear_cache',
+    'export_cache',
     'get_index',
     'get_by_hash',
+    'get_cost_report',
+    'get_stats',
+    'import_cache',
+    'iter_index',
+    'migrate_cache_layout',
+    'register_key_encoder',
+    'register_serializer',
+    'remove_stats_hook',
+    'reset_stats',
 ]
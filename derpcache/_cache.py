@@ -1,26 +1,102 @@
+from typing import IO
 from typing import Any
+from typing import AsyncIterator
+from typing import Awaitable
 from typing import Callable
+from typing import Collection
+from typing import ContextManager
 from typing import Dict
+from typing import Iterable
+from typing import Iterator
 from typing import List
 from typing import Optional
+from typing import Set
+from typing import Tuple
 from typing import Union
+import asyncio
+import atexit
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
 import datetime
 import functools
 import hashlib
+import heapq
+import inspect
+import io
+import itertools
 import json
 import logging
+import mmap
 import os
 import pickle
+import re
 import shutil
+import tarfile
+import threading
+import time
+import types
+import uuid
+import weakref
+
+from . import _hashing
+from . import _journal
+from . import _locking
+from . import _memory
+from . import _packs
+from . import _serializers
+from . import _sqlite
+from . import _stats
 
 
 # TODO: use stricter structure
 _EntryDict = Dict
 _IndexDict = Dict[str, _EntryDict]
+_StatSignature = Tuple[int, int, int]
+# a call's key: its hash and, engine permitting, a check value to detect collisions
+_Key = Tuple[str, Optional[str]]
 
 
 _CACHE_INDEX_FILE = 'index.json'
+_CACHE_JOURNAL_FILE = 'index.journal'
+_CACHE_SQLITE_FILE = 'index.sqlite'
+_CACHE_PACK_DIR = 'packs'
+_CACHE_CONTENT_DIR = 'content'
+_CACHE_KEYS_FILE = 'keys.json'
+_CONTENT_DIGEST_SIZE = 32
 _DEFAULT_CACHE_DIR = '.derpcache/'
+_DEFAULT_LEASE_TIMEOUT = 30
+_DEFAULT_HASH_ENGINE = 'blake2b'
+_DEFAULT_HASH_SIZE = 16
+# bytes of a key: at least a 32 bit digest, at most a 128 character file name
+_MIN_HASH_SIZE = 4
+_MAX_HASH_SIZE = 64
+# width in characters of keys of the "legacy" engine
+_LEGACY_HASH_WIDTH = 8
+_DEFAULT_EVICTION_POLICY = 'lru'
+# hex characters of the hash naming each level of directories objects are sharded into
+_SHARD_WIDTH = 2
+_MAX_SHARD_DEPTH = 4
+# buffered accesses are written out at the latest once this many entries were hit
+_ACCESS_FLUSH_SIZE = 1000
+# first line of pickles with out-of-band buffers, followed by the token naming them
+_BUFFERS_HEADER = b'derpcache-buffers '
+_EXECUTORS = ('thread', 'process')
+_PUBLIC_ENTRY_FIELDS = ('callable', 'called_at', 'expires_after', 'annotation')
+# bookkeeping fields included on request, as recorded so far (missing from old entries)
+_DETAIL_ENTRY_FIELDS = ('duration', 'size', 'hits', 'last_accessed')
+_REPORT_GROUPINGS = ('entry', 'callable')
+_DEFAULT_PAGE_SIZE = 1000
+# entry fields locating objects in a cache's packs or content store, which differ
+# from one cache to the next
+_LOCATION_FIELDS = ('segment', 'offset', 'length', 'content')
+_BUNDLE_FORMAT = 1
+_BUNDLE_MANIFEST = 'derpcache.json'
+_BUNDLE_OBJECT_DIR = 'objects'
+_BUNDLE_COMPRESSIONS = (None, 'gz', 'bz2', 'xz')
+_HASH_PATTERN = re.compile('[0-9a-f]+')
+_TIER_WRITE_POLICIES = ('through', 'back')
 _CACHE_CONFIG_DEFAULTS = {
     'cache_dir': _DEFAULT_CACHE_DIR,
 }
@@ -29,7 +105,42 @@ _CACHE_CONFIG_DEFAULTS = {
 logger = logging.getLogger(__name__)
 
 
-__cache_config = _CACHE_CONFIG_DEFAULTS.copy()
+__cache_config: Dict[str, Any] = _CACHE_CONFIG_DEFAULTS.copy()
+_memory_tier = _memory.MemoryTier()
+_UNVERIFIED: _StatSignature = (-1, -1, -1)  # never matches a real stat signature
+# index path -> (stat signature, parsed index)
+_parsed_indexes: Dict[str, Tuple[_StatSignature, _IndexDict]] = {}
+# index path -> (index, earliest expiry among its entries)
+_next_expiries: Dict[str, Tuple[_IndexDict, datetime.datetime]] = {}
+# (cache directory, hash engine, hash size) its recorded key scheme was checked against
+_checked_key_schemes: Set[Tuple[str, str, Optional[int]]] = set()
+# index path -> (index, number of its entries, bytes of their objects, number of
+# entries sharing each deduplicated payload)
+_usages: Dict[str, Tuple[_IndexDict, int, int, Dict[str, int]]] = {}
+# hash -> [last accessed, hits], not yet recorded in the index
+_pending_accesses: Dict[str, list] = {}
+_pending_accesses_lock = threading.Lock()
+# event loop -> (cache dir, hash) -> future of the call being computed on that loop
+_in_flight: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict]'
+_in_flight = weakref.WeakKeyDictionary()
+# types already warned about as lacking a stable identity (see `_CachedFunction`)
+_unkeyable_types: set = set()
+# (cache dir, hash) of the entries being refreshed in the background
+_refreshing: set = set()
+_refreshing_lock = threading.Lock()
+_refresh_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+# background refreshes of coroutine functions, kept referenced until done
+_refresh_tasks: set = set()
+# flushes of accesses recorded on event loops, kept referenced until done
+_flush_tasks: set = set()
+# which of the configured "tiers" the cache is being operated on, the top one (0) but
+# while reading from or writing to those below it
+_active_tier: contextvars.ContextVar[int] = contextvars.ContextVar(
+    'derpcache_active_tier', default=0
+)
+# writes on to lower tiers with "tier_write_policy" "back", in order
+_write_back_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+_write_back_lock = threading.Lock()
 
 
 def update_cache_config(**config) -> dict:
@@ -43,11 +154,106 @@ def update_cache_config(**config) -> dict:
 
                 "cache_dir": (path to) the desired cache directory.
 
+            Optional keys (unset by default):
+
+                "memory_max_entries": enable the in-process memory tier, holding at
+                    most this many return values.
+
+                "memory_max_bytes": enable the in-process memory tier, holding at
+                    most this many (pickled) bytes of return values.
+
+                "index_backend": how the index is stored.  One of "json" (the
+                    default, a single `index.json`), "journal" (an append-only
+                    `index.journal`, compacted as it accumulates dead records) or
+                    "sqlite" (an `index.sqlite` database with indexed columns).
+
+                "lease_timeout": seconds after which the lease of a worker computing
+                    a missing entry is presumed abandoned (default 30).
+
+                "hash_engine": digest used for cache keys.  One of "blake2b" (the
+                    default), "sha256", "xxhash" (requires the `xxhash` package) or
+                    "legacy" (the original `str()`-based 8 character keys).
+
+                "hash_size": width of cache keys in bytes (default 16, at least 4
+                    and at most 64).
+
+                    Entries keyed by another "hash_engine" or "hash_size" are never
+                    found, so changing either (or upgrading from the "legacy"
+                    default) leaves a cache's existing entries orphaned.  The scheme
+                    is recorded in the cache directory, and a warning is logged when
+                    it no longer matches the configured one.
+
+                "serializer": default serializer for cached values (see
+                    :func:`cache`).
+
+                "mmap_threshold": store buffers of at least this many bytes (e.g.
+                    large NumPy arrays) in separate files, returned memory-mapped
+                    and read-only on cache hits.
+
+                "max_entries": evict entries whenever the cache holds more than
+                    this many.
+
+                "max_bytes": evict entries whenever their objects take up more
+                    than this many bytes on disk (payloads shared by deduplicated
+                    entries counting once).
+
+                "eviction_policy": which entries are evicted first.  One of "lru"
+                    (the default, least recently used), "lfu" (least frequently
+                    used) or "cost" (cheapest to recompute, i.e. the least compute
+                    time saved per byte stored).
+
+                "pack_threshold": append objects smaller than this many bytes to
+                    shared pack files rather than writing a file for each, which
+                    are compacted as entries are removed.  Not used for pickles
+                    with "mmap_threshold" configured.
+
+                "dedupe": store byte-identical objects once, by content.  Entries
+                    record their object's "content" digest, and objects of
+                    different calls sharing a payload are hard links to it, so it is
+                    only removed with the last entry referencing it.  Applies to
+                    objects stored whole (not packed, nor with buffers memory-mapped
+                    out-of-band).
+
+                "shard_depth": spread objects over this many levels of
+                    subdirectories (e.g. `ab/cd/<hash>` for 2), keeping directories
+                    small for caches with millions of entries.  Objects of flat
+                    caches are still found; :func:`migrate_cache_layout` moves them.
+
+                "tiers": an ordered list of stores, fastest first (e.g. a local SSD,
+                    then a network mount shared by a cluster), each a dict of the
+                    settings above in which it differs from the rest, including at
+                    least its "cache_dir" (which replaces the top-level one).  Calls
+                    are looked up in the top tier, falling through to the ones below
+                    it on a miss, and hits found below are copied up into every tier
+                    above.  New entries are written to every tier.  Listings,
+                    exports and migrations only cover the top tier; clearing and
+                    invalidating cover every tier.
+
+                "tier_write_policy": how new entries reach the tiers below the top
+                    one.  One of "through" (the default, before the call returns) or
+                    "back" (in order, on a background thread).
+
     Returns:
 
         dict: The current configuration settings.
     """
 
+    for tier in config.get('tiers') or ():
+        if 'cache_dir' not in tier:
+            raise ValueError('Every tier needs a "cache_dir" of its own')
+    for settings in (config, *(config.get('tiers') or ())):
+        hash_size = settings.get('hash_size', _DEFAULT_HASH_SIZE)
+        if (
+            not isinstance(hash_size, int)
+            or isinstance(hash_size, bool)
+            or not _MIN_HASH_SIZE <= hash_size <= _MAX_HASH_SIZE
+        ):
+            raise ValueError(
+                f'hash_size must be an integer between {_MIN_HASH_SIZE} and '
+                f'{_MAX_HASH_SIZE}, not {hash_size!r}'
+            )
+    if 'cache_dir' in __cache_config:
+        _flush_accesses()  # they belong to the index configured so far
     __cache_config.update(config)
     return __cache_config
 
@@ -60,20 +266,87 @@ def reset_cache_config() -> dict:
         dict: The default configuration settings.
     """
 
+    _flush_accesses()
     for k in list(__cache_config.keys()):
         __cache_config.pop(k)
     return update_cache_config(**_CACHE_CONFIG_DEFAULTS)
 
 
+def _get_config(key: str, default: Any = None) -> Any:
+    """A setting of the active tier, if tiers are configured and it has its own."""
+
+    tiers = __cache_config.get('tiers')
+    if tiers:
+        tier_config = tiers[_active_tier.get()]
+        if key in tier_config:
+            return tier_config[key]
+    return __cache_config.get(key, default)
+
+
 def _get_cache_dir() -> str:
-    return __cache_config['cache_dir']
+    return _get_config('cache_dir')
+
+
+def _get_n_tiers() -> int:
+    return len(__cache_config.get('tiers') or ()) or 1
+
+
+@contextlib.contextmanager
+def _using_tier(tier: int) -> Iterator[None]:
+    """Operate on tier `tier` (of the configured "tiers") within the block."""
+
+    token = _active_tier.set(tier)
+    try:
+        yield
+    finally:
+        _active_tier.reset(token)
 
 
 def _get_cache_path(filename: str = '') -> str:
     return os.path.join(_get_cache_dir(), filename)
 
 
+def _get_shard_depth() -> int:
+    depth = _get_config('shard_depth', 0)
+    if not 0 <= depth <= _MAX_SHARD_DEPTH:
+        raise ValueError(f'shard_depth must be between 0 and {_MAX_SHARD_DEPTH}')
+    return depth
+
+
+def _get_object_path(hash: str, shard_depth: Optional[int] = None) -> str:
+    """Where the object of `hash` is written: `<cache_dir>/ab/cd/abcd...` for a
+    `shard_depth` (by default, the configured one) of 2."""
+
+    if shard_depth is None:
+        shard_depth = _get_shard_depth()
+    shards = (
+        hash[i * _SHARD_WIDTH : (i + 1) * _SHARD_WIDTH] for i in range(shard_depth)
+    )
+    return os.path.join(_get_cache_dir(), *shards, hash)
+
+
+def _find_object_path(hash: str) -> str:
+    """Where the object of `hash` is found, falling back to the flat layout for
+    caches written before sharding was configured."""
+
+    path = _get_object_path(hash)
+    if path != _get_cache_path(hash) and not os.path.exists(path):
+        flat_path = _get_cache_path(hash)
+        if os.path.exists(flat_path):
+            return flat_path
+    return path
+
+
+def _get_index_backend() -> str:
+    return _get_config('index_backend', 'json')
+
+
 def _get_index_path() -> str:
+    backend = _get_index_backend()
+    if backend == 'journal':
+        return _get_cache_path(_CACHE_JOURNAL_FILE)
+    if backend == 'sqlite':
+        return _get_cache_path(_CACHE_SQLITE_FILE)
     return _get_cache_path(_CACHE_INDEX_FILE)
 
 
@@ -98,30 +371,285 @@ def _to_string(arg: Any) -> str:
     return str(arg)
 
 
+def _hash_call(*args, **kwargs) -> _Key:
+    """Returns the key for a call and, engine permitting, an independent check value
+    to tell colliding keys apart."""
+
+    engine = _get_config('hash_engine', _DEFAULT_HASH_ENGINE)
+    if engine == 'legacy':
+        args_string = _to_string(args) + _to_string(kwargs)
+        return hashlib.sha256(args_string.encode()).hexdigest()[:8], None
+    size = _get_config('hash_size', _DEFAULT_HASH_SIZE)
+    key, check = _hashing.hash_values(engine, size, args, kwargs)
+    return key, check or None
+
+
 def _hash_args(*args, **kwargs) -> str:
-    args_string = _to_string(args) + _to_string(kwargs)
-    return hashlib.sha256(args_string.encode()).hexdigest()[:8]
+    return _hash_call(*args, **kwargs)[0]
+
+
+def _key_call(name: str, *args, **kwargs) -> _Key:
+    """:func:`_hash_call` for a call of callable `name`, timed into its stats."""
+
+    started = time.perf_counter()
+    key = _hash_call(name, *args, **kwargs)
+    _stats.record(name, hash_seconds=time.perf_counter() - started)
+    return key
+
+
+def _is_collision(entry: _EntryDict, check: Optional[str]) -> bool:
+    return entry.get('key_check', check) != check
+
+
+def register_key_encoder(cls: type, encoder: Callable[[Any], Any]) -> None:
+    """Register how instances of a type are turned into cache keys.
+
+    Args:
+
+        cls (type): The type (subclasses included) whose instances are to be encoded.
+
+        encoder (Callable): Maps an instance to a value the key engine understands,
+            e.g. a tuple of its identifying fields.
+    """
+
+    _hashing.register_encoder(cls, encoder)
+
+
+def register_serializer(
+    name: str,
+    dump: Callable[[Any, IO[bytes]], None],
+    load: Callable[[IO[bytes]], Any],
+) -> None:
+    """Register a serializer, to be chosen by name through `_serializer`.
+
+    Args:
+
+        name (str): The serializer's name, as recorded in the index.
+
+        dump (Callable): Writes a value to a binary file object.
+
+        load (Callable): Reads a value back from a binary file object.
+    """
+
+    _serializers.register(name, dump, load)
+
+
+def get_stats() -> dict:
+    """Statistics on what the cache did in this process, since it started (or since
+    :func:`reset_stats`).
+
+    Counters: "hits" (of which "memory_hits"), "misses", "refreshes" (background
+    recomputes), "promotions" (hits found in a lower tier), "expirations",
+    "evictions", "bytes_read", "bytes_written", and the
+    seconds spent hashing arguments ("hash_seconds"), looking up the index
+    ("index_seconds"), loading values ("load_seconds") and computing them
+    ("compute_seconds").
+
+    Returns:
+
+        dict: The counters summed over all callables under "total", and those of
+            each callable under "callables" (by the name recorded in the index).
+    """
+
+    return _stats.snapshot()
+
+
+def reset_stats() -> None:
+    """Zero all counters returned by :func:`get_stats`."""
+
+    _stats.reset()
+
+
+def add_stats_hook(hook: Callable[[str, float, str], None]) -> None:
+    """Pass every increment of the counters of :func:`get_stats` on to `hook`, e.g.
+    to export them to Prometheus or StatsD.
+
+    Args:
+
+        hook (Callable): Called as `hook(counter, increment, callable)`, on the
+            thread doing the counting, so it should be quick.  Exceptions it raises
+            are logged and otherwise ignored.
+    """
+
+    _stats.add_hook(hook)
+
+
+def remove_stats_hook(hook: Callable[[str, float, str], None]) -> None:
+    """Stop passing counter increments on to a hook added by :func:`add_stats_hook`."""
+
+    _stats.remove_hook(hook)
+
+
+def _stat_signature(path: str) -> _StatSignature:
+    stat = os.stat(path)
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
 
 
 def _read_index() -> _IndexDict:
-    with open(_get_index_path(), 'r') as f:
+    """Parse `index.json`, reusing the last parse while the file is unchanged.
+
+    Note: The returned dict is shared with later calls; copy it before mutating it
+        without writing it back.
+    """
+
+    path = _get_index_path()
+    backend = _get_index_backend()
+    if backend == 'journal':
+        return _journal.read_index(path)
+    if backend == 'sqlite':
+        return _sqlite.read_index(path)
+    signature = _stat_signature(path)
+    cached = _parsed_indexes.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    with open(path, 'r') as f:
         index = json.load(f)
+    if cached is not None and cached[1] == index:
+        index = cached[1]  # unchanged after all; keep its identity (and next expiry)
+    _parsed_indexes[path] = (signature, index)
     return index
 
 
 def _write_index(index: _IndexDict) -> None:
-    with open(_get_index_path(), 'w') as f:
+    path = _get_index_path()
+    backend = _get_index_backend()
+    if backend == 'journal':
+        _journal.write_index(path, index)
+        return
+    if backend == 'sqlite':
+        _sqlite.write_index(path, index)
+        return
+    with _locking.atomic_write(path, 'w') as f:
         json.dump(index, f)
+    _parsed_indexes[path] = (_stat_signature(path), index)
+
+
+@contextlib.contextmanager
+def _index_lock() -> Iterator[None]:
+    """Lock held while mutating the index.  SQLite brings its own transactions.
+
+    Note: Another process may have replaced `index.json` with one of the same stat
+        signature (inodes alternate between atomic writes, and mtimes can be coarse),
+        so the first read under a freshly taken lock always re-parses it.  The
+        cached dict is kept if the contents turn out to be unchanged.
+    """
+
+    if _get_index_backend() == 'sqlite':
+        yield
+        return
+    cache_dir = _get_cache_dir()
+    outermost = not _locking.is_held(cache_dir)
+    with _locking.lock(cache_dir):
+        cached = _parsed_indexes.get(_get_index_path())
+        if outermost and cached is not None:
+            _parsed_indexes[_get_index_path()] = (_UNVERIFIED, cached[1])
+        yield
+
+
+def _get_next_expiry(index: _IndexDict) -> Optional[datetime.datetime]:
+    """The earliest expiry among `index`'s entries, if known for this very dict."""
 
+    known = _next_expiries.get(_get_index_path())
+    if known is not None and known[0] is index:
+        return known[1]
+    return None
 
-def _write_entry_to_index(
+
+def _set_next_expiry(
     index: _IndexDict,
-    hash: str,
-    entry: _EntryDict,
-) -> _IndexDict:
-    index[hash] = entry
-    _write_index(index)
-    return index
+    next_expiry: Optional[datetime.datetime],
+) -> None:
+    path = _get_index_path()
+    if next_expiry is None:
+        _next_expiries.pop(path, None)
+    else:
+        _next_expiries[path] = (index, next_expiry)
+
+
+def _write_entries_to_index(
+    entries: _IndexDict,
+    accesses: Optional[Dict[str, list]] = None,
+) -> None:
+    """Add `entries` and record `accesses` of existing ones in a single write."""
+
+    backend = _get_index_backend()
+    if backend == 'sqlite':
+        _sqlite.add_entries(_get_index_path(), entries, accesses)
+        return
+    with _index_lock():
+        index = _read_index()
+        next_expiry = _get_next_expiry(index)
+        for entry in entries.values():
+            if next_expiry is not None:
+                expiry = _get_expiry(entry) or datetime.datetime.max
+                next_expiry = min(next_expiry, expiry)
+        updates = {
+            hash: _with_accesses(index[hash], last_accessed, hits)
+            for hash, (last_accessed, hits) in (accesses or {}).items()
+            if hash in index and hash not in entries
+        }
+        old = index
+        if backend == 'journal':
+            index = _journal.add_entries(_get_index_path(), {**updates, **entries})
+        else:
+            index = {**index, **updates, **entries}
+            _write_index(index)
+        _set_next_expiry(index, next_expiry)
+        _carry_usage_over(old, index, entries, ())
+
+
+def _with_accesses(entry: _EntryDict, last_accessed: str, hits: int) -> _EntryDict:
+    return {
+        **entry,
+        'last_accessed': last_accessed,
+        'hits': entry.get('hits', 0) + hits,
+    }
+
+
+def _record_access(hash: str, flush: bool = True) -> bool:
+    """Note a hit.  Accesses are buffered and only written out along with the next
+    entry added (or once enough accumulated), so hits stay read-only.
+
+    Returns whether enough accumulated, flushing them unless `flush` is false.
+    """
+
+    now = datetime.datetime.utcnow().isoformat()
+    with _pending_accesses_lock:
+        access = _pending_accesses.setdefault(hash, [now, 0])
+        access[0] = now
+        access[1] += 1
+        n_pending = len(_pending_accesses)
+    if n_pending < _ACCESS_FLUSH_SIZE:
+        return False
+    if flush:
+        _flush_accesses()
+    return True
+
+
+def _record_access_async(hash: str) -> None:
+    """:func:`_record_access`, flushing on the executor rather than the event loop."""
+
+    if _record_access(hash, flush=False):
+        task = asyncio.ensure_future(_run_in_executor(_flush_accesses))
+        _flush_tasks.add(task)
+        task.add_done_callback(_flush_tasks.discard)
+
+
+def _take_accesses() -> Dict[str, list]:
+    """Note: Accesses are of the top tier, so there are none to take for others."""
+
+    global _pending_accesses
+    if _active_tier.get():
+        return {}
+    with _pending_accesses_lock:
+        accesses, _pending_accesses = _pending_accesses, {}
+    return accesses
+
+
+def _flush_accesses() -> None:
+    accesses = _take_accesses()
+    if accesses and os.path.exists(_get_index_path()):
+        _write_entries_to_index({}, accesses)
 
 
 def get_by_hash(hash: str) -> Any:
@@ -136,224 +664,2396 @@ def get_by_hash(hash: str) -> Any:
         Any: The return value of the function call.
     """
 
-    with open(_get_cache_path(hash), 'rb') as f:
-        value = pickle.load(f)
-    return value
+    _init_cache()  # e.g. a top tier yet to promote anything into
+    return _read_object(hash, _peek_entry(hash) or _promote(hash))
 
 
-def _write_object_by_hash(hash: str, value: Any) -> None:
-    with open(_get_cache_path(hash), 'wb') as f:
-        pickle.dump(value, f)
+def _read_object(hash: str, entry: Optional[_EntryDict]) -> Any:
+    return _read_stored(hash, entry)[0]
 
 
-def _remove_objects(to_remove: List[str]) -> None:
-    for hash in to_remove:
-        os.remove(_get_cache_path(hash))
+def _read_stored(hash: str, entry: Optional[_EntryDict]) -> Tuple[Any, int]:
+    """Returns the object of `hash`, and its size, wherever `entry` has it stored."""
 
+    started = time.perf_counter()
+    serializer = (entry or {}).get('serializer', _serializers.DEFAULT)
+    if entry is not None and 'segment' in entry:
+        data = _packs.read(
+            _get_pack_dir(), entry['segment'], entry['offset'], entry['length']
+        )
+        value = _serializers.get(serializer).load(io.BytesIO(data))
+        nbytes = len(data)
+    else:
+        path = _find_object_path(hash)
+        value = _load_object(path, serializer)
+        nbytes = os.path.getsize(path)
+    if entry is not None:
+        _stats.record(
+            entry['callable'],
+            bytes_read=nbytes,
+            load_seconds=time.perf_counter() - started,
+        )
+    return value, nbytes
 
-def _remove_entries(index: _IndexDict, to_remove: List[str]) -> _IndexDict:
-    index = {k: v for k, v in index.items() if k not in to_remove}
-    _write_index(index)
-    return index
 
+def _load_object(path: str, serializer: str) -> Any:
+    if serializer == _serializers.STREAM:
+        # opened right away, so a hit is readable to the end even if removed meanwhile
+        stream = _iter_stream(path)
+        next(stream)
+        return stream
+    with open(path, 'rb') as f:
+        if serializer == 'pickle':
+            token = _read_buffers_token(f)
+            return pickle.load(f, buffers=_iter_buffers(path, token))
+        return _serializers.get(serializer).load(f)
 
-def _is_expired(entry: _EntryDict) -> bool:
-    expires_after = entry.get('expires_after')
-    if expires_after:
-        called_at = datetime.datetime.fromisoformat(entry['called_at'])
-        expires_after = datetime.timedelta(seconds=expires_after)
-        now = datetime.datetime.utcnow()
-        expired = called_at + expires_after < now
-    else:
-        expired = False
-    return expired
 
+def _iter_stream(path: str) -> Iterator:
+    """Yields once the file is open, then its items; closing the stream (or
+    dropping it unconsumed) closes the file."""
 
-def _remove_expired_items(index: _IndexDict) -> _IndexDict:
-    to_remove = []
-    for hash, entry in index.items():
-        if _is_expired(entry):
-            to_remove.append(hash)
-    index = _remove_entries(index, to_remove)
-    _remove_objects(to_remove)
-    return index
+    with open(path, 'rb') as f:
+        yield
+        yield from _serializers.get(_serializers.STREAM).load(f)
 
 
-def _sort_index(index: _IndexDict) -> _IndexDict:
-    index = {k: v for k, v in sorted(index.items(), key=lambda x: x[1]['called_at'])}
-    return index
+def _get_serializer_for(value: Any, serializer: str) -> str:
+    """Generators cannot be serialized whole, so they are always streamed."""
 
+    if isinstance(value, types.GeneratorType):
+        return _serializers.STREAM
+    return serializer
 
-def get_index(clear_expired: bool = True) -> _IndexDict:
-    """Retrieve `index.json` metadata dict about cache contents.
 
-    Note: When using `expires_after` expiration rules, expired cache contents will be
-        permanently removed upon calling this function (or checking the cache again),
-        unless `clear_expired` is set to `False`.
+def _get_buffer_path(path: str, i: int, token: str = '') -> str:
+    """Note: Buffers of objects written before they were versioned have no token."""
 
-    Args:
-        clear_expired (bool): Clear expired cache contents upon call.
+    if token:
+        return f'{path}.{token}.{i}.buf'
+    return f'{path}.{i}.buf'
 
-    Returns:
-        dict: The current state of the cache.
-    """
 
-    index = _read_index()
-    if clear_expired:
-        index = _remove_expired_items(index)
-    index = _sort_index(index)
-    return index
+def _read_buffers_token(f: IO[bytes]) -> str:
+    """The token naming the buffers of the object file `f`, read past its header."""
 
+    if f.read(len(_BUFFERS_HEADER)) != _BUFFERS_HEADER:
+        f.seek(0)
+        return ''
+    return f.readline().rstrip(b'\n').decode()
 
-def _init_cache() -> None:
+
+def _get_buffers_token(path: str) -> Optional[str]:
     try:
-        os.makedirs(_get_cache_dir())
-        _write_index({})
-    except FileExistsError:
-        pass
+        with open(path, 'rb') as f:
+            return _read_buffers_token(f)
+    except FileNotFoundError:
+        return None
 
 
-def clear_cache() -> None:
-    """Removes cache directory and all files within it.  If configured cache directory
-    is a path, remove only the bottom-most empty directories within that path.
-    """
+def _list_buffer_paths(path: str, token: str) -> List[str]:
+    """Paths of the buffers named `token` of the object file at `path`."""
 
-    def _remove_bottom_dir(path):
-        dirs = path.rstrip('/').split('/')
-        new_path = '/'.join(dirs[:-1])
-        return new_path
+    paths: List[str] = []
+    for i in itertools.count():
+        buffer_path = _get_buffer_path(path, i, token)
+        if not os.path.exists(buffer_path):
+            return paths
+        paths.append(buffer_path)
+    raise AssertionError  # unreachable
 
-    cache_path = _get_cache_path()
-    shutil.rmtree(cache_path, ignore_errors=True)
-    cache_path = _remove_bottom_dir(cache_path)
-    while cache_path:
+
+def _iter_buffers(path: str, token: str) -> Iterator[mmap.mmap]:
+    """Memory-maps an object's out-of-band buffers, as `pickle.load` asks for them."""
+
+    for i in itertools.count():
+        with open(_get_buffer_path(path, i, token), 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        yield buffer
+
+
+def _remove_buffers(path: str, token: str) -> None:
+    for i in itertools.count():
         try:
-            os.rmdir(cache_path)
-            cache_path = _remove_bottom_dir(cache_path)
-        except OSError:
+            os.remove(_get_buffer_path(path, i, token))
+        except FileNotFoundError:
             break
 
 
-def _describe_callable(f: Callable) -> str:
-    """Note: Some callables are missing a :attr:`__qualname__`, so including `type()`
-    provides at least some information."""
+@contextlib.contextmanager
+def _replace_object_file(path: str) -> Iterator[IO]:
+    """:func:`_open_object_file` for an object file (rather than a buffer), removing
+    the buffers of the version it replaces once it did.
 
-    mod = f.__module__
-    name = getattr(f, '__qualname__', str(type(f)))
-    return f'{mod}.{name}'
+    Every version's buffers are named by a token of its own, recorded in its header,
+    so a reader of the old version never maps the new one's buffers meanwhile.
+    """
 
+    replaced = _get_buffers_token(path)
+    with _open_object_file(path) as f:
+        yield f
+    if replaced is not None:
+        _remove_buffers(path, replaced)
 
-def _expires_after_to_float(expires_after: Union[float, datetime.timedelta]) -> float:
-    if isinstance(expires_after, datetime.timedelta):
-        expires_after = expires_after.total_seconds()
-    return expires_after
 
+def _get_pack_dir() -> str:
+    return _get_cache_path(_CACHE_PACK_DIR)
 
-def _format_entry(
-    f: Callable,
-    called_at: str,
-    expires_after: Optional[Union[float, datetime.timedelta]],
-    annotation: Optional[str],
-) -> _EntryDict:
-    entry = {
-        'callable': _describe_callable(f),
-        'called_at': called_at,
-    }
-    if expires_after:
-        # mypy thinks `expires_after` is a string here
-        entry['expires_after'] = _expires_after_to_float(expires_after)  # type: ignore
-    if annotation:
-        entry['annotation'] = annotation
-    return entry
 
+def _open_object_file(path: str) -> ContextManager[IO]:
+    if path != _get_cache_path(os.path.basename(path)):  # sharded
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    return _locking.atomic_write(path)
 
-def cache(
-    f: Callable,
-    *args,
-    _expires_after: Optional[Union[float, datetime.timedelta]] = None,
-    _annotation: Optional[str] = None,
-    **kwargs,
-) -> Any:
+
+def _write_object_by_hash(
+    hash: str,
+    value: Any,
+    serializer: str = _serializers.DEFAULT,
+) -> Tuple[int, Optional[_EntryDict]]:
+    """Serialize `value` to its object file, returning the number of bytes written and
+    the fields locating it: in a pack, or in the content store.
+
+    With "mmap_threshold" configured, the default pickle serializer writes buffers at
+    least that large (e.g. the data of NumPy arrays) out-of-band to
+    `<hash>.<token>.<i>.buf` sidecar files via pickle protocol 5, to be memory-mapped
+    rather than copied when read back.  The token is new for every write, and is
+    recorded in a header ahead of the pickle.  Otherwise, with "pack_threshold"
+    configured, objects smaller than that are appended to a pack segment instead of
+    getting a file of their own, and with "dedupe" configured, objects are digested
+    as written and shared by content.
     """
-    Calls a function and caches the results.
 
-    Args:
+    path = _get_object_path(hash)
+    threshold = _get_config('mmap_threshold')
+    if serializer != 'pickle' or threshold is None:
+        dump = _serializers.get(serializer).dump
+        pack_threshold = _get_config('pack_threshold')
+        with contextlib.ExitStack() as stack:
+            writer: Any
+            if pack_threshold is None:
+                writer = stack.enter_context(_replace_object_file(path))
+            else:
+                writer = _packs.SpillWriter(
+                    pack_threshold,
+                    lambda: stack.enter_context(_replace_object_file(path)),
+                )
+            digesting = _DigestingWriter(writer) if _get_config('dedupe') else None
+            dump(value, digesting or writer)  # type: ignore  # as good as a file
+            nbytes = writer.tell()
+        if pack_threshold is not None and writer.buffer is not None:  # not spilled
+            segment, offset, length = _packs.append(
+                _get_pack_dir(), bytes(writer.buffer)
+            )
+            return length, {'segment': segment, 'offset': offset, 'length': length}
+        if digesting is not None:
+            return nbytes, _share_content(path, digesting.hexdigest())
+        return nbytes, None
 
-        f (Callable):
+    nbytes = 0
+    n_buffers = 0
+    token = uuid.uuid4().hex
 
-            Function whose results are to be cached.
+    def _write_buffer(buffer: pickle.PickleBuffer) -> bool:
+        nonlocal nbytes, n_buffers
+        try:
+            data = buffer.raw()
+        except BufferError:  # not contiguous
+            return True
+        if not data.nbytes or data.nbytes < threshold:
+            return True
+        with _open_object_file(_get_buffer_path(path, n_buffers, token)) as f:
+            f.write(data)
+        nbytes += data.nbytes
+        n_buffers += 1
+        return False
 
-        *args (optional):
+    with _replace_object_file(path) as f:
+        f.write(_BUFFERS_HEADER + token.encode() + b'\n')
+        pickle.dump(value, f, protocol=5, buffer_callback=_write_buffer)
+        nbytes += f.tell()
+    return nbytes, None
 
-            The function call's arguments.
 
-        **kwargs (optional):
+class _DigestingWriter:
+    """Binary file stand-in passing writes on to `f`, digesting them on the way."""
 
-            The function call's keyword arguments.
+    def __init__(self, f: Any) -> None:
+        self.f = f
+        self.digest = hashlib.blake2b(digest_size=_CONTENT_DIGEST_SIZE)
 
-        _expires_after (float, :obj:`datetime.timedelta`, optional):
+    def write(self, data: bytes) -> int:
+        self.digest.update(data)
+        return self.f.write(data)
 
-            Time elapsed after which the cache entry will be cleared.  Numeric values
-                are interpreted as seconds.
+    def flush(self) -> None:
+        self.f.flush()
 
-        _annotation (:obj:`str`, optional):
+    def tell(self) -> int:
+        return self.f.tell()
 
-            Arbitrary string that can be passed to help identify or describe the call.
+    def hexdigest(self) -> str:
+        return self.digest.hexdigest()
 
-    Returns:
 
-        value (any):
+def _get_content_path(digest: str) -> str:
+    return _get_cache_path(
+        os.path.join(_CACHE_CONTENT_DIR, digest[:_SHARD_WIDTH], digest)
+    )
 
-            The return value of the original function call.
+
+def _share_content(path: str, digest: str) -> Optional[_EntryDict]:
+    """Deduplicate the object just written to `path`: it becomes the payload stored for
+    `digest`, or is replaced by a link to the one already stored.  Returns the field
+    recording `digest` in its entry.
+
+    Note: Payloads are reference-counted by the filesystem, as their number of (hard)
+        links: one linked to by no object any more is removed by
+        :func:`_release_contents`.
     """
 
-    _init_cache()
-    hash = _hash_args(
-        _describe_callable(f),  # lazy, but keeps :meth:`_hash_args` dumb
-        *args,
-        **kwargs,
+    content_path = _get_content_path(digest)
+    os.makedirs(os.path.dirname(content_path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.link'
+    while True:
+        try:
+            os.link(path, content_path)
+            break
+        except FileExistsError:
+            pass
+        except OSError:  # no hard links on this filesystem
+            logger.debug('not deduplicating', exc_info=True)
+            return None
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        try:
+            os.link(content_path, tmp_path)
+        except FileNotFoundError:  # released in the meantime
+            continue
+        os.replace(tmp_path, path)
+        break
+    return {'content': digest}
+
+
+def _release_contents(digests: Iterable[str]) -> None:
+    """Remove the payloads of `digests` that no object links to any more."""
+
+    for digest in set(digests):
+        path = _get_content_path(digest)
+        with contextlib.suppress(FileNotFoundError):
+            if os.stat(path).st_nlink == 1:
+                os.remove(path)
+
+
+def _get_contents(entries: Iterable[Optional[_EntryDict]]) -> List[str]:
+    return [entry['content'] for entry in entries if entry and 'content' in entry]
+
+
+def _memory_tier_enabled() -> bool:
+    return (
+        _get_config('memory_max_entries') is not None
+        or _get_config('memory_max_bytes') is not None
     )
-    index = get_index(clear_expired=True)
-    if hash in index:
-        value = get_by_hash(hash)
-        logger.debug('cache hit')
-    else:
-        logger.debug('caching...')
-        called_at = datetime.datetime.utcnow().isoformat()
-        value = f(*args, **kwargs)
-        _write_object_by_hash(hash, value)
-        _write_entry_to_index(
-            index,
-            hash,
-            entry=_format_entry(
-                f,
-                called_at,
-                _expires_after,
-                _annotation,
-            ),
-        )
-        logger.debug('caching successful.')
-    return value
 
 
-def cache_wrapper(
-    _expires_after: Optional[Union[float, datetime.timedelta]] = None,
-    _annotation: Optional[str] = None,
-) -> Callable:
+def _get_from_memory(
+    hash: str, check: Optional[str] = None
+) -> Tuple[Any, Optional[datetime.datetime]]:
+    """Returns the value held in memory (or :data:`_memory.MISSING`) and until when
+    it is fresh."""
 
-    # TODO: support wrapping bound methods.
+    if not _memory_tier_enabled():
+        return _memory.MISSING, None
+    item = _memory_tier.get((_get_cache_dir(), hash))
+    if item is _memory.MISSING or item[0] != check:
+        return _memory.MISSING, None
+    return item[1], item[2]
 
-    def decorator(f: Callable) -> Callable:
-        @functools.wraps(f)
-        def wrapped(*args, **kwargs) -> Any:
-            return cache(
-                f,
-                *args,
-                **kwargs,
-                _expires_after=_expires_after,
-                _annotation=_annotation,
+
+def _put_in_memory(
+    hash: str,
+    value: Any,
+    entry: _EntryDict,
+    nbytes: int,
+    check: Optional[str] = None,
+) -> None:
+    if not _memory_tier_enabled() or entry.get('serializer') == _serializers.STREAM:
+        return  # streams are iterated once, so every hit reads its own
+    _memory_tier.put(
+        (_get_cache_dir(), hash),
+        (check, value, _get_fresh_until(entry)),
+        _get_expiry(entry),
+        nbytes,
+        max_entries=_get_config('memory_max_entries'),
+        max_bytes=_get_config('memory_max_bytes'),
+    )
+
+
+def _remove_objects(removed: _IndexDict) -> None:
+    """Remove the objects of the `removed` entries, and the payloads no other object
+    shares any more.
+
+    Note: Packed objects are reclaimed by compacting their segments, once enough
+        of a segment's entries are gone.
+    """
+
+    for hash in removed:
+        for path in {_get_object_path(hash), _get_cache_path(hash)}:
+            _remove_object_files(path)
+    _release_contents(_get_contents(removed.values()))
+    packed = [
+        (entry['segment'], entry['offset'], entry['length'])
+        for entry in removed.values()
+        if 'segment' in entry
+    ]
+    if packed and _packs.release(_get_pack_dir(), packed):
+        _compact_packs()
+
+
+def _compact_packs() -> None:
+    with _index_lock():
+        index = _read_index()
+        locations = {
+            hash: (entry['segment'], entry['offset'], entry['length'])
+            for hash, entry in list(index.items())
+            if 'segment' in entry
+        }
+        moved = _packs.compact(_get_pack_dir(), locations)
+        if moved:
+            logger.debug(f'compacted {len(moved)} packed objects')
+            if _get_index_backend() == 'sqlite':
+                # no index lock: only move entries not refreshed in the meantime
+                _sqlite.relocate(
+                    _get_index_path(),
+                    {hash: (locations[hash], moved[hash]) for hash in moved},
+                )
+                return
+            _write_entries_to_index(
+                {
+                    hash: {
+                        **index[hash],
+                        'segment': segment,
+                        'offset': offset,
+                        'length': length,
+                    }
+                    for hash, (segment, offset, length) in moved.items()
+                }
             )
 
-        return wrapped
 
-    return decorator
+def _remove_object_files(path: str) -> None:
+    token = _get_buffers_token(path)
+    with contextlib.suppress(FileNotFoundError):  # raced with another process
+        os.remove(path)
+    _remove_buffers(path, token or '')
+
+
+def _remove_entries(
+    index: _IndexDict,
+    to_remove: List[str],
+    next_expiry: Optional[datetime.datetime] = None,
+) -> _IndexDict:
+    """Note: Removing entries never brings the next expiry forward, so the current
+    one is carried over unless a fresher one is given."""
+
+    cache_dir = _get_cache_dir()
+    _memory_tier.discard((cache_dir, hash) for hash in to_remove)
+    to_remove_set = set(to_remove)
+    backend = _get_index_backend()
+    if backend == 'sqlite':
+        _sqlite.remove_entries(_get_index_path(), to_remove)
+        return {k: v for k, v in index.items() if k not in to_remove_set}
+    with _index_lock():
+        fresh = _read_index()
+        if fresh is not index:
+            index = fresh
+            next_expiry = None
+        elif next_expiry is None:
+            next_expiry = _get_next_expiry(index)
+        old = index
+        if backend == 'journal':
+            index = _journal.remove_entries(_get_index_path(), to_remove)
+        else:
+            index = {k: v for k, v in index.items() if k not in to_remove_set}
+            _write_index(index)
+        _set_next_expiry(index, next_expiry)
+        _carry_usage_over(old, index, {}, to_remove_set)
+    return index
+
+
+def _get_fresh_until(entry: _EntryDict) -> Optional[datetime.datetime]:
+    expires_after = entry.get('expires_after')
+    if not expires_after:
+        return None
+    called_at = datetime.datetime.fromisoformat(entry['called_at'])
+    return called_at + datetime.timedelta(seconds=expires_after)
+
+
+def _get_expiry(entry: _EntryDict) -> Optional[datetime.datetime]:
+    """When `entry` is removed: once it has been stale for its "stale_ttl", if any."""
+
+    fresh_until = _get_fresh_until(entry)
+    if fresh_until is None:
+        return None
+    return fresh_until + datetime.timedelta(seconds=entry.get('stale_ttl', 0))
+
+
+def _is_expired(entry: _EntryDict) -> bool:
+    expiry = _get_expiry(entry)
+    return expiry is not None and expiry < datetime.datetime.utcnow()
+
+
+def _remove_expired_items(index: _IndexDict) -> _IndexDict:
+    """Remove expired entries, only touching disk if any are found.
+
+    The earliest expiry among the remaining entries is remembered alongside the
+    parsed index, so lookups before that moment skip the scan entirely.
+    """
+
+    if _get_index_backend() == 'sqlite':
+        expired = set(_remove_expired_rows())
+        return {k: v for k, v in index.items() if k not in expired}
+    now = datetime.datetime.utcnow()
+    next_expiry = _get_next_expiry(index)
+    if next_expiry is not None and now <= next_expiry:
+        return index
+    to_remove = []
+    next_expiry = datetime.datetime.max
+    for hash, entry in list(index.items()):
+        expiry = _get_expiry(entry)
+        if expiry is None:
+            continue
+        if expiry < now:
+            to_remove.append(hash)
+        else:
+            next_expiry = min(next_expiry, expiry)
+    if to_remove:
+        with _index_lock():
+            fresh = _read_index()
+            if fresh is not index:
+                to_remove = [h for h in to_remove if _is_expired(fresh.get(h, {}))]
+                index, next_expiry = fresh, None
+            removed = {h: index[h] for h in to_remove}
+            _record_removals('expirations', removed.values())
+            index = _remove_entries(index, to_remove, next_expiry)
+            _remove_objects(removed)
+    else:
+        _set_next_expiry(index, next_expiry)
+    return index
+
+
+def _remove_expired_rows() -> List[str]:
+    removed = _sqlite.remove_expired(_get_index_path(), datetime.datetime.utcnow())
+    if removed:
+        _memory_tier.discard((_get_cache_dir(), hash) for hash in removed)
+        _remove_objects(removed)
+        _record_removals('expirations', removed.values())
+    return list(removed)
+
+
+def _record_removals(counter: str, entries: Iterable[_EntryDict]) -> None:
+    for name, n in collections.Counter(e['callable'] for e in entries).items():
+        _stats.record(name, **{counter: n})
+
+
+def _public_entry(entry: _EntryDict, details: bool = False) -> _EntryDict:
+    """Copy of `entry` without internal bookkeeping fields, bar those giving its
+    cost and usage if asked for `details`."""
+
+    fields = (
+        _PUBLIC_ENTRY_FIELDS + _DETAIL_ENTRY_FIELDS if details else _PUBLIC_ENTRY_FIELDS
+    )
+    return {k: entry[k] for k in fields if k in entry}
+
+
+def _sort_index(index: _IndexDict, details: bool = False) -> _IndexDict:
+    index = {
+        k: _public_entry(v, details)
+        for k, v in sorted(index.items(), key=lambda x: x[1]['called_at'])
+    }
+    return index
+
+
+def _load_index(clear_expired: bool = True) -> _IndexDict:
+    """Lookup-path counterpart to :func:`get_index`: no sorting, no copying."""
+
+    if clear_expired and _get_index_backend() == 'sqlite':
+        _remove_expired_rows()
+        return _read_index()
+    index = _read_index()
+    if clear_expired:
+        index = _remove_expired_items(index)
+    return index
+
+
+def _lookup_entry(hash: str) -> Optional[_EntryDict]:
+    """Look up a single entry after clearing expired ones.  With the SQLite backend
+    this is a point query rather than a read of the whole index."""
+
+    if _get_index_backend() == 'sqlite':
+        _remove_expired_rows()
+        return _sqlite.lookup(_get_index_path(), hash)
+    return _load_index(clear_expired=True).get(hash)
+
+
+def _read_entry(hash: str, name: str) -> Tuple[Any, Optional[_EntryDict], int]:
+    """Returns the cached value, its entry and its size, or an entry of `None`.
+    Time spent on the index is recorded in the stats of callable `name`."""
+
+    started = time.perf_counter()
+    entry = _lookup_entry(hash)
+    _stats.record(name, index_seconds=time.perf_counter() - started)
+    if entry is None:
+        entry = _promote(hash)
+    if entry is None:
+        return _memory.MISSING, None, 0
+    try:
+        value, nbytes = _read_stored(hash, entry)
+    except FileNotFoundError:  # removed by another process in the meantime
+        return _memory.MISSING, None, 0
+    logger.debug('cache hit')
+    return value, entry, nbytes
+
+
+def _single_flight(hash: str) -> ContextManager:
+    """Lease under which a miss is computed, so concurrent callers compute it once."""
+
+    timeout = _get_config('lease_timeout', _DEFAULT_LEASE_TIMEOUT)
+    return _locking.lease(_get_cache_path(hash), timeout)
+
+
+def _peek_entry(hash: str) -> Optional[_EntryDict]:
+    """Look up a single entry, leaving expired ones alone."""
+
+    if _get_index_backend() == 'sqlite':
+        return _sqlite.lookup(_get_index_path(), hash)
+    return _read_index().get(hash)
+
+
+def _add_entries(entries: _IndexDict) -> None:
+    _replace_entries(entries, _take_accesses())
+    _evict_over_budget(keep=entries)
+    if _get_n_tiers() > 1 and not _active_tier.get():
+        _write_to_lower_tiers(entries)
+
+
+def _add_to_tier(tier: int, entries: _IndexDict) -> None:
+    """:func:`_add_entries` for entries copied into `tier`, which are not written on
+    to other tiers."""
+
+    with _using_tier(tier):
+        _replace_entries(entries)
+        _evict_over_budget(keep=entries)
+
+
+def _replace_entries(
+    entries: _IndexDict,
+    accesses: Optional[Dict[str, list]] = None,
+) -> None:
+    """:func:`_write_entries_to_index`, releasing the payloads of the entries replaced
+    (whose objects were just overwritten)."""
+
+    if not _get_config('dedupe'):
+        _write_entries_to_index(entries, accesses)
+        return
+    replaced = _get_contents(_peek_entry(hash) for hash in entries)
+    _write_entries_to_index(entries, accesses)
+    _release_contents(replaced)
+
+
+def _copy_object(hash: str, entry: _EntryDict, source: int, target: int) -> _EntryDict:
+    """Copy the object of `entry` from tier `source` to tier `target` as stored
+    (without deserializing it), returning its entry there."""
+
+    fields = {k: v for k, v in entry.items() if k not in _LOCATION_FIELDS}
+    if 'segment' in entry:
+        with _using_tier(source):
+            data = _packs.read(
+                _get_pack_dir(), entry['segment'], entry['offset'], entry['length']
+            )
+        with _using_tier(target):
+            _init_cache()
+            location = _place_object(hash, io.BytesIO(data), len(data), 0)
+        return {**fields, **(location or {})}
+    with _using_tier(source):
+        path = _find_object_path(hash)
+        f = open(path, 'rb')  # kept open, so its buffers are those of this version
+    with f, _using_tier(target):
+        _init_cache()
+        token = _read_buffers_token(f)
+        f.seek(0)
+        buffer_paths = _list_buffer_paths(path, token)
+        target_path = _get_object_path(hash)
+        for i, buffer_path in enumerate(buffer_paths):  # never found without them
+            with open(buffer_path, 'rb') as buffer:
+                with _open_object_file(_get_buffer_path(target_path, i, token)) as out:
+                    shutil.copyfileobj(buffer, out)
+        size = os.fstat(f.fileno()).st_size
+        location = _place_object(hash, f, size, len(buffer_paths))
+    return {**fields, **(location or {})}
+
+
+def _place_object(
+    hash: str,
+    f: IO[bytes],
+    size: int,
+    n_buffers: int,
+) -> Optional[_EntryDict]:
+    """Store the object of `hash` as serialized (`size` bytes read from `f`), packed
+    or deduplicated if it qualifies.  Returns the fields locating it, as
+    :func:`_write_object_by_hash` does."""
+
+    pack_threshold = _get_config('pack_threshold')
+    if pack_threshold is not None and not n_buffers and size < pack_threshold:
+        segment, offset, length = _packs.append(_get_pack_dir(), f.read())
+        return {'segment': segment, 'offset': offset, 'length': length}
+    path = _get_object_path(hash)
+    digesting = None
+    with _replace_object_file(path) as out:
+        if _get_config('dedupe') and not n_buffers:
+            digesting = _DigestingWriter(out)
+        shutil.copyfileobj(f, digesting or out)
+    if digesting is not None:
+        return _share_content(path, digesting.hexdigest())
+    return None
+
+
+def _promote(hash: str) -> Optional[_EntryDict]:
+    """Fall through the tiers below the top one, copying the first entry of `hash`
+    found into every tier above it.  Returns its entry in the top tier."""
+
+    if _get_n_tiers() < 2 or _active_tier.get():
+        return None
+    now = datetime.datetime.utcnow().isoformat()
+    for tier in range(1, _get_n_tiers()):
+        with _using_tier(tier):
+            if not os.path.exists(_get_index_path()):
+                continue
+            entry = _lookup_entry(hash)
+            if entry is None:
+                continue
+            budget = _get_config('max_entries'), _get_config('max_bytes')
+            if budget != (None, None):  # only needed to evict by
+                _write_entries_to_index({}, {hash: [now, 1]})
+        entry = {k: v for k, v in entry.items() if k != 'hits'}
+        entry['last_accessed'] = now
+        try:
+            for upper in reversed(range(tier)):
+                entry = _copy_object(hash, entry, upper + 1, upper)
+                _add_to_tier(upper, {hash: entry})
+        except FileNotFoundError:  # removed by another process in the meantime
+            continue
+        logger.debug(f'cache hit (tier {tier})')
+        _stats.record(entry['callable'], promotions=1)
+        return entry
+    return None
+
+
+def _write_to_lower_tiers(entries: _IndexDict) -> None:
+    policy = _get_config('tier_write_policy', 'through')
+    if policy not in _TIER_WRITE_POLICIES:
+        raise ValueError(f'Unknown tier write policy: {policy!r}')
+    if policy == 'through':
+        _copy_to_lower_tiers(entries)
+        return
+    global _write_back_executor
+    with _write_back_lock:
+        if _write_back_executor is None:
+            _write_back_executor = concurrent.futures.ThreadPoolExecutor(
+                1, thread_name_prefix='derpcache-write-back'
+            )
+    context = contextvars.copy_context()
+    _write_back_executor.submit(context.run, _copy_to_lower_tiers, entries)
+
+
+def _copy_to_lower_tiers(entries: _IndexDict) -> None:
+    """Copy `entries` (and their objects) from the top tier into every other one.
+
+    Note: A store below failing leaves the entries cached above it, so it is logged
+        rather than raised.
+    """
+
+    for tier in range(1, _get_n_tiers()):
+        copies = {}
+        try:
+            for hash, entry in entries.items():
+                try:
+                    copies[hash] = _copy_object(hash, entry, 0, tier)
+                except FileNotFoundError:  # evicted from the top tier meanwhile
+                    continue
+            _add_to_tier(tier, copies)
+        except Exception:
+            logger.warning(f'writing to cache tier {tier} failed', exc_info=True)
+
+
+def _get_usage() -> Tuple[int, int]:
+    """Number of entries and the bytes taken up by their objects, counting payloads
+    shared by deduplicated entries once.
+
+    SQLite keeps these up to date itself.  Otherwise they are summed up once per
+    parsed index, then carried over from one index written to the next.
+    """
+
+    if _get_index_backend() == 'sqlite':
+        return _sqlite.usage(_get_index_path())
+    _, n_entries, n_bytes, _ = _get_known_usage()
+    return n_entries, n_bytes
+
+
+def _get_known_usage() -> Tuple[_IndexDict, int, int, Dict[str, int]]:
+    index = _read_index()
+    path = _get_index_path()
+    known = _usages.get(path)
+    if known is not None and known[0] is index:
+        return known
+    shares: Dict[str, int] = {}
+    n_bytes = sum(_count_bytes(entry, shares, 1) for entry in index.values())
+    known = _usages[path] = (index, len(index), n_bytes, shares)
+    return known
+
+
+def _count_bytes(entry: _EntryDict, shares: Dict[str, int], change: int) -> int:
+    """Bytes that adding (`change` 1) or removing (-1) `entry` adds to the usage,
+    given the number of entries sharing each payload (`shares`, updated).  A shared
+    payload only counts with its first entry, and until its last one is gone."""
+
+    size = entry.get('size', 0)
+    digest = entry.get('content')
+    if digest is None:
+        return change * size
+    n_shares = shares.get(digest, 0)
+    if n_shares + change:
+        shares[digest] = n_shares + change
+    else:
+        del shares[digest]
+    return change * size if n_shares in (0, -change) else 0
+
+
+def _carry_usage_over(
+    old: _IndexDict,
+    new: _IndexDict,
+    added: _IndexDict,
+    removed: Collection[str],
+) -> None:
+    """Derive the usage of index `new` from that of `old`, which it differs from by
+    the `added` (or replaced) entries and the `removed` hashes."""
+
+    path = _get_index_path()
+    known = _usages.get(path)
+    if known is None or known[0] is not old:
+        return
+    _, n_entries, n_bytes, shares = known
+    for hash, entry in added.items():
+        previous = old.get(hash)
+        if previous is None:
+            n_entries += 1
+        else:
+            n_bytes += _count_bytes(previous, shares, -1)
+        n_bytes += _count_bytes(entry, shares, 1)
+    for hash in removed:
+        previous = old.get(hash)
+        if previous is not None:
+            n_entries -= 1
+            n_bytes += _count_bytes(previous, shares, -1)
+    _usages[path] = (new, n_entries, n_bytes, shares)
+
+
+def _is_within_budget(
+    n_entries: int,
+    n_bytes: int,
+    max_entries: Optional[int],
+    max_bytes: Optional[int],
+) -> bool:
+    return (max_entries is None or n_entries <= max_entries) and (
+        max_bytes is None or n_bytes <= max_bytes
+    )
+
+
+def _get_last_accessed(entry: _EntryDict) -> str:
+    return entry.get('last_accessed', entry['called_at'])
+
+
+def _eviction_key(policy: str) -> Callable[[_EntryDict], Any]:
+    """Sort key putting the entries to be evicted first."""
+
+    if policy == 'lru':
+        return _get_last_accessed
+    if policy == 'lfu':
+        return lambda entry: (entry.get('hits', 0), _get_last_accessed(entry))
+    if policy == 'cost':
+        return lambda entry: (
+            entry.get('duration', 0)
+            * (entry.get('hits', 0) + 1)
+            / max(entry.get('size', 0), 1),
+            _get_last_accessed(entry),
+        )
+    raise ValueError(f'Unknown eviction policy: {policy!r}')
+
+
+def _evict_over_budget(keep: Collection[str] = ()) -> None:
+    """Evict entries (sparing `keep`) until within "max_entries" / "max_bytes"."""
+
+    max_entries = _get_config('max_entries')
+    max_bytes = _get_config('max_bytes')
+    if max_entries is None and max_bytes is None:
+        return
+    if _is_within_budget(*_get_usage(), max_entries, max_bytes):
+        return
+    policy = _get_config('eviction_policy', _DEFAULT_EVICTION_POLICY)
+    key = _eviction_key(policy)
+    if _get_index_backend() == 'sqlite':
+        _flush_accesses()
+        removed = _sqlite.evict(_get_index_path(), policy, max_entries, max_bytes, keep)
+        if removed:
+            logger.debug(f'evicting {len(removed)} entries')
+            _memory_tier.discard((_get_cache_dir(), hash) for hash in removed)
+            _record_removals('evictions', removed.values())
+            _remove_objects(removed)
+        return
+    with _index_lock():
+        _flush_accesses()
+        index, n_entries, n_bytes, shares = _get_known_usage()
+        shares = dict(shares)
+        candidates = [(key(entry), hash) for hash, entry in index.items()]
+        heapq.heapify(candidates)  # only the few evicted are ever sorted out
+        to_remove = []
+        while candidates and not _is_within_budget(
+            n_entries, n_bytes, max_entries, max_bytes
+        ):
+            _, hash = heapq.heappop(candidates)
+            if hash in keep:
+                continue
+            to_remove.append(hash)
+            n_entries -= 1
+            n_bytes += _count_bytes(index[hash], shares, -1)
+        if to_remove:
+            logger.debug(f'evicting {len(to_remove)} entries')
+            removed = {h: index[h] for h in to_remove}
+            _record_removals('evictions', removed.values())
+            _remove_entries(index, to_remove)
+            _remove_objects(removed)
+
+
+def get_index(clear_expired: bool = True, details: bool = False) -> _IndexDict:
+    """Retrieve `index.json` metadata dict about cache contents.
+
+    Note: When using `expires_after` expiration rules, expired cache contents will be
+        permanently removed upon calling this function (or checking the cache again),
+        unless `clear_expired` is set to `False`.
+
+    Args:
+        clear_expired (bool): Clear expired cache contents upon call.
+        details (bool): Also return what each entry cost and how it was used, as far
+            as recorded: "duration" (seconds computing it), "size" (bytes stored),
+            "hits" and "last_accessed".
+
+    Returns:
+        dict: The current state of the cache.
+    """
+
+    if details:
+        _flush_accesses()  # so hits are up to date
+    index = _load_index(clear_expired)
+    index = _sort_index(index, details)
+    return index
+
+
+def iter_index(
+    clear_expired: bool = True,
+    details: bool = False,
+    page_size: int = _DEFAULT_PAGE_SIZE,
+) -> Iterator[Tuple[str, _EntryDict]]:
+    """Iterate over the metadata of cache contents, as returned by :func:`get_index`,
+    one `(hash, entry)` pair at a time.
+
+    With the "sqlite" index backend, entries are read from disk a page at a time, so
+    even caches of millions of entries can be inspected without loading their index
+    into memory.  Other backends have their index parsed whole (as for any lookup).
+
+    Args:
+        clear_expired (bool): Clear expired cache contents first.
+        details (bool): As for :func:`get_index`.
+        page_size (int): Entries read from disk at a time.
+
+    Returns:
+        Iterator: Hashes and entries, in the order they were cached.
+    """
+
+    if details:
+        _flush_accesses()
+    if _get_index_backend() == 'sqlite':
+        if clear_expired:
+            _remove_expired_rows()
+        entries = _sqlite.iter_index(_get_index_path(), page_size)
+    else:
+        index = _load_index(clear_expired)
+        entries = iter(sorted(index.items(), key=lambda x: x[1]['called_at']))
+    for hash, entry in entries:
+        yield hash, _public_entry(entry, details)
+
+
+def get_cost_report(by: str = 'entry') -> List[dict]:
+    """Rank cache entries, or the callables they belong to, by the compute time their
+    hits saved per byte they take up.
+
+    Those at the bottom of the ranking are the first candidates for eviction (see the
+    "cost" eviction policy), or for not being cached at all.
+
+    Args:
+        by (str): "entry" (the default) or "callable".
+
+    Returns:
+        list: One dict per entry (keyed by "hash", with its "callable") or callable
+            (with its number of "entries"), giving the total "duration" of computing
+            them, their "size" in bytes, their "hits", the "time_saved" by those hits
+            and "time_saved_per_byte", best first.
+    """
+
+    if by not in _REPORT_GROUPINGS:
+        raise ValueError(f'Unknown report grouping: {by!r}')
+    rows: List[dict] = []
+    for hash, entry in iter_index(details=True):
+        row: dict = {'hash': hash} if by == 'entry' else {}
+        rows.append(
+            {
+                **row,
+                'callable': entry['callable'],
+                'duration': entry.get('duration', 0),
+                'size': entry.get('size', 0),
+                'hits': entry.get('hits', 0),
+                'time_saved': entry.get('duration', 0) * entry.get('hits', 0),
+            }
+        )
+    if by == 'callable':
+        by_callable: Dict[str, dict] = {}
+        for row in rows:
+            total = by_callable.setdefault(
+                row['callable'],
+                {
+                    'callable': row['callable'],
+                    'entries': 0,
+                    'duration': 0,
+                    'size': 0,
+                    'hits': 0,
+                    'time_saved': 0,
+                },
+            )
+            total['entries'] += 1
+            for k in ('duration', 'size', 'hits', 'time_saved'):
+                total[k] += row[k]
+        rows = list(by_callable.values())
+    for row in rows:
+        row['time_saved_per_byte'] = row['time_saved'] / max(row['size'], 1)
+    return sorted(rows, key=lambda row: row['time_saved_per_byte'], reverse=True)
+
+
+def _init_cache() -> None:
+    os.makedirs(_get_cache_dir(), exist_ok=True)
+    _check_key_scheme()
+    if _get_index_backend() == 'sqlite':
+        _sqlite.init(_get_index_path())
+    elif not os.path.exists(_get_index_path()):
+        with _index_lock():
+            if not os.path.exists(_get_index_path()):
+                _write_index({})
+
+
+def _check_key_scheme() -> None:
+    """Warn (once per process) if the cache directory's entries were keyed by another
+    hash engine or size than configured, as they would never be found, then record
+    the configured ones.
+
+    Note: Caches from before schemes were recorded are taken to be "legacy" ones if
+        their keys are as short.
+    """
+
+    engine = _get_config('hash_engine', _DEFAULT_HASH_ENGINE)
+    size = None if engine == 'legacy' else _get_config('hash_size', _DEFAULT_HASH_SIZE)
+    checked = (_get_cache_dir(), engine, size)
+    if checked in _checked_key_schemes:
+        return
+    scheme = {'hash_engine': engine, 'hash_size': size}
+    path = _get_cache_path(_CACHE_KEYS_FILE)
+    try:
+        with open(path) as f:
+            recorded = json.load(f)
+    except FileNotFoundError:
+        recorded = scheme
+        if os.path.exists(_get_index_path()):
+            first = next(iter_index(clear_expired=False), None)
+            legacy_width = len(first[0]) == _LEGACY_HASH_WIDTH if first else False
+            if legacy_width and size != _LEGACY_HASH_WIDTH // 2:
+                recorded = {'hash_engine': 'legacy', 'hash_size': None}
+    if recorded != scheme:
+        logger.warning(
+            f'entries in {_get_cache_dir()} were keyed with hash_engine '
+            f'{recorded["hash_engine"]!r} and hash_size {recorded["hash_size"]!r}, '
+            f'so are not found with {engine!r} and {size!r} configured'
+        )
+    if recorded != scheme or not os.path.exists(path):
+        with _locking.atomic_write(path, 'w') as f:
+            json.dump(scheme, f)
+    _checked_key_schemes.add(checked)
+
+
+def clear_cache() -> None:
+    """Removes cache directory and all files within it.  If configured cache directory
+    is a path, remove only the bottom-most empty directories within that path.  With
+    "tiers" configured, every tier's directory is removed.
+    """
+
+    def _remove_bottom_dir(path):
+        dirs = path.rstrip('/').split('/')
+        new_path = '/'.join(dirs[:-1])
+        return new_path
+
+    _take_accesses()
+    _memory_tier.clear()
+    _parsed_indexes.clear()
+    _next_expiries.clear()
+    _usages.clear()
+    _checked_key_schemes.clear()
+    _journal.forget()
+    _sqlite.forget()
+    _packs.forget()
+    for tier in range(_get_n_tiers()):
+        with _using_tier(tier):
+            cache_path = _get_cache_path()
+        shutil.rmtree(cache_path, ignore_errors=True)
+        cache_path = _remove_bottom_dir(cache_path)
+        while cache_path:
+            try:
+                os.rmdir(cache_path)
+                cache_path = _remove_bottom_dir(cache_path)
+            except OSError:
+                break
+
+
+def migrate_cache_layout(shard_depth: Optional[int] = None) -> int:
+    """Move the objects of the configured cache into another on-disk layout, e.g.
+    from a flat cache directory into one sharded by :func:`update_cache_config`'s
+    "shard_depth".
+
+    Args:
+
+        shard_depth (int, optional): Levels of subdirectories to shard objects into
+            (0 for a flat directory).  Defaults to the configured "shard_depth".
+
+    Returns:
+
+        int: The number of objects moved.
+    """
+
+    if shard_depth is None:
+        shard_depth = _get_shard_depth()
+    if not 0 <= shard_depth <= _MAX_SHARD_DEPTH:
+        raise ValueError(f'shard_depth must be between 0 and {_MAX_SHARD_DEPTH}')
+    if not os.path.exists(_get_index_path()):
+        return 0
+    n_moved = 0
+    with _index_lock():
+        for hash in list(_load_index(clear_expired=False)):
+            target = _get_object_path(hash, shard_depth)
+            for depth in range(_MAX_SHARD_DEPTH + 1):
+                source = _get_object_path(hash, depth)
+                if depth != shard_depth and os.path.exists(source):
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    _move_object_files(source, target)
+                    n_moved += 1
+                    break
+    _remove_empty_shards()
+    return n_moved
+
+
+def _move_object_files(source: str, target: str) -> None:
+    """Note: Buffers go first, so that an object found at `target` is complete."""
+
+    token = _get_buffers_token(source) or ''
+    for i, buffer_path in enumerate(_list_buffer_paths(source, token)):
+        os.replace(buffer_path, _get_buffer_path(target, i, token))
+    os.replace(source, target)
+
+
+def _remove_empty_shards() -> None:
+    cache_dir = _get_cache_dir()
+    for dirpath, _, _ in os.walk(cache_dir, topdown=False):
+        if os.path.normpath(dirpath) != os.path.normpath(cache_dir):
+            with contextlib.suppress(OSError):  # not empty
+                os.rmdir(dirpath)
+
+
+def export_cache(
+    path: str,
+    callables: Optional[Collection[Union[str, Callable]]] = None,
+    annotations: Optional[Collection[str]] = None,
+    max_age: Optional[Union[float, datetime.timedelta]] = None,
+    compression: Optional[str] = None,
+) -> int:
+    """Write (a selection of) the cache's unexpired entries and their objects to a
+    single tar archive, to be merged into another cache by :func:`import_cache`.
+
+    The archive is written as a stream: a manifest of the entries first, then their
+    objects, read from disk one at a time.
+
+    Args:
+
+        path (str): Where to write the archive.
+
+        callables (optional): Only export calls of these, given as callables or by
+            the names the index records them by.
+
+        annotations (optional): Only export entries annotated with one of these.
+
+        max_age (float, :obj:`datetime.timedelta`, optional): Only export entries
+            cached at most this long ago.  Numeric values are interpreted as seconds.
+
+        compression (str, optional): "gz", "bz2" or "xz" to compress the archive.
+
+    Returns:
+
+        int: The number of entries exported.
+    """
+
+    if compression not in _BUNDLE_COMPRESSIONS:
+        raise ValueError(f'Unknown compression: {compression!r}')
+    names = None
+    if callables is not None:
+        names = {c if isinstance(c, str) else _describe_callable(c) for c in callables}
+    oldest = None
+    if max_age is not None:
+        age = datetime.timedelta(seconds=_expires_after_to_float(max_age))
+        oldest = (datetime.datetime.utcnow() - age).isoformat()
+    _flush_accesses()
+    selected: Dict[str, dict] = {}
+    for hash, entry in _load_index().items():
+        if (
+            (names is None or entry['callable'] in names)
+            and (annotations is None or entry.get('annotation') in annotations)
+            and (oldest is None or entry['called_at'] >= oldest)
+        ):
+            selected[hash] = {
+                'entry': {k: v for k, v in entry.items() if k not in _LOCATION_FIELDS},
+                'buffers': 0 if 'segment' in entry else _count_buffers(hash),
+                'location': entry if 'segment' in entry else None,
+            }
+    manifest = {
+        'format': _BUNDLE_FORMAT,
+        'hash_engine': _get_config('hash_engine', _DEFAULT_HASH_ENGINE),
+        'hash_size': _get_config('hash_size', _DEFAULT_HASH_SIZE),
+        'entries': {
+            hash: {'entry': item['entry'], 'buffers': item['buffers']}
+            for hash, item in selected.items()
+        },
+    }
+    n_exported = 0
+    mode = f'w|{compression or ""}'
+    with tarfile.open(path, mode) as tar:  # type: ignore  # a valid mode
+        _add_bytes_to_bundle(tar, _BUNDLE_MANIFEST, json.dumps(manifest).encode())
+        for hash, item in selected.items():
+            try:
+                _add_object_to_bundle(tar, hash, item['buffers'], item['location'])
+            except FileNotFoundError:  # removed in the meantime; left out on import
+                continue
+            n_exported += 1
+    return n_exported
+
+
+def _count_buffers(hash: str) -> int:
+    path = _find_object_path(hash)
+    return len(_list_buffer_paths(path, _get_buffers_token(path) or ''))
+
+
+def _add_to_bundle(tar: tarfile.TarFile, name: str, f: IO[bytes], size: int) -> None:
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(time.time())
+    tar.addfile(info, f)
+
+
+def _add_bytes_to_bundle(tar: tarfile.TarFile, name: str, data: bytes) -> None:
+    _add_to_bundle(tar, name, io.BytesIO(data), len(data))
+
+
+def _add_file_to_bundle(tar: tarfile.TarFile, name: str, path: str) -> None:
+    with open(path, 'rb') as f:
+        _add_to_bundle(tar, name, f, os.fstat(f.fileno()).st_size)
+
+
+def _add_object_to_bundle(
+    tar: tarfile.TarFile,
+    hash: str,
+    n_buffers: int,
+    location: Optional[_EntryDict],
+) -> None:
+    """Note: Buffers go first, so that an imported object is complete once found."""
+
+    name = f'{_BUNDLE_OBJECT_DIR}/{hash}'
+    if location is not None:
+        data = _packs.read(
+            _get_pack_dir(), location['segment'], location['offset'], location['length']
+        )
+        _add_bytes_to_bundle(tar, name, data)
+        return
+    path = _find_object_path(hash)
+    with open(path, 'rb') as f:  # kept open, so its buffers are those of this version
+        token = _read_buffers_token(f)
+        f.seek(0)
+        buffer_paths = _list_buffer_paths(path, token)
+        if len(buffer_paths) != n_buffers:
+            raise FileNotFoundError(path)  # rewritten in the meantime
+        for i, buffer_path in enumerate(buffer_paths):
+            _add_file_to_bundle(tar, _get_buffer_path(name, i, token), buffer_path)
+        _add_to_bundle(tar, name, f, os.fstat(f.fileno()).st_size)
+
+
+def import_cache(path: str, overwrite: bool = False) -> int:
+    """Merge the entries of an archive written by :func:`export_cache` into the
+    configured cache, e.g. to warm it up from a shared one.
+
+    Objects are streamed from the archive straight into place, and the entries added
+    to the index in a single write once all of their objects have arrived.  Entries
+    that have expired since being exported are skipped.
+
+    Args:
+
+        path (str): The archive to import.
+
+        overwrite (bool): Replace entries the cache already holds, rather than keep
+            them.
+
+    Returns:
+
+        int: The number of entries imported.
+    """
+
+    _init_cache()
+    with tarfile.open(path, 'r|*') as tar:
+        member = tar.next()
+        if member is None or member.name != _BUNDLE_MANIFEST:
+            raise ValueError(f'{path} is not a cache bundle')
+        manifest = json.load(tar.extractfile(member))  # type: ignore  # a file
+        for key, default in (
+            ('hash_engine', _DEFAULT_HASH_ENGINE),
+            ('hash_size', _DEFAULT_HASH_SIZE),
+        ):
+            if manifest[key] != _get_config(key, default):
+                raise ValueError(
+                    f'{path} was exported with {key} {manifest[key]!r}, so its keys '
+                    f'would never match'
+                )
+        wanted = {}
+        for hash, item in manifest['entries'].items():
+            if not _HASH_PATTERN.fullmatch(hash):
+                raise ValueError(f'{path} holds an invalid hash: {hash!r}')
+            if _is_expired(item['entry']):
+                continue
+            if overwrite or _peek_entry(hash) is None:
+                wanted[hash] = item
+        received: Dict[str, int] = collections.Counter()
+        locations: Dict[str, _EntryDict] = {}
+        for member in tar:
+            dirname, _, name = member.name.partition('/')
+            hash, _, buffer = name.partition('.')
+            if dirname != _BUNDLE_OBJECT_DIR or hash not in wanted:
+                continue
+            f = tar.extractfile(member)
+            assert f is not None
+            if buffer:
+                *token, i, _ = buffer.split('.')  # named as by `_get_buffer_path`
+                with _open_object_file(
+                    _get_buffer_path(_get_object_path(hash), int(i), ''.join(token))
+                ) as out:
+                    shutil.copyfileobj(f, out)
+            else:
+                location = _place_object(hash, f, member.size, wanted[hash]['buffers'])
+                if location is not None:
+                    locations[hash] = location
+            received[hash] += 1
+    entries = {
+        hash: {**item['entry'], **locations.get(hash, {})}
+        for hash, item in wanted.items()
+        if received[hash] == item['buffers'] + 1
+    }
+    if entries:
+        _memory_tier.discard((_get_cache_dir(), hash) for hash in entries)
+        _add_entries(entries)
+    return len(entries)
+
+
+def _describe_callable(f: Callable) -> str:
+    """Note: Some callables are missing a :attr:`__qualname__`, so including `type()`
+    provides at least some information."""
+
+    mod = f.__module__
+    name = getattr(f, '__qualname__', str(type(f)))
+    return f'{mod}.{name}'
+
+
+def _expires_after_to_float(expires_after: Union[float, datetime.timedelta]) -> float:
+    if isinstance(expires_after, datetime.timedelta):
+        expires_after = expires_after.total_seconds()
+    return expires_after
+
+
+def _format_entry(
+    f: Callable,
+    called_at: str,
+    expires_after: Optional[Union[float, datetime.timedelta]],
+    annotation: Optional[str],
+    key_check: Optional[str] = None,
+    serializer: str = _serializers.DEFAULT,
+    size: Optional[int] = None,
+    duration: Optional[float] = None,
+    instance: Optional[str] = None,
+    location: Optional[_EntryDict] = None,
+    stale_ttl: Optional[Union[float, datetime.timedelta]] = None,
+) -> _EntryDict:
+    entry: _EntryDict = {
+        'callable': _describe_callable(f),
+        'called_at': called_at,
+    }
+    if expires_after:
+        entry['expires_after'] = _expires_after_to_float(expires_after)
+        if stale_ttl:
+            entry['stale_ttl'] = _expires_after_to_float(stale_ttl)
+    if annotation:
+        entry['annotation'] = annotation
+    if key_check:
+        entry['key_check'] = key_check
+    if serializer != _serializers.DEFAULT:
+        entry['serializer'] = serializer
+    if size is not None:
+        entry['size'] = size
+    if duration is not None:
+        entry['duration'] = duration
+    if instance is not None:
+        entry['instance'] = instance
+    if location is not None:
+        entry.update(location)
+    return entry
+
+
+def cache(
+    f: Callable,
+    *args,
+    _expires_after: Optional[Union[float, datetime.timedelta]] = None,
+    _annotation: Optional[str] = None,
+    _serializer: Optional[str] = None,
+    _stale_ttl: Optional[Union[float, datetime.timedelta]] = None,
+    _refresh_ahead: Optional[Union[float, datetime.timedelta]] = None,
+    **kwargs,
+) -> Any:
+    """
+    Calls a function and caches the results.
+
+    Args:
+
+        f (Callable):
+
+            Function whose results are to be cached.
+
+        *args (optional):
+
+            The function call's arguments.
+
+        **kwargs (optional):
+
+            The function call's keyword arguments.
+
+        _expires_after (float, :obj:`datetime.timedelta`, optional):
+
+            Time elapsed after which the cache entry will be cleared.  Numeric values
+                are interpreted as seconds.
+
+        _annotation (:obj:`str`, optional):
+
+            Arbitrary string that can be passed to help identify or describe the call.
+
+        _serializer (:obj:`str`, optional):
+
+            How the return value is stored: "pickle" (the default), "pickle-highest",
+                "gzip", "bz2" or "lzma" (compressed pickles), "json", "bytes" (raw
+                bytes-like values), "stream" (see below), or any name given to
+                :func:`register_serializer`.  The choice is recorded in the index, so
+                hits decode accordingly.
+
+                Return values that are generators are always streamed: their items
+                are pickled to disk in chunks as they are produced, and both the
+                call and later hits return an iterator reading them back lazily.
+                Streams that fail midway are never cached.  Other iterables (e.g.
+                large lists) can be streamed with "stream" too.
+
+        _stale_ttl (float, :obj:`datetime.timedelta`, optional):
+
+            With `_expires_after`, how long an expired entry is kept around: hits
+                within that window return the stale value right away, while the call
+                is recomputed in a background thread and swapped in.
+
+        _refresh_ahead (float, :obj:`datetime.timedelta`, optional):
+
+            With `_expires_after`, hits this close to expiry already recompute the
+                call in the background, so callers never wait on an expired entry.
+
+    Returns:
+
+        value (any):
+
+            The return value of the original function call.
+
+    Note: When the memory tier is enabled (see :func:`update_cache_config`), hits
+        may be served from memory and return the very object cached by this process.
+    """
+
+    name = _describe_callable(f)  # lazy, but keeps :meth:`_hash_args` dumb
+    key = _key_call(name, *args, **kwargs)
+    return _cache_call(
+        f,
+        args,
+        kwargs,
+        key,
+        _expires_after,
+        _annotation,
+        _serializer,
+        _stale_ttl,
+        _refresh_ahead,
+        name=name,
+    )
+
+
+def _cache_call(
+    f: Callable,
+    args: tuple,
+    kwargs: dict,
+    key: _Key,
+    expires_after: Optional[Union[float, datetime.timedelta]],
+    annotation: Optional[str],
+    serializer: Optional[str],
+    stale_ttl: Optional[Union[float, datetime.timedelta]] = None,
+    refresh_ahead: Optional[Union[float, datetime.timedelta]] = None,
+    instance: Optional[str] = None,
+    name: Optional[str] = None,
+) -> Any:
+    """:func:`cache`, given the call's key (and the identity of the instance a
+    method was called on, recorded to invalidate its entries by, and the callable's
+    description, if already at hand)."""
+
+    hash, check = key
+    name = name or _describe_callable(f)
+    value, fresh_until = _get_from_memory(hash, check)
+    refresh_due = _is_refresh_due(fresh_until, refresh_ahead)
+    if value is not _memory.MISSING and not refresh_due:
+        logger.debug('cache hit (memory)')
+        _stats.record(name, hits=1, memory_hits=1)
+        _record_access(hash)
+        return value
+    serializer = serializer or _get_config('serializer', _serializers.DEFAULT)
+    compute = functools.partial(
+        _compute_entry,
+        f,
+        args,
+        kwargs,
+        hash,
+        check,
+        expires_after,
+        annotation,
+        serializer,
+        stale_ttl,
+        instance,
+    )
+    if value is not _memory.MISSING:
+        logger.debug('cache hit (memory)')
+        _stats.record(name, hits=1, memory_hits=1)
+        _record_access(hash)
+        _schedule_refresh(hash, check, refresh_ahead, compute)
+        return value
+    _serializers.get(serializer)  # fail before calling `f` if it doesn't exist
+    _init_cache()
+    value, entry, nbytes = _read_entry(hash, name)
+    computed = False
+    if entry is None:
+        with _single_flight(hash):
+            # whoever held the lease before us may have just cached it
+            value, entry, nbytes = _read_entry(hash, name)
+            if entry is None:
+                logger.debug('caching...')
+                value, entry, nbytes = compute()
+                computed = True
+                logger.debug('caching successful.')
+                if entry.get('serializer') == _serializers.STREAM:
+                    value = _read_object(hash, entry)  # `f`'s own was written out
+    if _is_collision(entry, check):
+        logger.warning(f'cache key {hash} collides with another call; not caching')
+        _stats.record(name, misses=1)
+        return f(*args, **kwargs)
+    if computed:
+        _stats.record(name, misses=1)
+    else:
+        _stats.record(name, hits=1)
+        _record_access(hash)
+        if _is_refresh_due(_get_fresh_until(entry), refresh_ahead):
+            _schedule_refresh(hash, check, refresh_ahead, compute)
+    _put_in_memory(hash, value, entry, nbytes, check)
+    return value
+
+
+def _compute_entry(
+    f: Callable,
+    args: tuple,
+    kwargs: dict,
+    hash: str,
+    check: Optional[str],
+    expires_after: Optional[Union[float, datetime.timedelta]],
+    annotation: Optional[str],
+    serializer: str,
+    stale_ttl: Optional[Union[float, datetime.timedelta]],
+    instance: Optional[str],
+) -> Tuple[Any, _EntryDict, int]:
+    """Call `f` and store its result, replacing any previous entry.  Returns the
+    value (used up, if it was streamed), its entry and its size."""
+
+    called_at = datetime.datetime.utcnow().isoformat()
+    started = time.perf_counter()
+    value = f(*args, **kwargs)
+    duration = time.perf_counter() - started
+    serializer = _get_serializer_for(value, serializer)
+    nbytes, location = _write_object_by_hash(hash, value, serializer)
+    if serializer == _serializers.STREAM:  # produced as it was written
+        duration = time.perf_counter() - started
+    entry = _format_entry(
+        f,
+        called_at,
+        expires_after,
+        annotation,
+        key_check=check,
+        serializer=serializer,
+        size=nbytes,
+        duration=duration,
+        instance=instance,
+        location=location,
+        stale_ttl=stale_ttl,
+    )
+    _add_entries({hash: entry})
+    _stats.record(entry['callable'], compute_seconds=duration, bytes_written=nbytes)
+    return value, entry, nbytes
+
+
+def _is_refresh_due(
+    fresh_until: Optional[datetime.datetime],
+    refresh_ahead: Optional[Union[float, datetime.timedelta]],
+) -> bool:
+    """Whether a value fresh until `fresh_until` is stale, or about to be."""
+
+    if fresh_until is None:
+        return False
+    if refresh_ahead:
+        ahead = datetime.timedelta(seconds=_expires_after_to_float(refresh_ahead))
+        fresh_until -= ahead
+    return fresh_until <= datetime.datetime.utcnow()
+
+
+def _start_refresh(hash: str) -> Optional[Tuple[str, str]]:
+    """Claim the refresh of entry `hash`, returning the claim (to be released by
+    :func:`_end_refresh`), or `None` if it is already being refreshed."""
+
+    refresh_key = (_get_cache_dir(), hash)
+    with _refreshing_lock:
+        if refresh_key in _refreshing:
+            return None
+        _refreshing.add(refresh_key)
+    return refresh_key
+
+
+def _end_refresh(refresh_key: Tuple[str, str]) -> None:
+    with _refreshing_lock:
+        _refreshing.discard(refresh_key)
+
+
+def _schedule_refresh(
+    hash: str,
+    check: Optional[str],
+    refresh_ahead: Optional[Union[float, datetime.timedelta]],
+    compute: Callable[[], Tuple[Any, _EntryDict, int]],
+) -> None:
+    """Recompute entry `hash` on a background thread, unless already underway."""
+
+    global _refresh_executor
+    refresh_key = _start_refresh(hash)
+    if refresh_key is None:
+        return
+    with _refreshing_lock:
+        if _refresh_executor is None:
+            _refresh_executor = concurrent.futures.ThreadPoolExecutor(
+                thread_name_prefix='derpcache-refresh'
+            )
+    context = contextvars.copy_context()
+    _refresh_executor.submit(
+        context.run, _refresh, refresh_key, check, refresh_ahead, compute
+    )
+
+
+def _refresh(
+    refresh_key: Tuple[str, str],
+    check: Optional[str],
+    refresh_ahead: Optional[Union[float, datetime.timedelta]],
+    compute: Callable[[], Tuple[Any, _EntryDict, int]],
+) -> None:
+    """Note: The stale entry keeps being served until the new one replaces it in a
+    single index write, so readers never see it missing."""
+
+    hash = refresh_key[1]
+    try:
+        with _single_flight(hash):
+            entry = _peek_entry(hash)
+            if not _needs_refresh(entry, check, refresh_ahead):
+                return
+            logger.debug('refreshing...')
+            value, entry, nbytes = compute()
+            _put_in_memory(hash, value, entry, nbytes, check)
+            _stats.record(entry['callable'], refreshes=1)
+            logger.debug('refreshing successful.')
+    except Exception:
+        logger.warning(f'refreshing cache entry {hash} failed', exc_info=True)
+    finally:
+        _end_refresh(refresh_key)
+
+
+def _needs_refresh(
+    entry: Optional[_EntryDict],
+    check: Optional[str],
+    refresh_ahead: Optional[Union[float, datetime.timedelta]],
+) -> bool:
+    """Whether a refresh still applies to `entry`: it may have been removed, or
+    refreshed by another process, since the refresh was scheduled."""
+
+    return (
+        entry is not None
+        and not _is_collision(entry, check)
+        and _is_refresh_due(_get_fresh_until(entry), refresh_ahead)
+    )
+
+
+async def _run_in_executor(f: Callable, *args) -> Any:
+    """Run blocking cache I/O on the default executor, keeping the event loop free."""
+
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(None, functools.partial(context.run, f, *args))
+
+
+async def _enter_in_executor(stack: contextlib.ExitStack, cm: ContextManager) -> None:
+    """Enter a blocking context manager on the executor, onto `stack`.
+
+    If cancelled meanwhile, still wait for it to be entered, so `stack` exits it.
+    """
+
+    entering = asyncio.ensure_future(_run_in_executor(stack.enter_context, cm))
+    try:
+        await asyncio.shield(entering)
+    except asyncio.CancelledError:
+        await entering
+        raise
+
+
+@contextlib.asynccontextmanager
+async def _in_executor(cm: ContextManager) -> AsyncIterator[None]:
+    """Enter and exit a blocking context manager on the executor, keeping the event
+    loop free of both (e.g. acquiring and releasing a lease).
+
+    If cancelled while exiting, still wait for it to be exited.
+    """
+
+    with contextlib.ExitStack() as stack:
+        await _enter_in_executor(stack, cm)
+        try:
+            yield
+        finally:
+            exiting = asyncio.ensure_future(_run_in_executor(stack.pop_all().close))
+            try:
+                await asyncio.shield(exiting)
+            except asyncio.CancelledError:
+                await exiting
+                raise
+
+
+def _init_and_read_entry(hash: str, name: str) -> Tuple[Any, Optional[_EntryDict], int]:
+    _init_cache()
+    return _read_entry(hash, name)
+
+
+async def cache_async(
+    f: Callable[..., Awaitable],
+    *args,
+    _expires_after: Optional[Union[float, datetime.timedelta]] = None,
+    _annotation: Optional[str] = None,
+    _serializer: Optional[str] = None,
+    _stale_ttl: Optional[Union[float, datetime.timedelta]] = None,
+    _refresh_ahead: Optional[Union[float, datetime.timedelta]] = None,
+    **kwargs,
+) -> Any:
+    """
+    Awaits a coroutine function and caches the results.
+
+    Takes the same arguments as :func:`cache`.  Index and object I/O run on the
+    event loop's default executor, and concurrent calls awaiting the same (missing)
+    entry share a single call of `f`.  Background refreshes (see `_stale_ttl` and
+    `_refresh_ahead`) run as tasks on the same event loop.
+
+    Returns:
+
+        value (any):
+
+            The result of awaiting the original function call.
+    """
+
+    name = _describe_callable(f)
+    key = _key_call(name, *args, **kwargs)
+    return await _cache_async(
+        f,
+        args,
+        kwargs,
+        key,
+        _expires_after,
+        _annotation,
+        _serializer,
+        _stale_ttl,
+        _refresh_ahead,
+        name=name,
+    )
+
+
+async def _cache_async(
+    f: Callable[..., Awaitable],
+    args: tuple,
+    kwargs: dict,
+    key: _Key,
+    expires_after: Optional[Union[float, datetime.timedelta]],
+    annotation: Optional[str],
+    serializer: Optional[str],
+    stale_ttl: Optional[Union[float, datetime.timedelta]] = None,
+    refresh_ahead: Optional[Union[float, datetime.timedelta]] = None,
+    instance: Optional[str] = None,
+    name: Optional[str] = None,
+) -> Any:
+    """:func:`cache_async`, given the call's key (see :func:`_cache_call`)."""
+
+    hash, check = key
+    name = name or _describe_callable(f)
+    value, fresh_until = _get_from_memory(hash, check)
+    refresh_due = _is_refresh_due(fresh_until, refresh_ahead)
+    if value is not _memory.MISSING and not refresh_due:
+        logger.debug('cache hit (memory)')
+        _stats.record(name, hits=1, memory_hits=1)
+        _record_access_async(hash)
+        return value
+    serializer = serializer or _get_config('serializer', _serializers.DEFAULT)
+    compute = functools.partial(
+        _compute_entry_async,
+        f,
+        args,
+        kwargs,
+        hash,
+        check,
+        expires_after,
+        annotation,
+        serializer,
+        stale_ttl,
+        instance,
+    )
+    if value is not _memory.MISSING:
+        logger.debug('cache hit (memory)')
+        _stats.record(name, hits=1, memory_hits=1)
+        _record_access_async(hash)
+        _schedule_refresh_async(hash, check, refresh_ahead, compute)
+        return value
+    _serializers.get(serializer)
+
+    in_flight = _in_flight.setdefault(asyncio.get_running_loop(), {})
+    in_flight_key = (_get_cache_dir(), hash)
+    while in_flight_key in in_flight:
+        future = in_flight[in_flight_key]
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if not future.cancelled():
+                raise  # we were cancelled, rather than the call we waited on
+    future = in_flight[in_flight_key] = asyncio.get_running_loop().create_future()
+    try:
+        value = await _cache_async_call(
+            f, args, kwargs, hash, check, refresh_ahead, compute, name
+        )
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except BaseException as e:
+        future.set_exception(e)
+        future.exception()  # retrieved, even if nobody else was waiting
+        raise
+    else:
+        future.set_result(value)
+    finally:
+        del in_flight[in_flight_key]
+    return value
+
+
+async def _cache_async_call(
+    f: Callable[..., Awaitable],
+    args: tuple,
+    kwargs: dict,
+    hash: str,
+    check: Optional[str],
+    refresh_ahead: Optional[Union[float, datetime.timedelta]],
+    compute: Callable[[], Awaitable[Tuple[Any, _EntryDict, int]]],
+    name: str,
+) -> Any:
+    value, entry, nbytes = await _run_in_executor(_init_and_read_entry, hash, name)
+    computed = False
+    if entry is None:
+        async with _in_executor(_single_flight(hash)):
+            value, entry, nbytes = await _run_in_executor(_read_entry, hash, name)
+            if entry is None:
+                logger.debug('caching...')
+                value, entry, nbytes = await compute()
+                computed = True
+                logger.debug('caching successful.')
+                if entry.get('serializer') == _serializers.STREAM:
+                    value = await _run_in_executor(_read_object, hash, entry)
+    if _is_collision(entry, check):
+        logger.warning(f'cache key {hash} collides with another call; not caching')
+        _stats.record(name, misses=1)
+        return await f(*args, **kwargs)
+    if computed:
+        _stats.record(name, misses=1)
+    else:
+        _stats.record(name, hits=1)
+        _record_access_async(hash)
+        if _is_refresh_due(_get_fresh_until(entry), refresh_ahead):
+            _schedule_refresh_async(hash, check, refresh_ahead, compute)
+    _put_in_memory(hash, value, entry, nbytes, check)
+    return value
+
+
+async def _compute_entry_async(
+    f: Callable[..., Awaitable],
+    args: tuple,
+    kwargs: dict,
+    hash: str,
+    check: Optional[str],
+    expires_after: Optional[Union[float, datetime.timedelta]],
+    annotation: Optional[str],
+    serializer: str,
+    stale_ttl: Optional[Union[float, datetime.timedelta]],
+    instance: Optional[str],
+) -> Tuple[Any, _EntryDict, int]:
+    """:func:`_compute_entry`, awaiting `f` and storing its result on the executor."""
+
+    called_at = datetime.datetime.utcnow().isoformat()
+    started = time.perf_counter()
+    value = await f(*args, **kwargs)
+    duration = time.perf_counter() - started
+    serializer = _get_serializer_for(value, serializer)
+    nbytes, location = await _run_in_executor(
+        _write_object_by_hash, hash, value, serializer
+    )
+    if serializer == _serializers.STREAM:  # produced as it was written
+        duration = time.perf_counter() - started
+    entry = _format_entry(
+        f,
+        called_at,
+        expires_after,
+        annotation,
+        key_check=check,
+        serializer=serializer,
+        size=nbytes,
+        duration=duration,
+        instance=instance,
+        location=location,
+        stale_ttl=stale_ttl,
+    )
+    await _run_in_executor(_add_entries, {hash: entry})
+    _stats.record(entry['callable'], compute_seconds=duration, bytes_written=nbytes)
+    return value, entry, nbytes
+
+
+def _schedule_refresh_async(
+    hash: str,
+    check: Optional[str],
+    refresh_ahead: Optional[Union[float, datetime.timedelta]],
+    compute: Callable[[], Awaitable[Tuple[Any, _EntryDict, int]]],
+) -> None:
+    """:func:`_schedule_refresh`, as a task on the running event loop."""
+
+    refresh_key = _start_refresh(hash)
+    if refresh_key is None:
+        return
+    task = asyncio.ensure_future(
+        _refresh_async(refresh_key, check, refresh_ahead, compute)
+    )
+    _refresh_tasks.add(task)
+    task.add_done_callback(_refresh_tasks.discard)
+
+
+async def _refresh_async(
+    refresh_key: Tuple[str, str],
+    check: Optional[str],
+    refresh_ahead: Optional[Union[float, datetime.timedelta]],
+    compute: Callable[[], Awaitable[Tuple[Any, _EntryDict, int]]],
+) -> None:
+    hash = refresh_key[1]
+    try:
+        async with _in_executor(_single_flight(hash)):
+            entry = await _run_in_executor(_peek_entry, hash)
+            if not _needs_refresh(entry, check, refresh_ahead):
+                return
+            logger.debug('refreshing...')
+            value, entry, nbytes = await compute()
+            _put_in_memory(hash, value, entry, nbytes, check)
+            _stats.record(entry['callable'], refreshes=1)
+            logger.debug('refreshing successful.')
+    except Exception:
+        logger.warning(f'refreshing cache entry {hash} failed', exc_info=True)
+    finally:
+        _end_refresh(refresh_key)
+
+
+def _timed_call(f: Callable, args: tuple) -> Tuple[Any, str, float]:
+    """Call `f`, also returning when it was called and how long it took."""
+
+    called_at = datetime.datetime.utcnow().isoformat()
+    started = time.perf_counter()
+    value = f(*args)
+    return value, called_at, time.perf_counter() - started
+
+
+def cache_map(
+    f: Callable,
+    *iterables,
+    _expires_after: Optional[Union[float, datetime.timedelta]] = None,
+    _annotation: Optional[str] = None,
+    _serializer: Optional[str] = None,
+    _executor: Union[str, concurrent.futures.Executor] = 'thread',
+    _max_workers: Optional[int] = None,
+) -> Iterator[Any]:
+    """
+    Like `map(f, *iterables)`, caching every call.
+
+    All keys are hashed and checked against a single read of the index up front,
+    misses are submitted to a pool once iteration starts, and their entries are
+    added to the index in a single write once the results have been consumed (or
+    the iterator is closed).  Results are yielded in order, as they become available.
+
+    Args:
+
+        f (Callable):
+
+            Function whose results are to be cached.
+
+        *iterables:
+
+            Iterables of positional arguments, as for :func:`map`.
+
+        _expires_after, _annotation, _serializer (optional):
+
+            As for :func:`cache`.
+
+        _executor (:obj:`str`, :obj:`concurrent.futures.Executor`, optional):
+
+            Where misses are computed: "thread" (the default) or "process" for a
+            pool created for the call, or an existing executor.
+
+        _max_workers (:obj:`int`, optional):
+
+            Size of the pool created for the call.
+
+    Returns:
+
+        Iterator: The return values of the function calls.
+
+    Note: Unlike with :func:`cache`, concurrent batches in other threads or
+        processes may compute the same missing entries.
+    """
+
+    if not isinstance(_executor, concurrent.futures.Executor):
+        if _executor not in _EXECUTORS:
+            raise ValueError(f'Unknown executor: {_executor!r}')
+    serializer = _serializer or _get_config('serializer', _serializers.DEFAULT)
+    _serializers.get(serializer)
+    calls = list(zip(*iterables))
+    name = _describe_callable(f)
+    keys = [_key_call(name, *args) for args in calls]
+    _init_cache()
+    started = time.perf_counter()
+    index = _load_index()
+    _stats.record(name, index_seconds=time.perf_counter() - started)
+
+    to_compute: Dict[str, tuple] = {}
+    promoted: _IndexDict = {}
+    for (hash, _), args in zip(keys, calls):
+        if hash not in index and hash not in to_compute and hash not in promoted:
+            entry = _promote(hash)
+            if entry is None:
+                to_compute[hash] = args
+            else:
+                promoted[hash] = entry
+    if promoted:
+        index = {**index, **promoted}  # a copy, as the parsed index is shared
+    futures: Dict[str, concurrent.futures.Future] = {}
+    new_entries: _IndexDict = {}
+
+    def _store(hash: str, check: Optional[str], result: Tuple) -> Any:
+        value, called_at, duration = result
+        value_serializer = _get_serializer_for(value, serializer)
+        nbytes, location = _write_object_by_hash(hash, value, value_serializer)
+        new_entries[hash] = entry = _format_entry(
+            f,
+            called_at,
+            _expires_after,
+            _annotation,
+            key_check=check,
+            serializer=value_serializer,
+            size=nbytes,
+            duration=duration,
+            location=location,
+        )
+        _put_in_memory(hash, value, entry, nbytes, check)
+        _stats.record(name, misses=1, compute_seconds=duration, bytes_written=nbytes)
+        if value_serializer == _serializers.STREAM:
+            value = _read_object(hash, entry)
+        return value
+
+    def _results() -> Iterator[Any]:
+        # calls yet to be yielded per key, to keep values of repeated calls around
+        remaining = collections.Counter(hash for hash, _ in keys)
+        values: Dict[str, Any] = {}
+        executor = None
+        try:
+            if to_compute:
+                if isinstance(_executor, concurrent.futures.Executor):
+                    executor = _executor
+                elif _executor == 'process':
+                    executor = concurrent.futures.ProcessPoolExecutor(_max_workers)
+                else:
+                    executor = concurrent.futures.ThreadPoolExecutor(_max_workers)
+                for hash, args in to_compute.items():
+                    futures[hash] = executor.submit(_timed_call, f, args)
+            for (hash, check), args in zip(keys, calls):
+                remaining[hash] -= 1
+                value = values.get(hash, _memory.MISSING)
+                if isinstance(value, types.GeneratorType):  # a stream, iterated once
+                    value = _read_object(hash, new_entries.get(hash) or index[hash])
+                if value is _memory.MISSING:
+                    value, _ = _get_from_memory(hash, check)
+                    if value is not _memory.MISSING:
+                        _stats.record(name, hits=1, memory_hits=1)
+                        _record_access(hash)
+                if value is _memory.MISSING and hash not in futures:
+                    entry = index[hash]
+                    if _is_collision(entry, check):
+                        logger.warning(
+                            f'cache key {hash} collides with another call; not caching'
+                        )
+                        _stats.record(name, misses=1)
+                        value = f(*args)
+                    else:
+                        try:
+                            value, nbytes = _read_stored(hash, entry)
+                        except FileNotFoundError:  # removed in the meantime
+                            value = _store(hash, check, _timed_call(f, args))
+                        else:
+                            _stats.record(name, hits=1)
+                            _record_access(hash)
+                            _put_in_memory(hash, value, entry, nbytes, check)
+                if value is _memory.MISSING:
+                    value = _store(hash, check, futures.pop(hash).result())
+                if remaining[hash]:
+                    values[hash] = value
+                else:
+                    values.pop(hash, None)
+                yield value
+        finally:
+            for future in futures.values():
+                future.cancel()
+            if executor is not None and executor is not _executor:
+                executor.shutdown(wait=False)
+            if new_entries:
+                _add_entries(new_entries)
+
+    return _results()
+
+
+def _make_key_function(
+    f: Callable,
+    key_args: Dict[str, Callable[[Any], Any]],
+    exclude: Collection[str],
+    method: bool = False,
+) -> Callable[..., _Key]:
+    """Key calls to `f` by its bound arguments (defaults included), so that e.g.
+    `f(1, b=2)` and `f(1, 2)` share a key.
+
+    Arguments are keyed by position in the signature.  Signatures without
+    positional-only or variadic parameters are bound by a fast path;
+    :meth:`inspect.Signature.bind` handles the rest (and raises for invalid calls).
+    For a `method`, calls are passed (and bound) without their first argument, and
+    keyed by the given `prefix` (the instance's identity) instead.
+    """
+
+    name = _describe_callable(f)
+    try:
+        signature = inspect.signature(f)
+    except (TypeError, ValueError):  # e.g. some builtins
+        if key_args or exclude:
+            raise ValueError(f'Cannot bind the arguments of {name}') from None
+        return lambda args, kwargs, prefix=(): _key_call(name, *prefix, *args, **kwargs)
+    params = list(signature.parameters.values())
+    if method:
+        if not params:
+            raise TypeError(f'{name} cannot be bound to an instance')
+        params = params[1:]
+        signature = signature.replace(parameters=params)
+    names = [p.name for p in params]
+    unknown = (set(key_args) | set(exclude)) - set(names)
+    if unknown:
+        raise ValueError(f'{name} has no arguments named {sorted(unknown)}')
+    both = set(key_args) & set(exclude)
+    if both:
+        raise ValueError(
+            f'{name} has arguments both keyed and excluded: {sorted(both)}'
+        )
+    kept = [n for n in names if n not in exclude]
+    key_arg_positions = [(kept.index(n), key_arg) for n, key_arg in key_args.items()]
+    simple = all(p.kind in (p.POSITIONAL_OR_KEYWORD, p.KEYWORD_ONLY) for p in params)
+    positional = [p.name for p in params if p.kind is p.POSITIONAL_OR_KEYWORD]
+    defaults = {p.name: p.default for p in params if p.default is not p.empty}
+    bind = signature.bind
+    all_names = set(names)
+
+    def key(args: tuple, kwargs: dict, prefix: tuple = ()) -> _Key:
+        arguments = None
+        if simple and len(args) <= len(positional):
+            given = dict(zip(positional, args))
+            if given.keys().isdisjoint(kwargs):
+                arguments = {**defaults, **given, **kwargs}
+                if arguments.keys() != all_names:
+                    arguments = None
+        if arguments is None:
+            bound = bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = bound.arguments
+        values = [arguments[n] for n in kept]
+        for i, key_arg in key_arg_positions:
+            values[i] = key_arg(values[i])
+        return _key_call(name, *prefix, *values)
+
+    return key
+
+
+def _remove_matching(predicate: Callable[[_EntryDict], bool]) -> List[str]:
+    """Remove the entries (and objects) matching `predicate` from every tier, lest
+    they be promoted back, returning their hashes."""
+
+    removed: Dict[str, None] = {}
+    for tier in range(_get_n_tiers()):
+        with _using_tier(tier):
+            if not os.path.exists(_get_index_path()):
+                continue
+            with _index_lock():
+                index = _read_index()
+                to_remove = [h for h, entry in list(index.items()) if predicate(entry)]
+                if to_remove:
+                    _remove_entries(index, to_remove)
+                    _remove_objects({h: index[h] for h in to_remove})
+            removed.update(dict.fromkeys(to_remove))
+    return list(removed)
+
+
+class _CachedFunction:
+    """What :func:`cache_wrapper` turns a function into.
+
+    Bound as a method (i.e. accessed on an instance, or called through its class with
+    the instance first), calls are keyed by the instance's identity, rather than by
+    hashing the instance itself: the value of `instance_key(instance)`, else whatever
+    the key engine makes of it if its type has a `__cache_key__` or registered
+    encoder, or the qualified name of a class.  Instances with neither are passed
+    through uncached, as their keys would never match.
+    """
+
+    def __init__(
+        self,
+        f: Callable,
+        expires_after: Optional[Union[float, datetime.timedelta]],
+        annotation: Optional[str],
+        serializer: Optional[str],
+        stale_ttl: Optional[Union[float, datetime.timedelta]],
+        refresh_ahead: Optional[Union[float, datetime.timedelta]],
+        key_args: Dict[str, Callable[[Any], Any]],
+        exclude: Collection[str],
+        instance_key: Optional[Callable[[Any], Any]],
+    ) -> None:
+        functools.update_wrapper(self, f)
+        self._f = f
+        self._name = _describe_callable(f)
+        self._options = (
+            expires_after,
+            annotation,
+            serializer,
+            stale_ttl,
+            refresh_ahead,
+        )
+        self._key_args = key_args
+        self._exclude = exclude
+        self._instance_key = instance_key
+        self._make_key = _make_key_function(f, key_args, exclude)
+        self._make_method_key: Optional[Callable[..., _Key]] = None
+        self._owner: Optional[type] = None
+        self._call = _cache_async if inspect.iscoroutinefunction(f) else _cache_call
+        if self._call is _cache_async and hasattr(inspect, 'markcoroutinefunction'):
+            inspect.markcoroutinefunction(self)  # Python 3.12+
+
+    def __call__(self, *args, **kwargs) -> Any:
+        if self._owner is not None and args and isinstance(args[0], self._owner):
+            return self._call_method(args[0], args[1:], kwargs)  # `Class.method(obj)`
+        return self._call(
+            self._f,
+            args,
+            kwargs,
+            self._make_key(args, kwargs),
+            *self._options,
+            name=self._name,
+        )
+
+    def __reduce__(self) -> str:
+        return self._f.__qualname__  # pickled by reference, like the function it wraps
+
+    def __set_name__(self, owner: type, name: str) -> None:
+        self._owner = owner
+
+    def __get__(self, instance: Any, owner: Optional[type] = None) -> Any:
+        if instance is None:
+            return self
+        return _BoundCachedMethod(self, instance)
+
+    def _get_identity(self, instance: Any) -> Optional[str]:
+        if self._instance_key is not None:
+            return _hash_args(self._instance_key(instance))
+        if isinstance(instance, type):  # e.g. a classmethod
+            return _hash_args(_describe_callable(instance))
+        if _hashing.has_encoder(type(instance)):
+            return _hash_args(instance)
+        return None
+
+    def _call_method(self, instance: Any, args: tuple, kwargs: dict) -> Any:
+        identity = self._get_identity(instance)
+        if identity is None:
+            cls = type(instance)
+            if cls not in _unkeyable_types:
+                _unkeyable_types.add(cls)
+                logger.warning(
+                    f'{cls.__qualname__} instances have no stable identity (pass '
+                    f'`_instance_key` or define `__cache_key__`); not caching '
+                    f'{self._name}'
+                )
+            return self._f(instance, *args, **kwargs)
+        if self._make_method_key is None:
+            self._make_method_key = _make_key_function(
+                self._f, self._key_args, self._exclude, method=True
+            )
+        key = self._make_method_key(args, kwargs, (identity,))
+        return self._call(
+            self._f,
+            (instance, *args),
+            kwargs,
+            key,
+            *self._options,
+            instance=identity,
+            name=self._name,
+        )
+
+    def invalidate(self, instance: Any = None) -> List[str]:
+        """Remove the cached results of this function, or only those of the method
+        bound to `instance`, returning their hashes."""
+
+        if instance is None:
+            return _remove_matching(lambda entry: entry['callable'] == self._name)
+        identity = self._get_identity(instance)
+        return _remove_matching(
+            lambda entry: entry['callable'] == self._name
+            and entry.get('instance') == identity
+        )
+
+
+class _BoundCachedMethod:
+    def __init__(self, function: _CachedFunction, instance: Any) -> None:
+        functools.update_wrapper(self, function._f)
+        self.__func__ = function
+        self.__self__ = instance
+        if function._call is _cache_async and hasattr(inspect, 'markcoroutinefunction'):
+            inspect.markcoroutinefunction(self)  # Python 3.12+
+
+    def __call__(self, *args, **kwargs) -> Any:
+        return self.__func__._call_method(self.__self__, args, kwargs)
+
+    def invalidate(self) -> List[str]:
+        """Remove the cached results of this method for this instance."""
+
+        return self.__func__.invalidate(self.__self__)
+
+
+def cache_wrapper(
+    _expires_after: Optional[Union[float, datetime.timedelta]] = None,
+    _annotation: Optional[str] = None,
+    _serializer: Optional[str] = None,
+    _stale_ttl: Optional[Union[float, datetime.timedelta]] = None,
+    _refresh_ahead: Optional[Union[float, datetime.timedelta]] = None,
+    _key_args: Optional[Dict[str, Callable[[Any], Any]]] = None,
+    _exclude: Collection[str] = (),
+    _instance_key: Optional[Callable[[Any], Any]] = None,
+) -> Callable:
+    """
+    Decorator caching calls to a function (or coroutine function) as :func:`cache`
+    (or :func:`cache_async`) would.
+
+    Calls are keyed by their arguments as bound to the function's signature, so
+    equivalent call styles share an entry.  Decorated methods are keyed by their
+    instance's identity rather than its value, and their results can be dropped
+    per instance with `instance.method.invalidate()` (or all at once with
+    `Class.method.invalidate()`).
+
+    Args:
+
+        _expires_after, _annotation, _serializer, _stale_ttl, _refresh_ahead (optional):
+
+            As for :func:`cache`.
+
+        _key_args (:obj:`dict`, optional):
+
+            Maps argument names to functions deriving the value the argument is keyed
+                by, e.g. `{'df': lambda df: df.attrs['version']}`.
+
+        _exclude (optional):
+
+            Names of arguments left out of the key entirely, e.g. sessions or loggers.
+
+        _instance_key (Callable, optional):
+
+            For methods, maps the instance to its identity, e.g. `lambda self:
+                self.user_id`.  Defaults to the instance's `__cache_key__()` (or
+                encoder registered with :func:`register_key_encoder`); methods of
+                instances with neither are not cached.
+    """
+
+    def decorator(f: Callable) -> Callable:
+        return _CachedFunction(
+            f,
+            _expires_after,
+            _annotation,
+            _serializer,
+            _stale_ttl,
+            _refresh_ahead,
+            _key_args or {},
+            _exclude,
+            _instance_key,
+        )
+
+    return decorator
+
+
+atexit.register(_flush_accesses)
@@ -0,0 +1,314 @@
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Tuple
+import collections.abc
+import hashlib
+import struct
+import sys
+
+
+"""
+Key engine: a canonical, streaming binary encoding of call arguments fed into a
+configurable digest.
+
+Every value is written as a one-byte type tag followed by a length-prefixed payload,
+so no two different structures share an encoding.  Dict items and set members are
+ordered by their own encodings, making keys independent of insertion order.  Anything
+exposing the buffer protocol (bytes, memoryview, NumPy arrays, ...) is fed to the
+digest without being copied or stringified.
+"""
+
+
+_FLUSH_SIZE = 1 << 16
+# bytes of digest kept back from the key and stored alongside it, to detect collisions
+CHECK_SIZE = 8
+
+_encoders: Dict[type, Callable[[Any], Any]] = {}
+
+
+def register_encoder(cls: type, encoder: Callable[[Any], Any]) -> None:
+    """Key instances of `cls` (and its subclasses) by `encoder(instance)` instead."""
+
+    _encoders[cls] = encoder
+
+
+def has_encoder(cls: type) -> bool:
+    """Whether instances of `cls` are keyed by an encoder or `__cache_key__`, rather
+    than by value."""
+
+    return hasattr(cls, '__cache_key__') or any(
+        base in _encoders for base in cls.__mro__
+    )
+
+
+def new_digest(engine: str, size: int) -> Any:
+    """A :mod:`hashlib`-style digest object producing at least `size` bytes.
+
+    Engines with narrower outputs are run several times over, each instance seeded
+    differently, and their digests concatenated.
+    """
+
+    if engine == 'blake2b':
+        width = 64
+    elif engine == 'sha256':
+        width = 32
+    elif engine == 'xxhash':
+        width = 16 if size > 8 else 8
+    else:
+        raise ValueError(f'Unknown hash engine: {engine!r}')
+    n = -(-size // width)
+    if n == 1:
+        return _new_single_digest(engine, size, 0)
+    return _Digests([_new_single_digest(engine, width, i) for i in range(n)])
+
+
+def _new_single_digest(engine: str, size: int, seed: int) -> Any:
+    if engine == 'blake2b':
+        return hashlib.blake2b(digest_size=size, salt=struct.pack('>Q', seed))
+    if engine == 'sha256':
+        return hashlib.sha256(struct.pack('>Q', seed) if seed else b'')
+    import xxhash  # type: ignore  # optional dependency
+
+    return xxhash.xxh3_128(seed=seed) if size > 8 else xxhash.xxh3_64(seed=seed)
+
+
+class _Digests:
+    """Several digests fed the same data, their outputs concatenated."""
+
+    def __init__(self, digests: List[Any]) -> None:
+        self.digests = digests
+
+    def update(self, data: bytes) -> None:
+        for digest in self.digests:
+            digest.update(data)
+
+    def hexdigest(self) -> str:
+        return ''.join(digest.hexdigest() for digest in self.digests)
+
+
+class _Encoder:
+    def __init__(self, digest: Any) -> None:
+        self.digest = digest
+        self.buffer = bytearray()
+
+    def write(self, data: bytes) -> None:
+        self.buffer += data
+        if len(self.buffer) > _FLUSH_SIZE:
+            self.flush()
+
+    def write_buffer(self, data: memoryview) -> None:
+        self.write(struct.pack('>Q', data.nbytes))
+        if data.nbytes > _FLUSH_SIZE:
+            self.flush()
+            self.digest.update(data)
+        else:
+            self.buffer += data
+
+    def write_sized(self, tag: bytes, data: bytes) -> None:
+        self.write(tag + struct.pack('>Q', len(data)) + data)
+
+    def flush(self) -> None:
+        self.digest.update(self.buffer)
+        self.buffer.clear()
+
+    def encode(self, value: Any) -> None:
+        cls = type(value)
+        scalar = _SCALARS.get(cls)
+        if scalar is not None:
+            self.write(scalar(value))
+        elif cls is tuple or cls is list:
+            self._encode_sequence(value)
+        elif cls is dict:
+            self._encode_mapping(value)
+        elif value is True or value is False:
+            self.write(_encode_bool(value))
+        elif isinstance(value, int):
+            self.write(_encode_int(value))
+        elif isinstance(value, float):
+            self.write(_encode_float(value))
+        elif isinstance(value, str):
+            self.write(_encode_str(value))
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            view = memoryview(value)
+            if not view.c_contiguous:
+                view = memoryview(view.tobytes())
+            self.write(b'b')
+            self.write_buffer(view.cast('B'))
+        elif isinstance(value, (tuple, list)):
+            self._encode_sequence(value)
+        elif isinstance(value, dict):
+            self._encode_mapping(value)
+        elif isinstance(value, (set, frozenset)):
+            self._encode_set(value)
+        else:
+            self._encode_other(value)
+
+    def _encode_sequence(self, value: Any) -> None:
+        self.write(b'l' + struct.pack('>Q', len(value)))
+        types = set(map(type, value)) if len(value) > 8 else ()
+        if len(types) == 1:
+            (cls,) = types
+            if cls is str:
+                self.write(b''.join(map(_encode_str, value)))
+                return
+            if cls is float:
+                self.write(b'D' + struct.pack(f'>{len(value)}d', *value))
+                return
+            if cls is int and _INT64_MIN <= min(value) and max(value) <= _INT64_MAX:
+                self.write(b'q' + struct.pack(f'>{len(value)}q', *value))
+                return
+        for x in value:
+            self.encode(x)
+
+    def _encode_mapping(self, value: Any) -> None:
+        self.write(b'd' + struct.pack('>Q', len(value)))
+        items = ((_encode_key(k), v) for k, v in value.items())
+        for k, v in sorted(items, key=_first):
+            self.write(k)
+            self.encode(v)
+
+    def _encode_set(self, value: Any) -> None:
+        self.write(b'S' + struct.pack('>Q', len(value)))
+        for x in sorted(map(_encode_key, value)):
+            self.write(x)
+
+    def _encode_other(self, value: Any) -> None:
+        cls = type(value)
+        name = f'{cls.__module__}.{cls.__qualname__}'
+        for base in cls.__mro__:
+            if base in _encoders:
+                self.write_sized(b'E', name.encode())
+                self.encode(_encoders[base](value))
+                return
+        if hasattr(cls, '__cache_key__'):
+            self.write_sized(b'K', name.encode())
+            self.encode(value.__cache_key__())
+        elif _is_instance_of(value, 'numpy', 'ndarray'):
+            self._encode_ndarray(value)
+        elif _is_instance_of(value, 'numpy', 'generic'):
+            self.encode(value.item())
+        elif _is_instance_of(value, 'pandas', 'DataFrame', 'Series', 'Index'):
+            self._encode_pandas(value, name)
+        elif isinstance(value, collections.abc.Mapping):
+            self._encode_mapping(value)
+        elif isinstance(value, collections.abc.Set):
+            self._encode_set(value)
+        elif isinstance(value, collections.abc.Sequence):
+            self._encode_sequence(value)
+        else:
+            self.write_sized(b'r', name.encode())
+            self.write_sized(b'r', str(value).encode('utf-8', 'surrogatepass'))
+
+    def _encode_ndarray(self, value: Any) -> None:
+        if value.dtype.hasobject:
+            self.write_sized(b'A', str(value.shape).encode())
+            self._encode_sequence(value.ravel().tolist())
+            return
+        numpy = sys.modules['numpy']
+        self.write_sized(b'a', f'{value.dtype.str}{value.shape}'.encode())
+        data = numpy.ascontiguousarray(value).reshape(-1).view(numpy.uint8)
+        self.write_buffer(memoryview(data))
+
+    def _encode_pandas(self, value: Any, name: str) -> None:
+        pandas = sys.modules['pandas']
+        self.write_sized(b'p', name.encode())
+        if hasattr(value, 'columns'):
+            self.encode([str(c) for c in value.columns])
+            self.encode([str(d) for d in value.dtypes])
+        else:
+            self.encode(str(value.dtype))
+        try:
+            hashed = pandas.util.hash_pandas_object(value, index=True)
+        except TypeError:  # unhashable cells, e.g. lists
+            self.encode(value.to_dict() if hasattr(value, 'to_dict') else list(value))
+        else:
+            self._encode_ndarray(hashed.to_numpy())
+
+
+def _encode_none(value: None) -> bytes:
+    return b'N'
+
+
+def _encode_bool(value: bool) -> bytes:
+    return b'T' if value else b'F'
+
+
+def _encode_int(value: int) -> bytes:
+    data = value.to_bytes((value.bit_length() + 8) // 8, 'big', signed=True)
+    return b'i' + struct.pack('>Q', len(data)) + data
+
+
+def _encode_float(value: float) -> bytes:
+    return b'f' + struct.pack('>d', value)
+
+
+def _encode_str(value: str) -> bytes:
+    data = value.encode('utf-8', 'surrogatepass')
+    return b's' + struct.pack('>Q', len(data)) + data
+
+
+# exact types only: subclasses (e.g. enums) take the slow, type-aware path
+_SCALARS: Dict[type, Callable[[Any], bytes]] = {
+    type(None): _encode_none,
+    bool: _encode_bool,
+    int: _encode_int,
+    float: _encode_float,
+    str: _encode_str,
+}
+
+_INT64_MIN = -(2**63)
+_INT64_MAX = 2**63 - 1
+
+
+def _first(item: Tuple) -> Any:
+    return item[0]
+
+
+def _is_instance_of(value: Any, module: str, *names: str) -> bool:
+    """`isinstance` for optional dependencies, without importing them."""
+
+    mod = sys.modules.get(module)
+    if mod is None:
+        return False
+    return isinstance(value, tuple(getattr(mod, name) for name in names))
+
+
+class _Sink:
+    """Digest stand-in collecting the encoding itself."""
+
+    def __init__(self) -> None:
+        self.data = bytearray()
+
+    def update(self, data: bytes) -> None:
+        self.data += data
+
+
+def _encode_key(value: Any) -> bytes:
+    scalar = _SCALARS.get(type(value))
+    if scalar is not None:
+        return scalar(value)
+    return encode(value)
+
+
+def encode(value: Any) -> bytes:
+    """The canonical encoding of `value` as a single bytes object."""
+
+    sink = _Sink()
+    encoder = _Encoder(sink)
+    encoder.encode(value)
+    encoder.flush()
+    return bytes(sink.data)
+
+
+def hash_values(engine: str, size: int, *values: Any) -> Tuple[str, str]:
+    """Hash `values`, returning the key (`size` bytes) and its check, as hex."""
+
+    digest = new_digest(engine, size + CHECK_SIZE)
+    encoder = _Encoder(digest)
+    for value in values:
+        encoder.encode(value)
+    encoder.flush()
+    hexdigest = digest.hexdigest()
+    return hexdigest[: 2 * size], hexdigest[2 * size : 2 * (size + CHECK_SIZE)]
@@ -0,0 +1,158 @@
+from typing import Dict
+from typing import Iterable
+from typing import List
+import json
+import os
+import threading
+
+from . import _locking
+
+
+"""
+Append-only journal index backend.
+
+Each line of the journal is one JSON record:
+
+    ["+", hash, entry]      add (or replace) an entry
+    ["-", hash]             remove an entry
+
+Readers replay the journal into the same dict shape as `index.json`, only parsing
+records appended since their last read.  Once the journal holds enough dead records
+it is compacted into a snapshot of the live entries.
+"""
+
+
+_IndexDict = Dict[str, Dict]
+
+_ADD = '+'
+_REMOVE = '-'
+
+_COMPACT_MIN_RECORDS = 1024
+_COMPACT_RATIO = 2
+
+
+class _JournalState:
+    def __init__(self, ino: int) -> None:
+        self.ino = ino
+        self.offset = 0
+        self.n_records = 0
+        self.index: _IndexDict = {}
+
+
+_states: Dict[str, _JournalState] = {}
+_states_lock = threading.RLock()
+
+
+def _apply(index: _IndexDict, record: List) -> None:
+    if record[0] == _ADD:
+        index[record[1]] = record[2]
+    elif record[0] == _REMOVE:
+        index.pop(record[1], None)
+
+
+def _encode(record: List) -> bytes:
+    return (json.dumps(record) + '\n').encode()
+
+
+def read_index(path: str) -> _IndexDict:
+    """Materialize the journal at `path`, replaying only unread records.
+
+    Note: The returned dict is the reader's live state, shared with other callers and
+        never mutated.  It is replaced by a fresh dict whenever records are replayed
+        or appended, so callers may rely on its identity to tell whether its contents
+        changed underneath them.
+    """
+
+    with _states_lock:
+        return _read_index(path)
+
+
+def _read_index(path: str) -> _IndexDict:
+    stat = os.stat(path)
+    state = _states.get(path)
+    if state is None or state.ino != stat.st_ino or stat.st_size < state.offset:
+        state = _states[path] = _JournalState(stat.st_ino)
+    if stat.st_size == state.offset:
+        return state.index
+    with open(path, 'rb') as f:
+        f.seek(state.offset)
+        data = f.read(stat.st_size - state.offset)
+    index = dict(state.index)
+    consumed = 0
+    for line in data.splitlines(keepends=True):
+        if not line.endswith(b'\n'):
+            break  # still being written; pick it up next time
+        consumed += len(line)
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue  # torn write from a crashed writer; only this record is lost
+        _apply(index, record)
+        state.n_records += 1
+    state.offset += consumed
+    state.index = index
+    return index
+
+
+def _append(path: str, records: List[List]) -> _IndexDict:
+    """Note: Writers are expected to hold the cache's index lock."""
+
+    with _states_lock:
+        return _append_locked(path, records)
+
+
+def _append_locked(path: str, records: List[List]) -> _IndexDict:
+    index = dict(_read_index(path))  # the dict read may have been handed out already
+    state = _states[path]
+    data = b''.join(_encode(record) for record in records)
+    with open(path, 'ab') as f:
+        start = f.tell()
+        if start and start != state.offset:
+            # make sure a torn record left behind by a crashed writer is terminated
+            with open(path, 'rb') as r:
+                r.seek(start - 1)
+                if r.read(1) != b'\n':
+                    data = b'\n' + data
+        f.write(data)
+        end = f.tell()
+    for record in records:
+        _apply(index, record)
+    if start == state.offset and end == start + len(data):
+        state.offset = end
+        state.n_records += len(records)
+        state.index = index
+    if state.n_records > max(_COMPACT_MIN_RECORDS, _COMPACT_RATIO * len(index)):
+        _write_index(path, index)
+    return index
+
+
+def add_entries(path: str, entries: _IndexDict) -> _IndexDict:
+    return _append(path, [[_ADD, hash, entry] for hash, entry in entries.items()])
+
+
+def remove_entries(path: str, hashes: Iterable[str]) -> _IndexDict:
+    return _append(path, [[_REMOVE, hash] for hash in hashes])
+
+
+def write_index(path: str, index: _IndexDict) -> None:
+    """Replace the journal with a snapshot of `index` (i.e. compact it)."""
+
+    with _states_lock:
+        _write_index(path, index)
+
+
+def _write_index(path: str, index: _IndexDict) -> None:
+    data = b''.join(_encode([_ADD, hash, entry]) for hash, entry in index.items())
+    with _locking.atomic_write(path) as f:
+        f.write(data)
+    state = _states[path] = _JournalState(os.stat(path).st_ino)
+    state.offset = len(data)
+    state.n_records = len(index)
+    state.index = index
+
+
+def forget() -> None:
+    """Drop all in-process journal state."""
+
+    with _states_lock:
+        _states.clear()
@@ -0,0 +1,145 @@
+from typing import IO
+from typing import Dict
+from typing import Iterator
+import contextlib
+import os
+import threading
+import time
+
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover (Windows)
+    fcntl = None  # type: ignore
+
+
+"""
+Cross-process and cross-thread locking, plus atomic file replacement.
+"""
+
+
+_LEASE_SUFFIX = '.lease'
+_LEASE_POLL_MIN = 0.001
+_LEASE_POLL_MAX = 0.05
+
+
+_registry_lock = threading.Lock()
+_thread_locks: Dict[str, threading.RLock] = {}
+_local = threading.local()
+# lease path -> [lock, number of threads holding or waiting for it]
+_lease_locks: Dict[str, list] = {}
+
+
+def _get_thread_lock(path: str) -> threading.RLock:
+    with _registry_lock:
+        return _thread_locks.setdefault(path, threading.RLock())
+
+
+@contextlib.contextmanager
+def lock(path: str) -> Iterator[None]:
+    """Hold an exclusive, reentrant lock on directory `path`.
+
+    Threads are serialized by an in-process lock; processes by an advisory
+    :func:`fcntl.flock` on the directory itself, so no lock file is left behind.  On
+    platforms without :mod:`fcntl` only the in-process lock is taken.
+    """
+
+    depths: Dict[str, int] = _local.__dict__.setdefault('depths', {})
+    with _get_thread_lock(path):
+        depth = depths.get(path, 0)
+        depths[path] = depth + 1
+        fd = None
+        try:
+            if depth == 0 and fcntl is not None:
+                fd = os.open(path, os.O_RDONLY)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            if fd is not None:
+                os.close(fd)  # also releases the flock
+            depths[path] = depth
+
+
+def is_held(path: str) -> bool:
+    """Whether this thread holds the :func:`lock` on `path`."""
+
+    return _local.__dict__.get('depths', {}).get(path, 0) > 0
+
+
+@contextlib.contextmanager
+def atomic_write(path: str, mode: str = 'wb') -> Iterator[IO]:
+    """Write to a temporary sibling of `path`, then atomically move it into place.
+
+    Readers therefore see either the old or the new file, never a partial one.
+    """
+
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+
+
+def _try_create_lease(lease_path: str, timeout: float) -> bool:
+    try:
+        fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        with contextlib.suppress(FileNotFoundError):
+            if time.time() - os.stat(lease_path).st_mtime > timeout:
+                # holder crashed (live holders keep refreshing it); break the lease
+                os.remove(lease_path)
+        return False
+    os.write(fd, str(os.getpid()).encode())
+    os.close(fd)
+    return True
+
+
+def _heartbeat(lease_path: str, interval: float, stop: threading.Event) -> None:
+    while not stop.wait(interval):
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(lease_path)
+
+
+@contextlib.contextmanager
+def lease(path: str, timeout: float) -> Iterator[None]:
+    """Hold the exclusive lease on `path` (single-flight across threads and processes).
+
+    Threads of this process queue on an in-process lock; processes on a
+    `<path>.lease` file created with `O_EXCL`.  The holder refreshes the lease file's
+    mtime while it runs, so a lease untouched for longer than `timeout` seconds is
+    assumed to belong to a crashed worker and is broken.
+    """
+
+    with _registry_lock:
+        item = _lease_locks.setdefault(path, [threading.Lock(), 0])
+        item[1] += 1
+    try:
+        with item[0]:
+            lease_path = path + _LEASE_SUFFIX
+            poll = _LEASE_POLL_MIN
+            while not _try_create_lease(lease_path, timeout):
+                time.sleep(poll)
+                poll = min(poll * 2, _LEASE_POLL_MAX)
+            stop = threading.Event()
+            heartbeat = threading.Thread(
+                target=_heartbeat,
+                args=(lease_path, timeout / 3, stop),
+                daemon=True,
+            )
+            heartbeat.start()
+            try:
+                yield
+            finally:
+                stop.set()
+                heartbeat.join()
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(lease_path)
+    finally:
+        with _registry_lock:
+            item[1] -= 1
+            if not item[1]:
+                del _lease_locks[path]
@@ -0,0 +1,94 @@
+from collections import OrderedDict
+from typing import Any
+from typing import Hashable
+from typing import Iterable
+from typing import Optional
+from typing import Tuple
+import datetime
+import threading
+
+
+"""
+In-process LRU tier sitting in front of the on-disk store.
+"""
+
+
+MISSING = object()
+
+
+_MemoryItem = Tuple[Any, Optional[datetime.datetime], int]
+
+
+class MemoryTier:
+    """Least-recently-used mapping bounded by entry count and estimated bytes.
+
+    Values are held by reference, so mutating a returned value mutates the cached
+    one, exactly as with :func:`functools.lru_cache`.
+    """
+
+    def __init__(self) -> None:
+        self._items: 'OrderedDict[Hashable, _MemoryItem]' = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def get(self, key: Hashable) -> Any:
+        """Return the value stored under `key`, or :data:`MISSING`."""
+
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return MISSING
+            value, expires_at, _ = item
+            if expires_at is not None and expires_at < datetime.datetime.utcnow():
+                self._pop(key)
+                return MISSING
+            self._items.move_to_end(key)
+            return value
+
+    def put(
+        self,
+        key: Hashable,
+        value: Any,
+        expires_at: Optional[datetime.datetime],
+        nbytes: int,
+        max_entries: Optional[int],
+        max_bytes: Optional[int],
+    ) -> None:
+        """Store `value`, then evict least-recently-used items until within limits.
+
+        Values estimated to be larger than `max_bytes` on their own are not stored.
+        """
+
+        if max_bytes is not None and nbytes > max_bytes:
+            return
+        with self._lock:
+            self._pop(key)
+            self._items[key] = (value, expires_at, nbytes)
+            self._nbytes += nbytes
+            while (max_entries is not None and len(self._items) > max_entries) or (
+                max_bytes is not None and self._nbytes > max_bytes
+            ):
+                oldest = next(iter(self._items))
+                self._pop(oldest)
+
+    def discard(self, keys: Iterable[Hashable]) -> None:
+        with self._lock:
+            for key in keys:
+                self._pop(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+            self._nbytes = 0
+
+    def _pop(self, key: Hashable) -> None:
+        item = self._items.pop(key, None)
+        if item is not None:
+            self._nbytes -= item[2]
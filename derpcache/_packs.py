@@ -0,0 +1,236 @@
+from typing import IO
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import Optional
+from typing import Tuple
+import collections
+import contextlib
+import mmap
+import os
+import threading
+import uuid
+
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover (Windows)
+    fcntl = None  # type: ignore
+
+
+"""
+Pack files: small objects appended to shared segment files instead of one file each.
+
+Every process appends to a segment of its own, holding a shared :func:`fcntl.flock`
+on it for as long as it does.  A segment nobody holds a lock on is sealed: it never
+changes again, so readers can memory-map it once, and compaction may copy its live
+records elsewhere and delete it.
+"""
+
+
+_SUFFIX = '.pack'
+_SEGMENT_MAX_BYTES = 64 << 20
+# sealed segments with a smaller share of live bytes are compacted
+_COMPACT_LIVE_RATIO = 0.5
+_MAX_MAPS = 64
+
+# hash -> (segment, offset, length)
+Locations = Dict[str, Tuple[str, int, int]]
+
+
+class _Segment:
+    def __init__(self, name: str, fd: int) -> None:
+        self.pid = os.getpid()
+        self.name = name
+        self.fd = fd
+        self.size = 0
+
+
+_lock = threading.Lock()
+# pack directory -> segment this process appends to
+_active: Dict[str, _Segment] = {}
+# segment path -> read-only map of it
+_maps: 'collections.OrderedDict[str, mmap.mmap]' = collections.OrderedDict()
+# segment path -> bytes of its records this process has seen die
+_dead: Dict[str, int] = {}
+
+
+class SpillWriter:
+    """Binary file stand-in buffering writes in memory until they reach `threshold`
+    bytes, then spilling them (and any later ones) into the file `open_file()`."""
+
+    def __init__(self, threshold: int, open_file: Callable[[], IO[bytes]]) -> None:
+        self.threshold = threshold
+        self.open_file = open_file
+        self.buffer: Optional[bytearray] = bytearray()
+        self.file: Optional[IO[bytes]] = None
+        self.n_written = 0
+
+    def write(self, data: bytes) -> int:
+        n = len(data)
+        self.n_written += n
+        if self.file is not None:
+            self.file.write(data)
+            return n
+        assert self.buffer is not None
+        self.buffer += data
+        if len(self.buffer) >= self.threshold:
+            self.file = self.open_file()
+            self.file.write(self.buffer)
+            self.buffer = None
+        return n
+
+    def flush(self) -> None:
+        if self.file is not None:
+            self.file.flush()
+
+    def tell(self) -> int:
+        return self.n_written
+
+
+def _open_segment(pack_dir: str) -> _Segment:
+    os.makedirs(pack_dir, exist_ok=True)
+    name = uuid.uuid4().hex
+    path = os.path.join(pack_dir, name)
+    # locked before it shows up under its final name, so it is never taken for sealed
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_EXCL)
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_SH)
+    os.rename(path, path + _SUFFIX)
+    return _Segment(name + _SUFFIX, fd)
+
+
+def _seal(pack_dir: str) -> None:
+    segment = _active.pop(pack_dir, None)
+    if segment is not None and segment.pid == os.getpid():
+        os.close(segment.fd)  # also releases the flock
+
+
+def append(pack_dir: str, data: bytes) -> Tuple[str, int, int]:
+    """Append `data` to this process' segment, returning its location."""
+
+    with _lock:
+        segment = _active.get(pack_dir)
+        if segment is not None and (
+            segment.pid != os.getpid()  # forked: the segment is our parent's
+            or segment.size + len(data) > _SEGMENT_MAX_BYTES
+            or not os.path.exists(os.path.join(pack_dir, segment.name))
+        ):
+            _seal(pack_dir)
+            segment = None
+        if segment is None:
+            segment = _active[pack_dir] = _open_segment(pack_dir)
+        offset = segment.size
+        os.write(segment.fd, data)
+        segment.size += len(data)
+        return segment.name, offset, len(data)
+
+
+def read(pack_dir: str, segment: str, offset: int, length: int) -> bytes:
+    path = os.path.join(pack_dir, segment)
+    with _lock:
+        mapped = _maps.get(path)
+        if mapped is None or len(mapped) < offset + length:  # new, or since grown
+            if mapped is not None:
+                mapped.close()
+            with open(path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            _maps[path] = mapped
+            while len(_maps) > _MAX_MAPS:
+                _maps.popitem(last=False)[1].close()
+        _maps.move_to_end(path)
+        return mapped[offset : offset + length]
+
+
+def release(pack_dir: str, locations: Iterable[Tuple[str, int, int]]) -> bool:
+    """Count the records at `locations` as dead, returning whether a sealed segment
+    of theirs now holds enough dead data for :func:`compact` to delete it.
+
+    Note: Only records this process saw die are counted, so other processes may have
+        left a segment emptier than it seems.
+    """
+
+    with _lock:
+        touched = set()
+        for segment, _, length in locations:
+            path = os.path.join(pack_dir, segment)
+            _dead[path] = _dead.get(path, 0) + length
+            touched.add(path)
+        active = _active.get(pack_dir)
+        if active is not None:
+            touched.discard(os.path.join(pack_dir, active.name))  # not sealed yet
+    for path in touched:
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:  # compacted by another process
+            _dead.pop(path, None)
+            continue
+        if _dead.get(path, 0) > (1 - _COMPACT_LIVE_RATIO) * size:
+            return True
+    return False
+
+
+@contextlib.contextmanager
+def _lock_sealed(path: str):
+    """Yields whether the segment at `path` is sealed, keeping it that way meanwhile."""
+
+    if fcntl is None:  # pragma: no cover (Windows)
+        yield False
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+        else:
+            yield True
+    finally:
+        os.close(fd)
+
+
+def compact(pack_dir: str, locations: Locations) -> Locations:
+    """Copy the live records (`locations`) out of sealed segments holding too much dead
+    data, deleting those segments.  Returns the records' new locations.
+
+    Note: Callers are expected to hold the cache's index lock, and to record the new
+        locations before releasing it (or, without one, to only record those of
+        records still at their old locations).
+    """
+
+    if not os.path.isdir(pack_dir):
+        return {}
+    live: Dict[str, Locations] = collections.defaultdict(dict)
+    for hash, location in locations.items():
+        live[location[0]][hash] = location
+    moved: Locations = {}
+    for name in os.listdir(pack_dir):
+        if not name.endswith(_SUFFIX):
+            continue
+        path = os.path.join(pack_dir, name)
+        records = live.get(name, {})
+        with contextlib.suppress(FileNotFoundError), _lock_sealed(path) as sealed:
+            size = os.path.getsize(path)
+            live_bytes = sum(length for _, _, length in records.values())
+            if not sealed or live_bytes >= _COMPACT_LIVE_RATIO * size:
+                continue
+            for hash, (_, offset, length) in records.items():
+                moved[hash] = append(pack_dir, read(pack_dir, name, offset, length))
+            with _lock:
+                mapped = _maps.pop(path, None)
+                if mapped is not None:
+                    mapped.close()
+                _dead.pop(path, None)
+            os.remove(path)
+    return moved
+
+
+def forget() -> None:
+    """Seal this process' segments and drop its maps."""
+
+    with _lock:
+        for pack_dir in list(_active):
+            _seal(pack_dir)
+        for mapped in _maps.values():
+            mapped.close()
+        _maps.clear()
@@ -0,0 +1,122 @@
+from typing import IO
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import NamedTuple
+import bz2
+import gzip
+import itertools
+import json
+import lzma
+import pickle
+
+
+"""
+Serializer registry: how cached values are written to and read from object files.
+"""
+
+
+DEFAULT = 'pickle'
+# iterables written as they are iterated, and read back lazily
+STREAM = 'stream'
+# items pickled per record of a stream
+STREAM_CHUNK_SIZE = 1000
+
+
+class Serializer(NamedTuple):
+    dump: Callable[[Any, IO[bytes]], None]
+    load: Callable[[IO[bytes]], Any]
+
+
+_registry: Dict[str, Serializer] = {}
+
+
+def register(
+    name: str,
+    dump: Callable[[Any, IO[bytes]], None],
+    load: Callable[[IO[bytes]], Any],
+) -> None:
+    _registry[name] = Serializer(dump, load)
+
+
+def get(name: str) -> Serializer:
+    try:
+        return _registry[name]
+    except KeyError:
+        raise ValueError(f'Unknown serializer: {name!r}') from None
+
+
+def _compressed(open_: Callable[..., Any], **kwargs: Any) -> Serializer:
+    """Pickle (at the highest protocol) through a streaming compressor."""
+
+    def dump(value: Any, f: IO[bytes]) -> None:
+        with open_(f, 'wb', **kwargs) as compressed:
+            pickle.dump(value, compressed, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load(f: IO[bytes]) -> Any:
+        with open_(f, 'rb') as compressed:
+            return pickle.load(compressed)
+
+    return Serializer(dump, load)
+
+
+def _open_gzip(f: IO[bytes], mode: str, **kwargs: Any) -> gzip.GzipFile:
+    # a fixed mtime keeps the output deterministic
+    return gzip.GzipFile(fileobj=f, mode=mode, mtime=0, **kwargs)
+
+
+def _dump_json(value: Any, f: IO[bytes]) -> None:
+    f.write(json.dumps(value).encode())
+
+
+def _load_json(f: IO[bytes]) -> Any:
+    return json.load(f)
+
+
+def _dump_bytes(value: Any, f: IO[bytes]) -> None:
+    if isinstance(value, str):
+        raise TypeError('the "bytes" serializer only accepts bytes-like values')
+    f.write(value)
+
+
+def _load_bytes(f: IO[bytes]) -> bytes:
+    return f.read()
+
+
+def _dump_stream(value: Iterable, f: IO[bytes]) -> None:
+    """Pickle the items of `value` as they come, in records of up to
+    :data:`STREAM_CHUNK_SIZE` items, so it never needs to fit in memory whole."""
+
+    items = iter(value)
+    while True:
+        chunk = list(itertools.islice(items, STREAM_CHUNK_SIZE))
+        if not chunk:
+            return
+        pickle.dump(chunk, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _load_stream(f: IO[bytes]) -> Iterator:
+    """Lazily yield the items of a stream, reading a record at a time."""
+
+    while True:
+        try:
+            chunk = pickle.load(f)
+        except EOFError:
+            return
+        yield from chunk
+
+
+register('pickle', pickle.dump, pickle.load)
+register(
+    'pickle-highest',
+    lambda value, f: pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL),
+    pickle.load,
+)
+register('gzip', *_compressed(_open_gzip, compresslevel=6))
+register('bz2', *_compressed(bz2.BZ2File))
+register('lzma', *_compressed(lzma.LZMAFile))
+register('json', _dump_json, _load_json)
+register('bytes', _dump_bytes, _load_bytes)
+register(STREAM, _dump_stream, _load_stream)
@@ -0,0 +1,407 @@
+from typing import Collection
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import Mapping
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+import datetime
+import json
+import os
+import sqlite3
+import threading
+
+
+"""
+SQLite index backend.
+
+Entries live in a single `entries` table with indexed columns for the fields the
+cache filters on, so lookups are point queries and expiry cleanup is a single
+indexed range delete.  Fields without a column of their own are kept as JSON.
+"""
+
+
+_IndexDict = Dict[str, Dict]
+
+_COLUMNS = (
+    'callable',
+    'called_at',
+    'expires_after',
+    'annotation',
+    'size',
+    'last_accessed',
+    'hits',
+)
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    hash TEXT PRIMARY KEY,
+    callable TEXT NOT NULL,
+    called_at TEXT NOT NULL,
+    expires_after REAL,
+    expires_at REAL,
+    annotation TEXT,
+    extra TEXT,
+    size INTEGER,
+    last_accessed TEXT,
+    hits INTEGER
+);
+CREATE INDEX IF NOT EXISTS entries_callable ON entries (callable);
+CREATE INDEX IF NOT EXISTS entries_called_at ON entries (called_at);
+CREATE INDEX IF NOT EXISTS entries_called_at_hash ON entries (called_at, hash);
+CREATE INDEX IF NOT EXISTS entries_expires_after ON entries (expires_after);
+CREATE INDEX IF NOT EXISTS entries_expires_at ON entries (expires_at);
+CREATE INDEX IF NOT EXISTS entries_annotation ON entries (annotation);
+'''
+_SELECT = (
+    'SELECT hash, callable, called_at, expires_after, annotation, extra, size, '
+    'last_accessed, hits'
+)
+_INSERT = (
+    'INSERT OR REPLACE INTO entries (hash, callable, called_at, expires_after, '
+    'expires_at, annotation, extra, size, last_accessed, hits) '
+    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+)
+_RECORD_ACCESS = (
+    'UPDATE entries SET last_accessed = ?, hits = coalesce(hits, 0) + ? '
+    'WHERE hash = ?'
+)
+# columns added since the table was first introduced, with their types
+_ADDED_COLUMNS = {'size': 'INTEGER', 'last_accessed': 'TEXT', 'hits': 'INTEGER'}
+# on top of the added columns: the number of entries and their total size, kept up to
+# date by triggers (REPLACE firing the delete trigger, with recursive triggers on),
+# counting payloads shared by deduplicated entries once, and indexes serving the
+# eviction orders
+_USAGE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS contents (
+    digest TEXT PRIMARY KEY,
+    shares INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO contents
+    SELECT json_extract(extra, '$.content'), count(*) FROM entries
+    WHERE json_extract(extra, '$.content') IS NOT NULL
+    GROUP BY 1;
+CREATE TABLE IF NOT EXISTS usage (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    entries INTEGER NOT NULL,
+    bytes INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO usage
+    SELECT 0, (SELECT count(*) FROM entries), coalesce(sum(size), 0) FROM entries
+    WHERE json_extract(extra, '$.content') IS NULL OR hash IN (
+        SELECT min(hash) FROM entries GROUP BY json_extract(extra, '$.content')
+    );
+CREATE TRIGGER IF NOT EXISTS entries_inserted AFTER INSERT ON entries BEGIN
+    UPDATE usage SET
+        entries = entries + 1,
+        bytes = bytes + coalesce(NEW.size, 0) * NOT EXISTS (
+            SELECT 1 FROM contents
+            WHERE digest = json_extract(NEW.extra, '$.content')
+        );
+    INSERT INTO contents
+        SELECT json_extract(NEW.extra, '$.content'), 1
+        WHERE json_extract(NEW.extra, '$.content') IS NOT NULL
+        ON CONFLICT (digest) DO UPDATE SET shares = shares + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_deleted AFTER DELETE ON entries BEGIN
+    UPDATE contents SET shares = shares - 1
+        WHERE digest = json_extract(OLD.extra, '$.content');
+    UPDATE usage SET
+        entries = entries - 1,
+        bytes = bytes - coalesce(OLD.size, 0) * NOT EXISTS (
+            SELECT 1 FROM contents
+            WHERE digest = json_extract(OLD.extra, '$.content') AND shares > 0
+        );
+    DELETE FROM contents
+        WHERE digest = json_extract(OLD.extra, '$.content') AND shares = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_resized AFTER UPDATE OF size ON entries
+WHEN json_extract(NEW.extra, '$.content') IS NULL BEGIN
+    UPDATE usage SET bytes = bytes + coalesce(NEW.size, 0) - coalesce(OLD.size, 0);
+END;
+CREATE INDEX IF NOT EXISTS entries_lru ON entries (coalesce(last_accessed, called_at));
+CREATE INDEX IF NOT EXISTS entries_lfu
+    ON entries (coalesce(hits, 0), coalesce(last_accessed, called_at));
+'''
+# eviction policy -> ORDER BY clause putting the entries to be evicted first
+_EVICTION_ORDERS = {
+    'lru': 'coalesce(last_accessed, called_at)',
+    'lfu': 'coalesce(hits, 0), coalesce(last_accessed, called_at)',
+    'cost': (
+        "coalesce(json_extract(extra, '$.duration'), 0.0) * (coalesce(hits, 0) + 1) "
+        '/ max(coalesce(size, 0), 1), coalesce(last_accessed, called_at)'
+    ),
+}
+
+_BUSY_TIMEOUT = 60
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+_local = threading.local()
+
+
+def _timestamp(dt: datetime.datetime) -> float:
+    return (dt - _EPOCH).total_seconds()
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    """Per-thread connection to the database at `path`.
+
+    Connections are reopened whenever the file was replaced or removed (e.g. by
+    clearing the cache), so they never keep writing into an unlinked database.
+    """
+
+    connections: Dict[str, Tuple[int, sqlite3.Connection]]
+    connections = _local.__dict__.setdefault('connections', {})
+    try:
+        ino: Optional[int] = os.stat(path).st_ino
+    except FileNotFoundError:
+        ino = None
+    cached = connections.get(path)
+    if cached is not None:
+        if cached[0] == ino:
+            return cached[1]
+        cached[1].close()
+    connection = sqlite3.connect(path, timeout=_BUSY_TIMEOUT, isolation_level=None)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.execute('PRAGMA recursive_triggers=ON')
+    connection.executescript(_SCHEMA)
+    columns = {row[1] for row in connection.execute('PRAGMA table_info(entries)')}
+    for column, type_ in _ADDED_COLUMNS.items():
+        if column not in columns:
+            connection.execute(f'ALTER TABLE entries ADD COLUMN {column} {type_}')
+    connection.executescript(_USAGE_SCHEMA)
+    connections[path] = (os.stat(path).st_ino, connection)
+    return connection
+
+
+def _to_row(hash: str, entry: Dict) -> Tuple:
+    extra = {k: v for k, v in entry.items() if k not in _COLUMNS}
+    expires_at = None
+    if entry.get('expires_after'):
+        called_at = datetime.datetime.fromisoformat(entry['called_at'])
+        expires_at = (
+            _timestamp(called_at) + entry['expires_after'] + entry.get('stale_ttl', 0)
+        )
+    return (
+        hash,
+        entry['callable'],
+        entry['called_at'],
+        entry.get('expires_after'),
+        expires_at,
+        entry.get('annotation'),
+        json.dumps(extra) if extra else None,
+        entry.get('size'),
+        entry.get('last_accessed'),
+        entry.get('hits'),
+    )
+
+
+def _from_row(row: Tuple) -> Tuple[str, Dict]:
+    hash, callable, called_at, expires_after, annotation, extra, *columns = row
+    entry = {'callable': callable, 'called_at': called_at}
+    optional = zip(
+        ('expires_after', 'annotation', 'size', 'last_accessed', 'hits'),
+        (expires_after, annotation, *columns),
+    )
+    entry.update((k, v) for k, v in optional if v is not None)
+    if extra is not None:
+        entry.update(json.loads(extra))
+    return hash, entry
+
+
+def init(path: str) -> None:
+    _connect(path)
+
+
+def read_index(path: str) -> _IndexDict:
+    rows = _connect(path).execute(f'{_SELECT} FROM entries ORDER BY called_at')
+    return dict(_from_row(row) for row in rows)
+
+
+def iter_index(path: str, page_size: int) -> Iterator[Tuple[str, Dict]]:
+    """Entries in order of `called_at`, queried `page_size` rows at a time (each page
+    picking up after the last row of the previous one), so the table is never loaded
+    whole."""
+
+    query = f'{_SELECT} FROM entries ORDER BY called_at, hash LIMIT ?'
+    rows = _connect(path).execute(query, (page_size,)).fetchall()
+    while rows:
+        for row in rows:
+            yield _from_row(row)
+        hash, _, called_at, *_ = rows[-1]
+        rows = (
+            _connect(path)
+            .execute(
+                f'{_SELECT} FROM entries WHERE (called_at, hash) > (?, ?) '
+                'ORDER BY called_at, hash LIMIT ?',
+                (called_at, hash, page_size),
+            )
+            .fetchall()
+        )
+
+
+def lookup(path: str, hash: str) -> Optional[Dict]:
+    row = (
+        _connect(path)
+        .execute(f'{_SELECT} FROM entries WHERE hash = ?', (hash,))
+        .fetchone()
+    )
+    if row is None:
+        return None
+    return _from_row(row)[1]
+
+
+def add_entries(
+    path: str,
+    entries: _IndexDict,
+    accesses: Optional[Mapping[str, Sequence]] = None,
+) -> None:
+    """Insert (or replace) `entries` and record `accesses` (hash -> (last accessed,
+    number of hits)) of existing ones, in a single transaction."""
+
+    connection = _connect(path)
+    with connection:
+        connection.execute('BEGIN IMMEDIATE')
+        connection.executemany(
+            _INSERT, [_to_row(hash, entry) for hash, entry in entries.items()]
+        )
+        if accesses:
+            connection.executemany(
+                _RECORD_ACCESS,
+                [(at, hits, hash) for hash, (at, hits) in accesses.items()],
+            )
+
+
+def relocate(
+    path: str,
+    moved: Mapping[str, Tuple[Tuple[str, int, int], Tuple[str, int, int]]],
+) -> None:
+    """Point entries at new (segment, offset, length) locations, given by hash along
+    with their old ones, in a single transaction.  Entries no longer at their old
+    location (e.g. refreshed meanwhile) are left alone."""
+
+    connection = _connect(path)
+    with connection:
+        connection.execute('BEGIN IMMEDIATE')
+        rows = []
+        for hash, (old, new) in moved.items():
+            row = connection.execute(
+                f'{_SELECT} FROM entries WHERE hash = ?', (hash,)
+            ).fetchone()
+            if row is None:
+                continue
+            _, entry = _from_row(row)
+            location = (entry.get('segment'), entry.get('offset'), entry.get('length'))
+            if location == tuple(old):
+                entry.update(segment=new[0], offset=new[1], length=new[2])
+                rows.append(_to_row(hash, entry))
+        connection.executemany(_INSERT, rows)
+
+
+def usage(path: str) -> Tuple[int, int]:
+    """Number of entries and their total size in bytes, counting payloads shared by
+    deduplicated entries once."""
+
+    return _connect(path).execute('SELECT entries, bytes FROM usage').fetchone()
+
+
+def evict(
+    path: str,
+    policy: str,
+    max_entries: Optional[int],
+    max_bytes: Optional[int],
+    keep: Collection[str] = (),
+) -> _IndexDict:
+    """Delete entries (sparing `keep`) in the order of eviction `policy` until within
+    `max_entries` / `max_bytes`, returning them by hash.
+
+    Entries are read off the index serving the policy's order, only as far as needed,
+    and deleted in the same transaction.
+    """
+
+    connection = _connect(path)
+    with connection:
+        connection.execute('BEGIN IMMEDIATE')
+        n_entries, n_bytes = connection.execute(
+            'SELECT entries, bytes FROM usage'
+        ).fetchone()
+        evicted = {}
+        shares: Dict[str, int] = {}  # left of the payloads shared by those evicted
+        rows = connection.execute(
+            f'{_SELECT} FROM entries ORDER BY {_EVICTION_ORDERS[policy]}'
+        )
+        for row in rows:
+            if (max_entries is None or n_entries <= max_entries) and (
+                max_bytes is None or n_bytes <= max_bytes
+            ):
+                break
+            hash, entry = _from_row(row)
+            if hash in keep:
+                continue
+            evicted[hash] = entry
+            n_entries -= 1
+            digest = entry.get('content')
+            if digest is not None:
+                if digest not in shares:
+                    shares[digest] = connection.execute(
+                        'SELECT shares FROM contents WHERE digest = ?', (digest,)
+                    ).fetchone()[0]
+                shares[digest] -= 1
+                if shares[digest]:
+                    continue  # still taking up its bytes
+            n_bytes -= entry.get('size', 0)
+        rows.close()
+        connection.execute(
+            'DELETE FROM entries WHERE hash IN (SELECT value FROM json_each(?))',
+            (json.dumps(list(evicted)),),
+        )
+    return evicted
+
+
+def remove_entries(path: str, hashes: Iterable[str]) -> None:
+    connection = _connect(path)
+    with connection:
+        connection.execute('BEGIN IMMEDIATE')
+        connection.executemany(
+            'DELETE FROM entries WHERE hash = ?', [(hash,) for hash in hashes]
+        )
+
+
+def remove_expired(path: str, now: datetime.datetime) -> Dict[str, Dict]:
+    """Delete expired entries, returning them by hash.
+
+    The (read-only) check comes first, so the common case of nothing having expired
+    never takes the write lock.
+    """
+
+    connection = _connect(path)
+    now_timestamp = _timestamp(now)
+    query = 'FROM entries WHERE expires_at < ?'
+    if connection.execute(f'SELECT 1 {query} LIMIT 1', (now_timestamp,)).fetchone():
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            rows = connection.execute(f'{_SELECT} {query}', (now_timestamp,))
+            expired = dict(_from_row(row) for row in rows)
+            connection.execute(f'DELETE {query}', (now_timestamp,))
+        return expired
+    return {}
+
+
+def write_index(path: str, index: _IndexDict) -> None:
+    connection = _connect(path)
+    with connection:
+        connection.execute('BEGIN IMMEDIATE')
+        connection.execute('DELETE FROM entries')
+        connection.executemany(
+            _INSERT, [_to_row(hash, entry) for hash, entry in index.items()]
+        )
+
+
+def forget() -> None:
+    """Close this thread's connections."""
+
+    for _, connection in _local.__dict__.pop('connections', {}).values():
+        connection.close()
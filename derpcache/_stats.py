@@ -0,0 +1,87 @@
+from typing import Callable
+from typing import Dict
+from typing import List
+import logging
+import threading
+
+
+"""
+Cache statistics: counters kept per callable by this process, plus hooks passing
+every increment on to exporters (Prometheus, StatsD, ...).
+"""
+
+
+COUNTERS = (
+    'hits',
+    'memory_hits',
+    'misses',
+    'refreshes',
+    'promotions',
+    'expirations',
+    'evictions',
+    'bytes_read',
+    'bytes_written',
+    'hash_seconds',
+    'index_seconds',
+    'load_seconds',
+    'compute_seconds',
+)
+
+# hook(counter, increment, callable)
+Hook = Callable[[str, float, str], None]
+
+
+logger = logging.getLogger(__name__)
+
+
+_lock = threading.Lock()
+# callable -> counter -> value
+_stats: Dict[str, Dict[str, float]] = {}
+# replaced rather than mutated, so it can be iterated without holding the lock
+_hooks: List[Hook] = []
+
+
+def record(callable: str, **increments: float) -> None:
+    with _lock:
+        stats = _stats.get(callable)
+        if stats is None:
+            stats = _stats[callable] = dict.fromkeys(COUNTERS, 0)
+        for counter, increment in increments.items():
+            stats[counter] += increment
+    for hook in _hooks:
+        try:
+            for counter, increment in increments.items():
+                hook(counter, increment, callable)
+        except Exception:  # exporters must not break caching
+            logger.warning(f'stats hook {hook!r} failed', exc_info=True)
+
+
+def snapshot() -> Dict[str, Dict]:
+    """Copies of the counters of every callable, and their totals."""
+
+    with _lock:
+        callables = {name: dict(stats) for name, stats in _stats.items()}
+    total: Dict[str, float] = dict.fromkeys(COUNTERS, 0)
+    for stats in callables.values():
+        for counter, value in stats.items():
+            total[counter] += value
+    return {'total': total, 'callables': callables}
+
+
+def reset() -> None:
+    with _lock:
+        _stats.clear()
+
+
+def add_hook(hook: Hook) -> None:
+    global _hooks
+    with _lock:
+        _hooks = [*_hooks, hook]
+
+
+def remove_hook(hook: Hook) -> None:
+    global _hooks
+    with _lock:
+        hooks = list(_hooks)
+        hooks.remove(hook)
+        _hooks = hooks
@@ -4,10 +4,20 @@ from typing import Any
 from typing import Dict
 from typing import Tuple
 from typing import Union
+import asyncio
+import concurrent.futures
+import contextlib
+import dataclasses
 import datetime
+import gc
+import json
 import logging
 import os
+import pickle
 import pytest
+import tarfile
+import threading
+import time
 
 
 faker = Faker()
@@ -22,6 +32,7 @@ def _auto_clear_cache():
     yield
     _cache.clear_cache()
     _cache.reset_cache_config()
+    _cache.reset_stats()
 
 
 @pytest.fixture(autouse=True)
@@ -311,7 +322,7 @@ class Test__cache:
 
         assert _cache._DEFAULT_CACHE_DIR.rstrip('/') not in os.listdir('.')
         cache_contents = os.listdir(cache_dir)
-        assert len(cache_contents) == 2
+        assert len(cache_contents) == 3  # the index, the object and the key scheme
         index = _cache.get_index()
         assert len(index) == 1
 
@@ -329,7 +340,7 @@ class Test__cache:
 
         assert _cache._DEFAULT_CACHE_DIR.rstrip('/') not in os.listdir('.')
         cache_contents = os.listdir(cache_dir)
-        assert len(cache_contents) == 2
+        assert len(cache_contents) == 3  # the index, the object and the key scheme
         index = _cache.get_index()
         assert len(index) == 1
 
@@ -398,3 +409,1809 @@ def test__expires_after__clear_expired(caplog, freezer, expires_after_type):
 
 def test__cache_wrapper():
     pass
+
+
+class Test__memory_tier:
+    def test__memory_tier__hit_skips_disk(self, caplog, monkeypatch):
+        _cache.update_cache_config(memory_max_entries=8)
+        result1 = _cache.cache(_func1)
+
+        def _fail(hash):
+            raise AssertionError('disk read on memory hit')
+
+        monkeypatch.setattr(_cache, 'get_by_hash', _fail)
+        result2 = _cache.cache(_func1)
+
+        assert result1 == result2
+        assert len(caplog.messages) == 1
+
+    def test__memory_tier__max_entries(self):
+        _cache.update_cache_config(memory_max_entries=2)
+        for i in range(3):
+            _cache.cache(_func1, i)
+
+        assert len(_cache._memory_tier) == 2
+
+    def test__memory_tier__max_bytes(self):
+        _cache.update_cache_config(memory_max_bytes=1)
+        _cache.cache(_func1)
+
+        assert len(_cache._memory_tier) == 0
+
+    def test__memory_tier__clear_cache(self, caplog):
+        _cache.update_cache_config(memory_max_entries=8)
+        result1 = _cache.cache(_func1)
+        _cache.clear_cache()
+        result2 = _cache.cache(_func1)
+
+        assert result1 != result2
+        assert len(caplog.messages) == 2
+
+    def test__memory_tier__expires_after(self, caplog, freezer):
+        dt = faker.date_time()
+        freezer.move_to(dt)
+        _cache.update_cache_config(memory_max_entries=8)
+        result1 = _cache.cache(_func1, _expires_after=60)
+        freezer.move_to(dt + datetime.timedelta(seconds=61))
+        result2 = _cache.cache(_func1, _expires_after=60)
+
+        assert result1 != result2
+        assert len(caplog.messages) == 2
+
+
+class Test__lookup_path:
+    def test__lookup_path__hit_does_not_write_index(self, monkeypatch):
+        result1 = _cache.cache(_func1, _expires_after=60)
+
+        def _fail(*args, **kwargs):
+            raise AssertionError('index written on cache hit')
+
+        monkeypatch.setattr(_cache, '_write_index', _fail)
+        result2 = _cache.cache(_func1, _expires_after=60)
+        _cache.get_index()
+
+        assert result1 == result2
+
+    def test__lookup_path__skips_scan_before_next_expiry(self, freezer, monkeypatch):
+        dt = faker.date_time()
+        freezer.move_to(dt)
+        _cache.cache(_func1, _expires_after=60)
+        _cache.cache(_func2, _expires_after=120)
+        _cache.get_index()
+
+        scanned = []
+        get_expiry = _cache._get_expiry
+        monkeypatch.setattr(
+            _cache,
+            '_get_expiry',
+            lambda entry: scanned.append(entry) or get_expiry(entry),
+        )
+        freezer.move_to(dt + datetime.timedelta(seconds=30))
+        _cache.cache(_func1, _expires_after=60)
+
+        assert scanned == []
+
+        freezer.move_to(dt + datetime.timedelta(seconds=90))
+        index = _cache.get_index()
+
+        assert len(scanned) == 2
+        assert len(index) == 1
+
+    def test__lookup_path__external_write_is_picked_up(self):
+        _cache.cache(_func1)
+        index = _cache.get_index()
+        with open(_cache._get_index_path(), 'w') as f:
+            f.write('{ }')  # a different size is enough to invalidate the parse
+
+        assert len(index) == 1
+        assert _cache.get_index() == {}
+
+    def test__lookup_path__writes_reparse_same_signature(self):
+        _cache.cache(_func1)
+        (hash,) = _cache.get_index()
+        path = _cache._get_index_path()
+        stat = os.stat(path)
+        with open(path, 'r+') as f:  # same inode, same size, same mtime below
+            text = f.read().replace(hash, hash[::-1])
+            f.seek(0)
+            f.write(text)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        _cache.cache(_func2)
+
+        index = _cache.get_index()
+        assert hash[::-1] in index
+        assert hash not in index
+
+
+class Test__journal_backend:
+    def test__journal_backend__cache(self, caplog, freezer):
+        dt = faker.date_time()
+        freezer.move_to(dt)
+        _cache.update_cache_config(index_backend='journal')
+        result1 = _cache.cache(_func1)
+        result2 = _cache.cache(_func1)
+        _cache.cache(_func2, _expires_after=60)
+
+        assert result1 == result2
+        assert len(caplog.messages) == 2
+        assert 'index.journal' in os.listdir(_cache._get_cache_dir())
+
+        freezer.move_to(dt + datetime.timedelta(seconds=61))
+        index = _cache.get_index()
+
+        expected_entry = {
+            'callable': _cache._describe_callable(_func1),
+            'called_at': dt.isoformat(),
+        }
+        assert list(index.values()) == [expected_entry]
+
+
+class Test__sqlite_backend:
+    def test__sqlite_backend__cache(self, caplog, freezer):
+        dt = faker.date_time()
+        freezer.move_to(dt)
+        _cache.update_cache_config(index_backend='sqlite')
+        result1 = _cache.cache(_func1)
+        result2 = _cache.cache(_func1)
+        _cache.cache(_func2, _expires_after=60)
+
+        assert result1 == result2
+        assert len(caplog.messages) == 2
+        assert len(_cache.get_index()) == 2
+
+        freezer.move_to(dt + datetime.timedelta(seconds=61))
+        result3 = _cache.cache(_func1)
+        index = _cache.get_index()
+
+        expected_entry = {
+            'callable': _cache._describe_callable(_func1),
+            'called_at': dt.isoformat(),
+        }
+        assert result3 == result1
+        assert list(index.values()) == [expected_entry]
+        assert len(caplog.messages) == 2
+
+    def test__sqlite_backend__clear_cache(self, caplog):
+        _cache.update_cache_config(index_backend='sqlite')
+        result1 = _cache.cache(_func1)
+        _cache.clear_cache()
+        result2 = _cache.cache(_func1)
+
+        assert result1 != result2
+        assert len(_cache.get_index()) == 1
+
+
+def _identity(x: Any) -> Any:
+    return x
+
+
+class Test__concurrency:
+    @pytest.mark.parametrize('index_backend', ['json', 'journal', 'sqlite'])
+    def test__concurrency__threads(self, index_backend):
+        from concurrent.futures import ThreadPoolExecutor
+
+        _cache.update_cache_config(index_backend=index_backend)
+        with ThreadPoolExecutor(8) as pool:
+            results = list(pool.map(lambda x: _cache.cache(_identity, x), range(64)))
+
+        assert results == list(range(64))
+        index = _cache.get_index()
+        assert len(index) == 64
+        assert sorted(_cache.get_by_hash(hash) for hash in index) == list(range(64))
+
+    @pytest.mark.parametrize('index_backend', ['json', 'journal', 'sqlite'])
+    def test__concurrency__threads_evicting(self, index_backend):
+        from concurrent.futures import ThreadPoolExecutor
+
+        _cache.update_cache_config(index_backend=index_backend, max_entries=16)
+        with ThreadPoolExecutor(8) as pool:
+            results = list(pool.map(lambda x: _cache.cache(_identity, x), range(400)))
+
+        assert results == list(range(400))
+        assert len(_cache.get_index()) <= 16
+
+    @pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires fork')
+    def test__concurrency__processes(self):
+        import multiprocessing
+
+        with multiprocessing.get_context('fork').Pool(4) as pool:
+            results = pool.starmap(_cache.cache, [(_identity, x) for x in range(32)])
+
+        assert results == list(range(32))
+        index = _cache.get_index()
+        assert len(index) == 32
+        assert sorted(_cache.get_by_hash(hash) for hash in index) == list(range(32))
+        assert not [p for p in os.listdir(_cache._get_cache_dir()) if 'tmp' in p]
+
+
+def _slow_logged_call(path: str) -> int:
+    import time
+
+    with open(path, 'a') as f:
+        f.write('.')
+    time.sleep(0.2)
+    return os.getpid()
+
+
+class Test__single_flight:
+    def test__single_flight__threads(self, tmp_path):
+        from concurrent.futures import ThreadPoolExecutor
+
+        path = str(tmp_path / 'calls')
+        with ThreadPoolExecutor(16) as pool:
+            results = list(
+                pool.map(lambda _: _cache.cache(_slow_logged_call, path), range(16))
+            )
+
+        assert len(set(results)) == 1
+        with open(path) as f:
+            assert f.read() == '.'
+
+    @pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires fork')
+    def test__single_flight__processes(self, tmp_path):
+        import multiprocessing
+
+        path = str(tmp_path / 'calls')
+        with multiprocessing.get_context('fork').Pool(4) as pool:
+            results = pool.starmap(
+                _cache.cache, [(_slow_logged_call, path) for _ in range(8)]
+            )
+
+        assert len(set(results)) == 1
+        with open(path) as f:
+            assert f.read() == '.'
+        assert not [p for p in os.listdir(_cache._get_cache_dir()) if 'lease' in p]
+
+    def test__single_flight__stale_lease(self):
+        _cache.update_cache_config(lease_timeout=1)
+        _cache._init_cache()
+        hash = _cache._hash_args(_cache._describe_callable(_identity), 1)
+        lease_path = _cache._get_cache_path(hash) + '.lease'
+        with open(lease_path, 'w') as f:
+            f.write('12345')
+        os.utime(lease_path, (0, 0))  # crashed long ago
+
+        assert _cache.cache(_identity, 1) == 1
+        assert not os.path.exists(lease_path)
+
+
+class Test__hash_engine:
+    def test__hash_engine__legacy(self):
+        _cache.update_cache_config(hash_engine='legacy')
+        _cache.cache(_func1)
+        ((hash, entry),) = _cache._read_index().items()
+
+        assert len(hash) == 8
+        assert 'key_check' not in entry
+
+    def test__hash_engine__hash_size(self):
+        _cache.update_cache_config(hash_size=8)
+        _cache.cache(_func1)
+        ((hash, entry),) = _cache._read_index().items()
+
+        assert len(hash) == 16
+        assert 'key_check' in entry
+        assert _cache.get_index()[hash] == {
+            'callable': entry['callable'],
+            'called_at': entry['called_at'],
+        }
+
+    @pytest.mark.parametrize('hash_size', [0, -1, 3, 65, 2.5, True])
+    def test__hash_engine__invalid_hash_size(self, hash_size):
+        with pytest.raises(ValueError, match='hash_size'):
+            _cache.update_cache_config(hash_size=hash_size)
+        with pytest.raises(ValueError, match='hash_size'):
+            _cache.update_cache_config(tiers=[{'cache_dir': 'a', 'hash_size': 0}])
+
+    def test__hash_engine__changed(self, caplog):
+        _cache.cache(_func1)
+        _cache.update_cache_config(hash_engine='sha256')
+        with caplog.at_level(logging.WARNING):
+            _cache.cache(_func1)
+            _cache.cache(_func1)
+
+        assert len([m for m in caplog.messages if 'keyed with' in m]) == 1
+        with open(_cache._get_cache_path(_cache._CACHE_KEYS_FILE)) as f:
+            assert json.load(f) == {'hash_engine': 'sha256', 'hash_size': 16}
+
+    def test__hash_engine__changed_from_unrecorded_legacy(self, caplog):
+        _cache.update_cache_config(hash_engine='legacy')
+        _cache.cache(_func1)
+        os.remove(_cache._get_cache_path(_cache._CACHE_KEYS_FILE))
+        _cache._checked_key_schemes.clear()  # i.e. in a process of its own
+        _cache.update_cache_config(hash_engine='blake2b')
+        with caplog.at_level(logging.WARNING):
+            _cache.cache(_func1)
+
+        assert "hash_engine 'legacy'" in caplog.text
+
+    def test__hash_engine__collision(self, caplog):
+        result1 = _cache.cache(_func1)
+        index = _cache._read_index()
+        ((hash, entry),) = index.items()
+        _cache._write_index({hash: {**entry, 'key_check': 'another call'}})
+
+        with caplog.at_level(logging.WARNING):
+            result2 = _cache.cache(_func1)
+
+        assert result1 != result2
+        assert 'collides' in caplog.text
+        assert _cache.get_by_hash(hash) == result1
+
+
+class Test__mmap_threshold:
+    def test__mmap_threshold__memory_mapped_arrays(self):
+        numpy = pytest.importorskip('numpy')
+        _cache.update_cache_config(mmap_threshold=1024)
+        array = numpy.arange(10_000, dtype='float64')
+
+        result1 = _cache.cache(_identity, {'big': array, 'small': array[:10].copy()})
+        result2 = _cache.cache(_identity, {'big': array, 'small': array[:10].copy()})
+
+        assert result1['big'].flags.writeable
+        assert not result2['big'].flags.writeable
+        assert result2['small'].flags.writeable
+        numpy.testing.assert_array_equal(result2['big'], array)
+        numpy.testing.assert_array_equal(result2['small'], array[:10])
+        buffers = [p for p in os.listdir(_cache._get_cache_dir()) if p.endswith('.buf')]
+        assert len(buffers) == 1
+
+    def test__mmap_threshold__rewrites_leave_readers_consistent(self):
+        numpy = pytest.importorskip('numpy')
+        _cache.update_cache_config(mmap_threshold=1024)
+        _cache.cache(_identity, numpy.ones(10_000))
+        (hash,) = _cache.get_index()
+        path = _cache._find_object_path(hash)
+        old = _cache._load_object(path, 'pickle')  # mapped before the rewrite
+        with open(path, 'rb') as f:  # opened before the rewrite, mapped after
+            token = _cache._read_buffers_token(f)
+            _cache._write_object_by_hash(hash, numpy.zeros(10_000))
+            with pytest.raises(FileNotFoundError):  # rather than the new buffers
+                pickle.load(f, buffers=_cache._iter_buffers(path, token))
+
+        numpy.testing.assert_array_equal(old, numpy.ones(10_000))
+        numpy.testing.assert_array_equal(_cache.get_by_hash(hash), numpy.zeros(10_000))
+        buffers = [p for p in os.listdir(_cache._get_cache_dir()) if p.endswith('.buf')]
+        assert len(buffers) == 1
+
+    def test__mmap_threshold__removed_with_object(self, freezer):
+        numpy = pytest.importorskip('numpy')
+        dt = faker.date_time()
+        freezer.move_to(dt)
+        _cache.update_cache_config(mmap_threshold=1024)
+        _cache.cache(_identity, numpy.ones(10_000), _expires_after=60)
+        freezer.move_to(dt + datetime.timedelta(seconds=61))
+        _cache.get_index()
+
+        assert sorted(os.listdir(_cache._get_cache_dir())) == [
+            'index.json',
+            'keys.json',
+        ]
+
+
+class Test__serializers:
+    @pytest.mark.parametrize('serializer', ['gzip', 'json'])
+    def test__serializers__cache(self, caplog, serializer):
+        args = _randomize_args()
+        result1 = _cache.cache(_func1, *args, _serializer=serializer)
+        result2 = _cache.cache(_func1, *args)
+        ((hash, entry),) = _cache._read_index().items()
+
+        assert result1 == result2
+        assert len(caplog.messages) == 1
+        assert entry['serializer'] == serializer
+        assert _cache.get_by_hash(hash) == result1
+        assert 'serializer' not in _cache.get_index()[hash]
+
+    def test__serializers__config_default(self):
+        _cache.update_cache_config(serializer='lzma')
+        result = _cache.cache(_func1)
+        ((hash, entry),) = _cache._read_index().items()
+
+        assert entry['serializer'] == 'lzma'
+        assert _cache.get_by_hash(hash) == result
+
+    def test__serializers__unknown(self, caplog):
+        with pytest.raises(ValueError):
+            _cache.cache(_func1, _serializer='nope')
+
+        assert len(caplog.messages) == 0
+
+    def test__serializers__register(self):
+        def dump(value, f):
+            f.write(value[::-1].encode())
+
+        def load(f):
+            return f.read().decode()[::-1]
+
+        _cache.register_serializer('reversed', dump, load)
+
+        @_cache.cache_wrapper(_serializer='reversed')
+        def _upper(x):
+            return x.upper()
+
+        assert _upper('abc') == 'ABC'
+        ((hash, _),) = _cache._read_index().items()
+        with open(_cache._get_cache_path(hash), 'rb') as f:
+            assert f.read() == b'CBA'
+        assert _upper('abc') == 'ABC'
+
+
+def _sleep_and_return(seconds: float) -> float:
+    import time
+
+    time.sleep(seconds)
+    return seconds
+
+
+class Test__eviction:
+    @staticmethod
+    def _hashes(f, *args_list):
+        return [_cache._hash_args(_cache._describe_callable(f), x) for x in args_list]
+
+    def test__eviction__lru(self, freezer):
+        freezer.move_to(faker.date_time())
+        _cache.update_cache_config(max_entries=2)
+        for x in [0, 1, 0, 2]:  # the hit on 0 makes 1 the least recently used
+            _cache.cache(_identity, x)
+            freezer.tick()
+        hash0, hash1, hash2 = self._hashes(_identity, 0, 1, 2)
+
+        assert set(_cache.get_index()) == {hash0, hash2}
+        assert not os.path.exists(_cache._get_cache_path(hash1))
+
+    @pytest.mark.parametrize('index_backend', ['json', 'journal', 'sqlite'])
+    def test__eviction__lfu(self, freezer, index_backend):
+        freezer.move_to(faker.date_time())
+        _cache.update_cache_config(
+            index_backend=index_backend,
+            max_entries=2,
+            eviction_policy='lfu',
+        )
+        for x in [0, 0, 0, 1, 2]:
+            _cache.cache(_identity, x)
+            freezer.tick()
+        hash0, _, hash2 = self._hashes(_identity, 0, 1, 2)
+
+        assert set(_cache.get_index()) == {hash0, hash2}
+
+    @pytest.mark.parametrize('index_backend', ['json', 'journal', 'sqlite'])
+    def test__eviction__cost(self, index_backend):
+        _cache.update_cache_config(
+            index_backend=index_backend,
+            max_entries=2,
+            eviction_policy='cost',
+        )
+        for seconds in [0.05, 0, 0.001]:
+            _cache.cache(_sleep_and_return, seconds)
+        slow, _, last = self._hashes(_sleep_and_return, 0.05, 0, 0.001)
+
+        assert set(_cache.get_index()) == {slow, last}
+
+    @pytest.mark.parametrize('index_backend', ['json', 'journal', 'sqlite'])
+    def test__eviction__max_bytes(self, index_backend):
+        _cache.update_cache_config(index_backend=index_backend, max_bytes=2500)
+        for x in range(3):
+            _cache.cache(_identity, bytes([x]) * 1000)
+        index = _cache._read_index()
+
+        assert len(index) == 2
+        assert sum(entry['size'] for entry in index.values()) <= 2500
+
+    @pytest.mark.parametrize('index_backend', ['json', 'journal'])
+    def test__eviction__usage_carried_over(self, index_backend):
+        _cache.update_cache_config(index_backend=index_backend, max_entries=3)
+        for x in range(6):
+            _cache.cache(_identity, bytes([x]) * (x + 1))
+        _cache.cache(_identity, bytes([5]) * 6)  # a hit
+        index = _cache._read_index()
+        known, *usage, _ = _cache._usages[_cache._get_index_path()]
+
+        assert known is index  # never summed up again
+        assert usage == [3, sum(entry['size'] for entry in index.values())]
+
+    def test__eviction__sqlite_never_reads_index(self, monkeypatch):
+        def _fail(*args, **kwargs):
+            raise AssertionError('whole index read')
+
+        _cache.update_cache_config(index_backend='sqlite', max_entries=2)
+        monkeypatch.setattr(_cache._sqlite, 'read_index', _fail)
+        for x in range(5):
+            _cache.cache(_identity, x)
+
+        assert _cache._get_usage()[0] == 2
+        assert _cache.cache(_identity, 4) == 4
+
+    def test__eviction__unknown_policy(self):
+        _cache.update_cache_config(max_entries=1, eviction_policy='nope')
+        _cache.cache(_identity, 0)
+        with pytest.raises(ValueError):
+            _cache.cache(_identity, 1)
+
+    @pytest.mark.parametrize('index_backend', ['json', 'journal', 'sqlite'])
+    def test__eviction__accesses_recorded(self, freezer, index_backend):
+        dt = faker.date_time()
+        freezer.move_to(dt)
+        _cache.update_cache_config(index_backend=index_backend)
+        _cache.cache(_identity, 0)
+        freezer.tick()
+        _cache.cache(_identity, 0)
+        _cache.cache(_identity, 0)
+        (hash,) = self._hashes(_identity, 0)
+
+        assert 'hits' not in _cache._peek_entry(hash)  # hits alone never write
+        _cache._flush_accesses()
+        entry = _cache._peek_entry(hash)
+        assert entry['hits'] == 2
+        assert entry['last_accessed'] > entry['called_at']
+        assert 'hits' not in _cache.get_index()[hash]
+
+
+async def _async_func1(*args, **kwargs) -> _RandomValueUnion:
+    await asyncio.sleep(0.01)
+    return _func1(*args, **kwargs)
+
+
+class Test__async:
+    def test__async__cache_async(self, caplog):
+        async def main():
+            return [await _cache.cache_async(_async_func1, 1) for _ in range(2)]
+
+        result1, result2 = asyncio.run(main())
+
+        assert result1 == result2
+        assert len(caplog.messages) == 1
+        assert not asyncio.iscoroutine(result1)
+
+    def test__async__cache_wrapper(self, caplog):
+        @_cache.cache_wrapper(_annotation='async')
+        async def _wrapped(x):
+            return await _async_func1(x)
+
+        async def main():
+            return await _wrapped(1), await _wrapped(1)
+
+        result1, result2 = asyncio.run(main())
+        ((_, entry),) = _cache.get_index().items()
+
+        assert result1 == result2
+        assert len(caplog.messages) == 1
+        assert entry['annotation'] == 'async'
+
+    def test__async__flushes_accesses_off_the_loop(self, monkeypatch):
+        threads = []
+        write_entries_to_index = _cache._write_entries_to_index
+
+        def _write(entries, accesses=None):
+            threads.append(threading.current_thread())
+            write_entries_to_index(entries, accesses)
+
+        async def main():
+            await _cache.cache_async(_async_func1, 1)
+            monkeypatch.setattr(_cache, '_ACCESS_FLUSH_SIZE', 1)
+            monkeypatch.setattr(_cache, '_write_entries_to_index', _write)
+            await _cache.cache_async(_async_func1, 1)
+            await asyncio.gather(*_cache._flush_tasks)
+
+        asyncio.run(main())
+
+        (hash,) = _cache.get_index()
+
+        assert threads and threading.main_thread() not in threads
+        assert _cache._peek_entry(hash)['hits'] == 1
+
+    def test__async__concurrent_awaits_deduplicated(self, caplog):
+        async def main():
+            return await asyncio.gather(
+                *(_cache.cache_async(_async_func1, 1) for _ in range(16))
+            )
+
+        results = asyncio.run(main())
+
+        assert len(set(results)) == 1
+        assert len(caplog.messages) == 1
+
+    def test__async__exception_shared_and_not_cached(self):
+        calls = []
+
+        async def _fail():
+            calls.append(None)
+            await asyncio.sleep(0.01)
+            raise KeyError('boom')
+
+        async def main():
+            return await asyncio.gather(
+                *(_cache.cache_async(_fail) for _ in range(4)),
+                return_exceptions=True,
+            )
+
+        results = asyncio.run(main())
+
+        assert all(isinstance(result, KeyError) for result in results)
+        assert len(calls) == 1
+        assert _cache.get_index() == {}
+
+    def test__async__io_off_event_loop(self, monkeypatch):
+        loop_threads = []
+        read_entry = _cache._read_entry
+
+        def _read_entry(hash, name):
+            loop_threads.append(threading.current_thread())
+            return read_entry(hash, name)
+
+        monkeypatch.setattr(_cache, '_read_entry', _read_entry)
+
+        async def main():
+            await _cache.cache_async(_async_func1, 1)
+            await _cache.cache_async(_async_func1, 1)
+
+        asyncio.run(main())
+
+        assert loop_threads
+        assert threading.main_thread() not in loop_threads
+
+    def test__async__lease_released_off_event_loop(self, monkeypatch):
+        threads = []
+        lease = _cache._locking.lease
+
+        @contextlib.contextmanager
+        def _lease(path, timeout):
+            with lease(path, timeout):
+                threads.append(threading.current_thread())
+                yield
+                threads.append(threading.current_thread())
+
+        monkeypatch.setattr(_cache._locking, 'lease', _lease)
+        asyncio.run(_cache.cache_async(_async_func1, 1))
+
+        assert len(threads) == 2
+        assert threading.main_thread() not in threads
+
+
+class Test__cache_map:
+    def test__cache_map__matches_cache(self, caplog):
+        _cache.cache(_func1, 1)
+        results = list(_cache.cache_map(_func1, [0, 1, 2, 1]))
+
+        assert results == [_cache.cache(_func1, x) for x in [0, 1, 2, 1]]
+        assert results[1] == results[3]
+        assert len(caplog.messages) == 3
+        assert len(_cache.get_index()) == 3
+
+    def test__cache_map__multiple_iterables(self):
+        results = list(_cache.cache_map(pow, [2, 3], [3, 2], _annotation='pow'))
+
+        assert results == [8, 9]
+        assert {e['annotation'] for e in _cache.get_index().values()} == {'pow'}
+
+    def test__cache_map__single_index_write(self, monkeypatch):
+        writes = []
+        write_entries = _cache._write_entries_to_index
+
+        def _write_entries_to_index(entries, accesses=None):
+            writes.append(len(entries))
+            return write_entries(entries, accesses)
+
+        monkeypatch.setattr(_cache, '_write_entries_to_index', _write_entries_to_index)
+        list(_cache.cache_map(_identity, range(20)))
+
+        assert writes == [20]
+
+    def test__cache_map__processes(self):
+        results = list(_cache.cache_map(_identity, range(8), _executor='process'))
+
+        assert results == list(range(8))
+        assert list(_cache.cache_map(_identity, range(8))) == results
+
+    def test__cache_map__executor(self):
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            results = list(_cache.cache_map(_identity, range(4), _executor=executor))
+            assert executor.submit(_identity, 1).result() == 1  # still usable
+
+        assert results == list(range(4))
+
+    def test__cache_map__partially_consumed(self):
+        results = _cache.cache_map(_identity, range(4))
+        assert next(results) == 0
+        results.close()
+
+        assert len(_cache.get_index()) == 1
+
+    def test__cache_map__nothing_submitted_until_iterated(self):
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            calls = []
+            results = _cache.cache_map(calls.append, range(4), _executor=executor)
+            del results
+            executor.submit(_identity, 1).result()  # after anything submitted before
+
+        assert calls == []
+
+    def test__cache_map__unknown_executor(self):
+        with pytest.raises(ValueError):
+            _cache.cache_map(_identity, range(4), _executor='nope')
+
+
+class Test__cache_wrapper_keys:
+    def test__cache_wrapper_keys__call_styles(self, caplog):
+        @_cache.cache_wrapper()
+        def _wrapped(a, b=2, *args, c=3, **kwargs):
+            return _func1(a, b, *args, c=c, **kwargs)
+
+        result = _wrapped(1, 2)
+
+        assert _wrapped(1) == result
+        assert _wrapped(1, b=2) == result
+        assert _wrapped(a=1, b=2, c=3) == result
+        assert len(caplog.messages) == 1
+        assert _wrapped(1, 2, 3) != result
+        assert _wrapped(1, d=4) != result
+        assert len(caplog.messages) == 3
+
+    def test__cache_wrapper_keys__exclude(self, caplog):
+        @_cache.cache_wrapper(_exclude=['logger'])
+        def _wrapped(x, logger=None):
+            return _func1(x)
+
+        assert _wrapped(1, logger=object()) == _wrapped(1, logger=object())
+        assert len(caplog.messages) == 1
+
+    def test__cache_wrapper_keys__key_args(self, caplog):
+        @_cache.cache_wrapper(_key_args={'path': str.lower})
+        def _wrapped(path):
+            return _func1(path)
+
+        assert _wrapped('A.txt') == _wrapped('a.TXT')
+        assert len(caplog.messages) == 1
+
+    def test__cache_wrapper_keys__unknown_argument(self):
+        with pytest.raises(ValueError):
+
+            @_cache.cache_wrapper(_exclude=['nope'])
+            def _wrapped(x):
+                return x
+
+    def test__cache_wrapper_keys__keyed_and_excluded(self):
+        with pytest.raises(ValueError, match='both keyed and excluded'):
+
+            @_cache.cache_wrapper(_key_args={'x': str}, _exclude=['x'])
+            def _wrapped(x):
+                return x
+
+    def test__cache_wrapper_keys__describes_callable_once(self, monkeypatch):
+        @_cache.cache_wrapper()
+        def _wrapped(x):
+            return x
+
+        assert _wrapped(1) == 1
+
+        def _fail(f):
+            raise AssertionError('callable described per call')
+
+        monkeypatch.setattr(_cache, '_describe_callable', _fail)
+
+        assert _wrapped(1) == 1
+
+    def test__cache_wrapper_keys__async(self, caplog):
+        @_cache.cache_wrapper(_exclude=['session'])
+        async def _wrapped(x, session=None):
+            return await _async_func1(x)
+
+        async def main():
+            return await _wrapped(1, session=object()), await _wrapped(x=1)
+
+        result1, result2 = asyncio.run(main())
+
+        assert result1 == result2
+        assert len(caplog.messages) == 1
+
+
+@_cache.cache_wrapper()
+def _wrapped_identity(x: Any) -> Any:
+    return x
+
+
+class _Service:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.client = object()  # unstable `str()`
+
+    @_cache.cache_wrapper(_instance_key=lambda self: self.name)
+    def fetch(self, x):
+        return _func1(self.name, x)
+
+
+class _KeyedService:
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __cache_key__(self):
+        return self.name
+
+    @_cache.cache_wrapper()
+    def fetch(self, x):
+        return _func1(self.name, x)
+
+
+@dataclasses.dataclass
+class _DataService:
+    name: str
+
+    @_cache.cache_wrapper()
+    def fetch(self, x):
+        return _func1(self.name, x)
+
+
+class _ClassService:
+    @classmethod
+    @_cache.cache_wrapper()
+    def fetch(cls, x):
+        return _func1(cls.__name__, x)
+
+
+class Test__methods:
+    def test__methods__instance_key(self, caplog):
+        result = _Service('a').fetch(1)
+
+        assert _Service('a').fetch(1) == result
+        assert _Service('a').fetch(x=1) == result
+        assert len(caplog.messages) == 1
+        _Service('b').fetch(1)
+        assert len(caplog.messages) == 2
+
+    def test__methods__cache_key(self, caplog):
+        result = _KeyedService('a').fetch(1)
+
+        assert _KeyedService('a').fetch(1) == result
+        assert len(caplog.messages) == 1
+
+    def test__methods__not_keyed_by_value(self, caplog):
+        _DataService('a').fetch(1)
+        _DataService('a').fetch(1)
+
+        assert not os.path.exists(_cache._get_index_path())
+        assert len([m for m in caplog.messages if 'stable identity' in m]) == 1
+
+    def test__methods__classmethod(self, caplog):
+        result = _ClassService.fetch(1)
+
+        assert _ClassService.fetch(1) == result
+        assert _ClassService().fetch(1) == result
+        assert len(caplog.messages) == 1
+
+    def test__methods__no_identity(self, caplog):
+        class _Unkeyed:
+            @_cache.cache_wrapper()
+            def fetch(self, x):
+                return _func1(x)
+
+        _Unkeyed().fetch(1)
+        _Unkeyed().fetch(1)
+
+        assert not os.path.exists(_cache._get_index_path())
+        assert len([m for m in caplog.messages if 'stable identity' in m]) == 1
+
+    def test__methods__invalidate(self, caplog):
+        a, b = _Service('a'), _Service('b')
+        a.fetch(1)
+        a.fetch(2)
+        b.fetch(1)
+
+        assert len(a.fetch.invalidate()) == 2
+        assert len(_cache.get_index()) == 1
+        b.fetch(1)
+        assert len(caplog.messages) == 3
+        assert len(_Service.fetch.invalidate()) == 1
+        assert _cache.get_index() == {}
+
+    def test__methods__called_through_class(self, caplog):
+        a = _Service('a')
+        result = _Service.fetch(a, 1)
+
+        assert a.fetch(1) == result
+        assert len(caplog.messages) == 1
+        assert len(a.fetch.invalidate()) == 1
+        assert _cache.get_index() == {}
+
+    def test__methods__wraps(self):
+        fetch = _Service('a').fetch
+
+        assert fetch.__name__ == 'fetch'
+        assert fetch.__qualname__ == '_Service.fetch'
+        assert fetch.__wrapped__ is _Service.fetch.__wrapped__
+
+    def test__methods__pickle(self):
+        import pickle
+
+        assert pickle.loads(pickle.dumps(_wrapped_identity)) is _wrapped_identity
+        assert _wrapped_identity(1) == 1
+
+
+class Test__shard_depth:
+    def test__shard_depth__layout(self):
+        _cache.update_cache_config(shard_depth=2)
+        result = _cache.cache(_func1)
+        ((hash, _),) = _cache._read_index().items()
+        path = os.path.join(_cache._get_cache_dir(), hash[:2], hash[2:4], hash)
+
+        assert os.path.exists(path)
+        assert _cache.get_by_hash(hash) == result
+        assert _cache.cache(_func1) == result
+
+    def test__shard_depth__reads_flat_cache(self, caplog):
+        result = _cache.cache(_func1)
+        ((hash, _),) = _cache._read_index().items()
+        _cache.update_cache_config(shard_depth=2)
+
+        assert _cache.get_by_hash(hash) == result
+        assert _cache.cache(_func1) == result
+        assert len(caplog.messages) == 1
+
+    def test__shard_depth__removes_objects(self, freezer):
+        freezer.move_to(faker.date_time())
+        _cache.update_cache_config(shard_depth=1)
+        _cache.cache(_func1, _expires_after=60)
+        ((hash, _),) = _cache._read_index().items()
+        freezer.tick(61)
+        _cache.get_index()
+
+        assert not os.path.exists(_cache._get_object_path(hash))
+
+    def test__shard_depth__migrate(self, caplog):
+        numpy = pytest.importorskip('numpy')
+        _cache.update_cache_config(mmap_threshold=1024)
+        results = [_cache.cache(_func1, x) for x in range(3)]
+        array = _cache.cache(_identity, numpy.arange(1000))
+        _cache.update_cache_config(shard_depth=2)
+
+        assert _cache.migrate_cache_layout() == 4
+        assert _cache.migrate_cache_layout() == 0
+        hashes = list(_cache._read_index())
+        assert all(os.path.exists(_cache._get_object_path(h)) for h in hashes)
+        assert not any(os.path.exists(_cache._get_cache_path(h)) for h in hashes)
+        assert [_cache.cache(_func1, x) for x in range(3)] == results
+        assert (_cache.cache(_identity, numpy.arange(1000)) == array).all()
+
+        assert _cache.migrate_cache_layout(shard_depth=0) == 4
+        assert not [
+            name
+            for name in os.listdir(_cache._get_cache_dir())
+            if os.path.isdir(_cache._get_cache_path(name))
+        ]
+        assert len(caplog.messages) == 3
+
+    def test__shard_depth__invalid(self):
+        _cache.update_cache_config(shard_depth=9)
+        with pytest.raises(ValueError):
+            _cache.cache(_func1)
+
+
+class Test__pack_threshold:
+    def test__pack_threshold__small_values_packed(self, caplog):
+        _cache.update_cache_config(pack_threshold=1024)
+        results = [_cache.cache(_func1, x) for x in range(10)]
+        large = _cache.cache(_identity, b'x' * 4096)
+        index = _cache._read_index()
+        packed = [hash for hash, entry in index.items() if 'segment' in entry]
+
+        assert len(packed) == 10
+        assert sorted(os.listdir(_cache._get_cache_dir())) == sorted(
+            ['index.json', 'keys.json', 'packs', *(set(index) - set(packed))]
+        )
+        assert [_cache.cache(_func1, x) for x in range(10)] == results
+        assert _cache.cache(_identity, b'x' * 4096) == large
+        assert _cache.get_by_hash(packed[0]) in results
+        assert len(caplog.messages) == 10
+        assert 'segment' not in _cache.get_index()[packed[0]]
+
+    def test__pack_threshold__serializer(self):
+        _cache.update_cache_config(pack_threshold=1024)
+        result = _cache.cache(_identity, list(range(10)), _serializer='gzip')
+        ((hash, entry),) = _cache._read_index().items()
+
+        assert 'segment' in entry
+        assert _cache.get_by_hash(hash) == result
+
+    @pytest.mark.parametrize('index_backend', ['json', 'sqlite'])
+    def test__pack_threshold__compacted_on_eviction(self, index_backend):
+        _cache.update_cache_config(
+            index_backend=index_backend,
+            pack_threshold=1024,
+            max_entries=2,
+        )
+        for x in range(3):
+            _cache.cache(_identity, str(x) * 100)
+        segments = {e['segment'] for e in _cache._read_index().values()}
+        _cache._packs.forget()  # seal the segment
+        _cache.cache(_identity, '3' * 100)  # evicts, leaving 2 of 4 records live
+        index = _cache._read_index()
+
+        assert len(index) == 2
+        assert not any(e['segment'] in segments for e in index.values())
+        assert not any(
+            os.path.exists(os.path.join(_cache._get_pack_dir(), s)) for s in segments
+        )
+        assert sorted(_cache.cache(_identity, str(x) * 100) for x in (2, 3)) == [
+            '2' * 100,
+            '3' * 100,
+        ]
+
+    def test__pack_threshold__compacted_only_once_worth_it(self, monkeypatch):
+        _cache.update_cache_config(pack_threshold=1024)
+        for x in range(4):
+            _cache.cache(_identity, str(x) * 100)
+        _cache._packs.forget()  # seal the segment
+        compactions = []
+        compact = _cache._packs.compact
+        monkeypatch.setattr(
+            _cache._packs,
+            'compact',
+            lambda *args: compactions.append(None) or compact(*args),
+        )
+        _cache.update_cache_config(max_entries=4)
+        for x in range(4, 7):
+            _cache.cache(_identity, str(x) * 100)  # each evicting a sealed record
+
+        assert len(compactions) == 1  # once 3 of its 4 records were dead
+
+
+def _wait_for_refreshes() -> None:
+    for _ in range(500):  # polled, as frozen clocks never reach a deadline
+        if not _cache._refreshing:
+            return
+        time.sleep(0.01)
+    assert not _cache._refreshing
+
+
+class Test__stale_ttl:
+    @pytest.mark.parametrize('index_backend', ['json', 'journal', 'sqlite'])
+    def test__stale_ttl__serves_stale_then_refreshes(self, freezer, index_backend):
+        _cache.update_cache_config(index_backend=index_backend)
+        calls = []
+
+        def _count():
+            calls.append(None)
+            return len(calls)
+
+        dt_called = faker.date_time()
+        freezer.move_to(dt_called)
+        options = dict(_expires_after=60, _stale_ttl=600)
+        assert _cache.cache(_count, **options) == 1
+
+        freezer.move_to(dt_called + datetime.timedelta(seconds=120))
+        assert _cache.cache(_count, **options) == 1  # stale, without waiting
+        _wait_for_refreshes()
+
+        assert _cache.cache(_count, **options) == 2
+        assert len(calls) == 2
+        ((_, entry),) = _cache.get_index().items()
+        assert (
+            entry['called_at']
+            == (dt_called + datetime.timedelta(seconds=120)).isoformat()
+        )
+        assert 'stale_ttl' not in entry
+
+    def test__stale_ttl__recomputed_past_window(self, freezer):
+        calls = []
+
+        def _count():
+            calls.append(None)
+            return len(calls)
+
+        dt_called = faker.date_time()
+        freezer.move_to(dt_called)
+        options = dict(_expires_after=60, _stale_ttl=60)
+        _cache.cache(_count, **options)
+        freezer.move_to(dt_called + datetime.timedelta(seconds=121))
+
+        assert _cache.cache(_count, **options) == 2
+        assert not _cache._refreshing
+
+    def test__stale_ttl__memory_tier(self, freezer):
+        _cache.update_cache_config(memory_max_entries=10)
+        calls = []
+
+        def _count():
+            calls.append(None)
+            return len(calls)
+
+        dt_called = faker.date_time()
+        freezer.move_to(dt_called)
+        options = dict(_expires_after=60, _stale_ttl=600)
+        _cache.cache(_count, **options)
+        freezer.move_to(dt_called + datetime.timedelta(seconds=120))
+
+        assert _cache.cache(_count, **options) == 1
+        _wait_for_refreshes()
+        assert _cache.cache(_count, **options) == 2
+
+    def test__stale_ttl__failed_refresh_keeps_stale(self, caplog, freezer):
+        calls = []
+
+        def _flaky():
+            calls.append(None)
+            if len(calls) > 1:
+                raise KeyError('boom')
+            return len(calls)
+
+        dt_called = faker.date_time()
+        freezer.move_to(dt_called)
+        options = dict(_expires_after=60, _stale_ttl=600)
+        _cache.cache(_flaky, **options)
+        freezer.move_to(dt_called + datetime.timedelta(seconds=120))
+
+        assert _cache.cache(_flaky, **options) == 1
+        _wait_for_refreshes()
+
+        assert _cache.cache(_flaky, **options) == 1
+        assert any('refreshing cache entry' in m for m in caplog.messages)
+
+    def test__refresh_ahead(self, freezer):
+        calls = []
+
+        @_cache.cache_wrapper(_expires_after=60, _refresh_ahead=10)
+        def _count():
+            calls.append(None)
+            return len(calls)
+
+        dt_called = faker.date_time()
+        freezer.move_to(dt_called)
+        _count()
+        freezer.move_to(dt_called + datetime.timedelta(seconds=45))
+        assert _count() == 1
+        assert not _cache._refreshing
+
+        freezer.move_to(dt_called + datetime.timedelta(seconds=55))
+        assert _count() == 1  # refreshed ahead of expiry, without waiting
+        _wait_for_refreshes()
+        freezer.move_to(dt_called + datetime.timedelta(seconds=65))
+
+        assert _count() == 2
+        assert len(calls) == 2
+
+    def test__stale_ttl__async(self, freezer):
+        calls = []
+
+        async def _count():
+            calls.append(None)
+            return len(calls)
+
+        dt_called = faker.date_time()
+        freezer.move_to(dt_called)
+        options = dict(_expires_after=60, _stale_ttl=600)
+
+        async def main():
+            first = await _cache.cache_async(_count, **options)
+            freezer.move_to(dt_called + datetime.timedelta(seconds=120))
+            stale = await _cache.cache_async(_count, **options)
+            await asyncio.gather(*_cache._refresh_tasks)
+            return first, stale, await _cache.cache_async(_count, **options)
+
+        assert asyncio.run(main()) == (1, 1, 2)
+
+
+class Test__stats:
+    def test__stats__hits_and_misses(self):
+        name = _cache._describe_callable(_identity)
+        _cache.cache(_identity, 1)
+        _cache.cache(_identity, 1)
+        _cache.cache(_identity, 2)
+
+        stats = _cache.get_stats()
+        callable_stats = stats['callables'][name]
+
+        assert (callable_stats['hits'], callable_stats['misses']) == (1, 2)
+        assert callable_stats['bytes_written'] > callable_stats['bytes_read'] > 0
+        assert callable_stats['hash_seconds'] > 0
+        assert callable_stats['index_seconds'] > 0
+        assert callable_stats['load_seconds'] > 0
+        assert stats['total']['hits'] == 1
+
+    def test__stats__memory_hits(self):
+        _cache.update_cache_config(memory_max_entries=10)
+        _cache.cache(_identity, 1)
+        _cache.cache(_identity, 1)
+
+        total = _cache.get_stats()['total']
+
+        assert (total['hits'], total['memory_hits'], total['misses']) == (1, 1, 1)
+
+    def test__stats__compute_seconds(self):
+        _cache.cache(_sleep_and_return, 0.05)
+        list(_cache.cache_map(_sleep_and_return, [0.01]))
+
+        total = _cache.get_stats()['total']
+        assert total['compute_seconds'] >= 0.06
+        assert total['misses'] == 2
+
+    @pytest.mark.parametrize('index_backend', ['json', 'sqlite'])
+    def test__stats__expirations_and_evictions(self, freezer, index_backend):
+        _cache.update_cache_config(index_backend=index_backend, max_entries=2)
+        dt_called = faker.date_time()
+        freezer.move_to(dt_called)
+        _cache.cache(_identity, 1, _expires_after=60)
+        for x in range(2, 5):
+            _cache.cache(_identity, x)
+        freezer.move_to(dt_called + datetime.timedelta(seconds=120))
+        _cache.get_index()
+
+        total = _cache.get_stats()['total']
+        assert total['evictions'] == 2
+        assert total['expirations'] == 0  # evicted before it could expire
+
+        _cache.cache(_identity, 5, _expires_after=60)
+        freezer.move_to(dt_called + datetime.timedelta(seconds=240))
+        _cache.get_index()
+
+        assert _cache.get_stats()['total']['expirations'] == 1
+
+    def test__stats__hook(self):
+        received = []
+
+        def _hook(counter, increment, callable):
+            received.append((counter, increment, callable))
+
+        _cache.add_stats_hook(_hook)
+        try:
+            _cache.cache(_identity, 1)
+        finally:
+            _cache.remove_stats_hook(_hook)
+
+        name = _cache._describe_callable(_identity)
+        assert ('misses', 1, name) in received
+
+
+class Test__cost_report:
+    def test__cost_report__get_index_details(self):
+        _cache.cache(_sleep_and_return, 0.01)
+        _cache.cache(_sleep_and_return, 0.01)
+
+        ((_, entry),) = _cache.get_index().items()
+        ((_, detailed),) = _cache.get_index(details=True).items()
+
+        assert 'duration' not in entry
+        assert detailed['duration'] >= 0.01
+        assert detailed['size'] > 0
+        assert detailed['hits'] == 1  # pending hits are flushed first
+        assert 'last_accessed' in detailed
+        assert 'key_check' not in detailed
+
+    def test__cost_report__by_entry(self):
+        _cache.cache(_sleep_and_return, 0.02)
+        _cache.cache(_sleep_and_return, 0.02)
+        _cache.cache(_identity, 'x' * 1000)
+
+        slow, big = _cache.get_cost_report()
+
+        assert slow['callable'] == _cache._describe_callable(_sleep_and_return)
+        assert slow['hits'] == 1
+        assert slow['time_saved'] == slow['duration'] >= 0.02
+        assert slow['time_saved_per_byte'] == slow['time_saved'] / slow['size']
+        assert (big['hits'], big['time_saved_per_byte']) == (0, 0)
+        assert set(slow) == {
+            'hash',
+            'callable',
+            'duration',
+            'size',
+            'hits',
+            'time_saved',
+            'time_saved_per_byte',
+        }
+
+    def test__cost_report__by_callable(self):
+        for x in (1, 2, 1):
+            _cache.cache(_identity, x)
+        _cache.cache(_sleep_and_return, 0.01)
+
+        rows = _cache.get_cost_report(by='callable')
+        (row,) = [
+            r for r in rows if r['callable'] == _cache._describe_callable(_identity)
+        ]
+
+        assert (row['entries'], row['hits']) == (2, 1)
+        assert row['size'] == sum(
+            e['size']
+            for e in _cache.get_index(details=True).values()
+            if e['callable'] == row['callable']
+        )
+
+    def test__cost_report__unknown_grouping(self):
+        with pytest.raises(ValueError):
+            _cache.get_cost_report(by='annotation')
+
+
+class Test__iter_index:
+    @pytest.mark.parametrize('index_backend', ['json', 'journal', 'sqlite'])
+    def test__iter_index__matches_get_index(self, index_backend):
+        _cache.update_cache_config(index_backend=index_backend)
+        for x in range(5):
+            _cache.cache(_identity, x, _annotation=str(x))
+        _cache.cache(_identity, 0)
+
+        assert list(_cache.iter_index(page_size=2)) == list(_cache.get_index().items())
+        assert dict(_cache.iter_index(details=True)) == _cache.get_index(details=True)
+
+    @pytest.mark.parametrize('index_backend', ['json', 'sqlite'])
+    def test__iter_index__clear_expired(self, freezer, index_backend):
+        _cache.update_cache_config(index_backend=index_backend)
+        dt_called = faker.date_time()
+        freezer.move_to(dt_called)
+        _cache.cache(_identity, 1, _expires_after=60)
+        _cache.cache(_identity, 2)
+        freezer.move_to(dt_called + datetime.timedelta(seconds=120))
+
+        assert len(list(_cache.iter_index(clear_expired=False))) == 2
+        assert len(list(_cache.iter_index())) == 1
+        assert len(_cache.get_index(clear_expired=False)) == 1
+
+
+def _double(x: Any) -> Any:
+    return x * 2
+
+
+class Test__bundles:
+    def _move_to_other_cache(self, tmp_path):
+        _cache.clear_cache()
+        _cache.update_cache_config(cache_dir=str(tmp_path / 'other'))
+
+    def test__bundles__round_trip(self, tmp_path):
+        path = str(tmp_path / 'bundle.tar')
+        for x in range(3):
+            _cache.cache(_identity, x, _annotation=str(x))
+        index = _cache.get_index()
+
+        assert _cache.export_cache(path, compression='gz') == 3
+        self._move_to_other_cache(tmp_path)
+        assert _cache.import_cache(path) == 3
+        assert _cache.get_index() == index
+        assert [_cache.cache(_identity, x) for x in range(3)] == [0, 1, 2]
+        assert _cache.get_stats()['total']['hits'] == 3
+
+    def test__bundles__filters(self, tmp_path, freezer):
+        path = str(tmp_path / 'bundle.tar')
+        dt_called = faker.date_time()
+        freezer.move_to(dt_called)
+        _cache.cache(_identity, 1)
+        freezer.move_to(dt_called + datetime.timedelta(hours=2))
+        _cache.cache(_identity, 2, _annotation='keep')
+        _cache.cache(_double, 3)
+
+        assert _cache.export_cache(path, callables=[_double]) == 1
+        assert _cache.export_cache(path, callables=[f'{__name__}._double']) == 1
+        assert _cache.export_cache(path, annotations=['keep']) == 1
+        assert _cache.export_cache(path, max_age=3600) == 2
+        assert _cache.export_cache(path, callables=[_identity], max_age=3600) == 1
+
+    def test__bundles__existing_entries(self, tmp_path):
+        path = str(tmp_path / 'bundle.tar')
+        _cache.cache(_identity, 1, _annotation='exported')
+        _cache.export_cache(path)
+        [hash] = _cache.get_index()
+        _cache.clear_cache()
+        _cache.cache(_identity, 1, _annotation='kept')
+
+        assert _cache.import_cache(path) == 0
+        assert _cache.get_index()[hash]['annotation'] == 'kept'
+        assert _cache.import_cache(path, overwrite=True) == 1
+        assert _cache.get_index()[hash]['annotation'] == 'exported'
+
+    def test__bundles__expired_entries(self, tmp_path, freezer):
+        path = str(tmp_path / 'bundle.tar')
+        dt_called = faker.date_time()
+        freezer.move_to(dt_called)
+        _cache.cache(_identity, 1, _expires_after=60)
+        _cache.cache(_identity, 2, _expires_after=600)
+        _cache.export_cache(path)
+        self._move_to_other_cache(tmp_path)
+        freezer.move_to(dt_called + datetime.timedelta(seconds=120))
+
+        assert _cache.import_cache(path) == 1
+        assert len(_cache.get_index()) == 1
+
+    def test__bundles__packed_objects(self, tmp_path):
+        path = str(tmp_path / 'bundle.tar')
+        _cache.update_cache_config(pack_threshold=4096)
+        _cache.cache(_identity, 'small')
+        _cache.export_cache(path)
+        self._move_to_other_cache(tmp_path)
+        _cache.update_cache_config(pack_threshold=4096)
+
+        assert _cache.import_cache(path) == 1
+        [entry] = _cache._load_index().values()
+        assert 'segment' in entry
+        assert _cache.cache(_identity, 'small') == 'small'
+
+    def test__bundles__buffers(self, tmp_path):
+        numpy = pytest.importorskip('numpy')
+        path = str(tmp_path / 'bundle.tar')
+        _cache.update_cache_config(mmap_threshold=1024)
+        array = numpy.arange(10_000, dtype='float64')
+        _cache.cache(_identity, array)
+        _cache.export_cache(path)
+        self._move_to_other_cache(tmp_path)
+        _cache.update_cache_config(mmap_threshold=1024)
+
+        assert _cache.import_cache(path) == 1
+        numpy.testing.assert_array_equal(_cache.cache(_identity, array), array)
+
+    def test__bundles__hash_engine_mismatch(self, tmp_path):
+        path = str(tmp_path / 'bundle.tar')
+        _cache.cache(_identity, 1)
+        _cache.export_cache(path)
+        _cache.update_cache_config(hash_engine='sha256')
+
+        with pytest.raises(ValueError, match='hash_engine'):
+            _cache.import_cache(path)
+
+    def test__bundles__not_a_bundle(self, tmp_path):
+        path = str(tmp_path / 'bundle.tar')
+        with tarfile.open(path, 'w') as tar:
+            tar.add(__file__, 'test_cache.py')
+
+        with pytest.raises(ValueError, match='not a cache bundle'):
+            _cache.import_cache(path)
+        with pytest.raises(ValueError, match='compression'):
+            _cache.export_cache(path, compression='zip')
+
+
+def _wait_for_write_backs() -> None:
+    executor = _cache._write_back_executor
+    assert executor is not None
+    executor.submit(_identity, None).result()  # queued after the writes
+
+
+class Test__tiers:
+    def _configure(self, tmp_path, local='a', **config):
+        return _cache.update_cache_config(
+            tiers=[
+                {'cache_dir': str(tmp_path / local)},
+                {'cache_dir': str(tmp_path / 'shared'), **config},
+            ]
+        )
+
+    def _get_index(self, tier):
+        with _cache._using_tier(tier):
+            return _cache.get_index()
+
+    def test__tiers__write_through(self, tmp_path):
+        self._configure(tmp_path)
+        _cache.cache(_identity, 1)
+
+        assert self._get_index(0).keys() == self._get_index(1).keys()
+        assert len(self._get_index(1)) == 1
+
+    def test__tiers__write_back(self, tmp_path):
+        self._configure(tmp_path)
+        _cache.update_cache_config(tier_write_policy='back')
+        _cache.cache(_identity, 1)
+        _wait_for_write_backs()
+
+        assert len(self._get_index(1)) == 1
+
+    @pytest.mark.parametrize('index_backend', ['json', 'journal', 'sqlite'])
+    def test__tiers__promotes_hits(self, tmp_path, index_backend):
+        calls = []
+
+        def _f(x):
+            calls.append(x)
+            return x
+
+        self._configure(tmp_path, index_backend=index_backend)
+        _cache.cache(_f, 1)
+        # another node, sharing the store
+        self._configure(tmp_path, local='b', index_backend=index_backend)
+
+        assert _cache.cache(_f, 1) == 1
+        assert _cache.cache(_f, 1) == 1
+        assert calls == [1]
+        assert len(self._get_index(0)) == 1
+        assert _cache.get_stats()['total']['promotions'] == 1
+
+    def test__tiers__promotes_objects_as_stored(self, tmp_path):
+        numpy = pytest.importorskip('numpy')
+        array = numpy.arange(10_000, dtype='float64')
+        self._configure(tmp_path, mmap_threshold=1024)
+        _cache.update_cache_config(pack_threshold=4096)
+        _cache.cache(_identity, array)
+        _cache.cache(_identity, 'small')
+        self._configure(tmp_path, local='b', mmap_threshold=1024)
+        _cache.update_cache_config(pack_threshold=4096)
+
+        numpy.testing.assert_array_equal(_cache.cache(_identity, array), array)
+        assert _cache.cache(_identity, 'small') == 'small'
+        assert _cache.get_stats()['total']['promotions'] == 2
+        entries = _cache._load_index().values()
+        assert sum('segment' in entry for entry in entries) == 1
+
+    def test__tiers__budgets(self, tmp_path):
+        _cache.update_cache_config(
+            tiers=[
+                {'cache_dir': str(tmp_path / 'a'), 'max_entries': 1},
+                {'cache_dir': str(tmp_path / 'shared')},
+            ]
+        )
+        for x in range(3):
+            _cache.cache(_identity, x)
+
+        assert len(self._get_index(0)) == 1
+        assert len(self._get_index(1)) == 3
+        assert _cache.cache(_identity, 0) == 0
+        assert _cache.get_stats()['total']['misses'] == 3
+
+    def test__tiers__get_by_hash(self, tmp_path):
+        self._configure(tmp_path)
+        _cache.cache(_identity, 1)
+        [hash] = _cache.get_index()
+        self._configure(tmp_path, local='b')
+
+        assert _cache.get_by_hash(hash) == 1
+
+    def test__tiers__cache_map(self, tmp_path):
+        self._configure(tmp_path)
+        _cache.cache(_identity, 1)
+        self._configure(tmp_path, local='b')
+
+        assert list(_cache.cache_map(_identity, [1, 2])) == [1, 2]
+        assert _cache.get_stats()['total']['promotions'] == 1
+        assert len(self._get_index(1)) == 2
+
+    def test__tiers__invalidate_and_clear(self, tmp_path):
+        @_cache.cache_wrapper()
+        def f(x):
+            return x
+
+        self._configure(tmp_path)
+        f(1)
+        f.invalidate()
+
+        assert self._get_index(1) == {}
+        f(1)
+        _cache.clear_cache()
+        assert not os.path.exists(tmp_path / 'a')
+        assert not os.path.exists(tmp_path / 'shared')
+
+    def test__tiers__invalid_config(self, tmp_path):
+        with pytest.raises(ValueError, match='cache_dir'):
+            _cache.update_cache_config(tiers=[{'max_bytes': 1}])
+        self._configure(tmp_path)
+        _cache.update_cache_config(tier_write_policy='sideways')
+        with pytest.raises(ValueError, match='write policy'):
+            _cache.cache(_identity, 1)
+
+
+class Test__stream:
+    def test__stream__generators(self):
+        calls = []
+
+        def _produce(n):
+            for i in range(n):
+                calls.append(i)
+                yield {'row': i}
+
+        result1 = _cache.cache(_produce, 2500)
+        result2 = _cache.cache(_produce, 2500)
+
+        assert not isinstance(result1, list)
+        assert list(result1) == list(result2) == [{'row': i} for i in range(2500)]
+        assert len(calls) == 2500
+        [entry] = _cache._load_index().values()
+        assert entry['serializer'] == 'stream'
+
+    def test__stream__read_lazily(self, monkeypatch):
+        stream = _cache._serializers.get('stream')
+        reads = []
+
+        def _load(f):
+            for item in stream.load(f):
+                reads.append(item)
+                yield item
+
+        monkeypatch.setitem(
+            _cache._serializers._registry,
+            'stream',
+            _cache._serializers.Serializer(stream.dump, _load),
+        )
+        _cache.cache(_identity, range(5000), _serializer='stream')
+        items = _cache.cache(_identity, range(5000), _serializer='stream')
+
+        assert next(items) == 0
+        assert reads == [0]
+
+    @pytest.mark.filterwarnings('error::ResourceWarning')
+    @pytest.mark.filterwarnings('error::pytest.PytestUnraisableExceptionWarning')
+    def test__stream__unconsumed_closed(self):
+        def _produce():
+            yield from range(3)
+
+        _cache.cache(_produce)  # neither the miss nor the hit ever iterated
+        _cache.cache(_produce)
+        gc.collect()
+
+        assert list(_cache.cache(_produce)) == [0, 1, 2]
+
+    def test__stream__partial_streams_not_cached(self):
+        def _produce():
+            yield 1
+            raise RuntimeError
+
+        with pytest.raises(RuntimeError):
+            _cache.cache(_produce)
+
+        assert _cache.get_index() == {}
+        assert not any(
+            name.startswith(tuple('0123456789abcdef'))
+            for name in os.listdir(_cache._get_cache_dir())
+        )
+
+    def test__stream__not_held_in_memory(self):
+        _cache.update_cache_config(memory_max_entries=10)
+
+        def _produce():
+            yield from range(3)
+
+        assert list(_cache.cache(_produce)) == [0, 1, 2]
+        assert list(_cache.cache(_produce)) == [0, 1, 2]
+        assert list(_cache.cache(_produce)) == [0, 1, 2]
+
+    def test__stream__packed(self):
+        _cache.update_cache_config(pack_threshold=4096)
+        _cache.cache(_identity, [1, 2, 3], _serializer='stream')
+
+        assert list(_cache.cache(_identity, [1, 2, 3], _serializer='stream')) == [
+            1,
+            2,
+            3,
+        ]
+        [entry] = _cache._load_index().values()
+        assert 'segment' in entry
+
+    def test__stream__cache_map(self):
+        def _produce(n):
+            yield from range(n)
+
+        results = [list(r) for r in _cache.cache_map(_produce, [2, 3, 2])]
+        assert results == [[0, 1], [0, 1, 2], [0, 1]]
+        results = [list(r) for r in _cache.cache_map(_produce, [2, 2, 4])]
+        assert results == [[0, 1], [0, 1], [0, 1, 2, 3]]
+
+    def test__stream__async(self):
+        async def _fetch(n):
+            return (i for i in range(n))
+
+        result1 = asyncio.run(_cache.cache_async(_fetch, 3))
+        result2 = asyncio.run(_cache.cache_async(_fetch, 3))
+
+        assert list(result1) == list(result2) == [0, 1, 2]
+
+
+def _fetch_document(url: str) -> str:
+    return 'the same document ' * 100
+
+
+class Test__dedupe:
+    def _get_object_paths(self):
+        return [_cache._find_object_path(hash) for hash in _cache._load_index()]
+
+    def _list_contents(self):
+        return [
+            name
+            for _, _, names in os.walk(_cache._get_cache_path('content'))
+            for name in names
+        ]
+
+    @pytest.mark.parametrize('index_backend', ['json', 'journal', 'sqlite'])
+    def test__dedupe__shares_payloads(self, index_backend):
+        _cache.update_cache_config(dedupe=True, index_backend=index_backend)
+        for url in ('a', 'b', 'c'):
+            _cache.cache(_fetch_document, url)
+        _cache.cache(_identity, 'another document')
+
+        entries = list(_cache._load_index().values())
+        assert len({entry['content'] for entry in entries}) == 2
+        inodes = {os.stat(path).st_ino for path in self._get_object_paths()}
+        assert len(inodes) == 2
+        assert len(self._list_contents()) == 2
+        assert _cache.cache(_fetch_document, 'b') == _fetch_document('b')
+
+    @pytest.mark.parametrize('index_backend', ['json', 'journal', 'sqlite'])
+    def test__dedupe__shared_bytes_counted_once(self, index_backend):
+        _cache.update_cache_config(dedupe=True, index_backend=index_backend)
+        _cache.cache(_fetch_document, 'a')
+        ((_, entry),) = _cache._read_index().items()
+        _cache.update_cache_config(max_bytes=entry['size'] + 10)
+        _cache.cache(_fetch_document, 'b')
+
+        assert _cache._get_usage() == (2, entry['size'])
+        assert len(_cache._read_index()) == 2  # neither evicted
+        _cache.cache(_identity, 'another document')  # only fits with both gone
+        assert [e['callable'] for e in _cache._read_index().values()] == [
+            'tests.test_cache._identity'
+        ]
+        assert _cache._get_usage()[0] == 1
+
+    def test__dedupe__payloads_outlive_references(self, freezer):
+        _cache.update_cache_config(dedupe=True)
+        dt_called = faker.date_time()
+        freezer.move_to(dt_called)
+        _cache.cache(_fetch_document, 'a', _expires_after=60)
+        _cache.cache(_fetch_document, 'b', _expires_after=600)
+        freezer.move_to(dt_called + datetime.timedelta(seconds=120))
+
+        assert len(_cache.get_index()) == 1
+        assert len(self._list_contents()) == 1
+        assert _cache.cache(_fetch_document, 'b') == _fetch_document('b')
+        freezer.move_to(dt_called + datetime.timedelta(seconds=1200))
+        assert _cache.get_index() == {}
+        assert self._list_contents() == []
+
+    def test__dedupe__eviction(self):
+        _cache.update_cache_config(dedupe=True, max_entries=1)
+        _cache.cache(_fetch_document, 'a')
+        _cache.cache(_fetch_document, 'b')
+
+        assert len(self._list_contents()) == 1
+        _cache.cache(_identity, 'another document')
+        assert len(self._list_contents()) == 1
+        assert _cache.cache(_identity, 'another document') == 'another document'
+
+    def test__dedupe__invalidate(self):
+        @_cache.cache_wrapper()
+        def fetch(url):
+            return _fetch_document(url)
+
+        _cache.update_cache_config(dedupe=True)
+        fetch('a')
+        _cache.cache(_fetch_document, 'b')
+        fetch.invalidate()
+
+        assert len(self._list_contents()) == 1
+        _cache.clear_cache()
+        _cache.update_cache_config(dedupe=True)
+        fetch('a')
+        fetch.invalidate()
+        assert self._list_contents() == []
+
+    def test__dedupe__replaced_entries(self, freezer):
+        _cache.update_cache_config(dedupe=True)
+        calls = []
+
+        def _count():
+            calls.append(None)
+            return 'version ' * len(calls)
+
+        dt_called = faker.date_time()
+        freezer.move_to(dt_called)
+        options = dict(_expires_after=60, _stale_ttl=600)
+        _cache.cache(_count, **options)
+        freezer.move_to(dt_called + datetime.timedelta(seconds=120))
+        _cache.cache(_count, **options)
+        _wait_for_refreshes()
+
+        assert len(calls) == 2
+        [entry] = _cache._load_index().values()
+        assert self._list_contents() == [entry['content']]
+
+    def test__dedupe__spilled_and_streamed(self):
+        _cache.update_cache_config(dedupe=True, pack_threshold=64)
+
+        def _produce(url):
+            yield from range(1000)
+
+        _cache.cache(_fetch_document, 'a')
+        _cache.cache(_fetch_document, 'b')
+        _cache.cache(_produce, 'a')
+        _cache.cache(_produce, 'b')
+        _cache.cache(_identity, 'small')
+
+        assert len(self._list_contents()) == 2
+        assert list(_cache.cache(_produce, 'b')) == list(range(1000))
+
+    def test__dedupe__bundles(self, tmp_path):
+        path = str(tmp_path / 'bundle.tar')
+        _cache.cache(_fetch_document, 'a')
+        _cache.cache(_fetch_document, 'b')
+        _cache.export_cache(path)
+        _cache.clear_cache()
+        _cache.update_cache_config(dedupe=True)
+
+        assert _cache.import_cache(path) == 2
+        assert len(self._list_contents()) == 1
@@ -0,0 +1,117 @@
+from derpcache import _hashing
+import pytest
+import struct
+
+
+def _hash(*values):
+    return _hashing.hash_values('blake2b', 16, *values)
+
+
+def test__hashing__widths():
+    key, check = _hash(1)
+
+    assert len(key) == 32
+    assert len(check) == 2 * _hashing.CHECK_SIZE
+    assert len(_hashing.hash_values('blake2b', 8, 1)[0]) == 16
+
+
+@pytest.mark.parametrize(
+    'engine, size',
+    [('blake2b', 16), ('blake2b', 64), ('sha256', 16), ('sha256', 32), ('xxhash', 16)],
+)
+def test__hashing__check_always_present(engine, size):
+    if engine == 'xxhash':
+        pytest.importorskip('xxhash')
+    key, check = _hashing.hash_values(engine, size, 1)
+
+    assert len(key) == 2 * size
+    assert len(check) == 2 * _hashing.CHECK_SIZE
+    assert (key, check) != _hashing.hash_values(engine, size, 2)
+
+
+def test__hashing__packed_sequences_are_distinct():
+    # a list of 9 dicts/Nones and one of 9 floats whose packed bytes spell it out
+    slow = [{'a' * 46: None}] + [None] * 8
+    encoding = _hashing.encode(slow)
+    header = _hashing.encode([None] * 9)[:9]
+    assert encoding.startswith(header)
+    fast = list(struct.unpack('>9d', encoding[len(header) + 1 :]))
+
+    assert _hash(slow) != _hash(fast)
+
+
+@pytest.mark.parametrize(
+    'a, b',
+    [
+        (1, 1.0),
+        (1, '1'),
+        (True, 1),
+        ('ab', b'ab'),
+        (('a', 'b'), ('ab',)),
+        ([1, [2]], [[1], 2]),
+        ({'a': 1}, [('a', 1)]),
+        (list(range(10)), list(range(1, 11))),
+        ([2**64] * 10, [2**64 + 1] * 10),
+    ],
+)
+def test__hashing__distinct(a, b):
+    assert _hash(a) != _hash(b)
+
+
+def test__hashing__order_independent():
+    assert _hash({'a': 1, 'b': {2, 3}}) == _hash({'b': {3, 2}, 'a': 1})
+
+
+def test__hashing__buffers():
+    assert _hash(b'abc') == _hash(bytearray(b'abc')) == _hash(memoryview(b'abc'))
+    big = bytes(range(256)) * 1024
+
+    assert _hash(big) == _hash(memoryview(big))
+    assert _hash(big) != _hash(big[:-1] + b'\x00')
+
+
+def test__hashing__numpy():
+    numpy = pytest.importorskip('numpy')
+    a = numpy.zeros(10_000)
+    b = a.copy()
+    b[5_000] = 1  # both print as `array([0., 0., 0., ..., 0., 0., 0.])`
+
+    assert str(a) == str(b)
+    assert _hash(a) != _hash(b)
+    assert _hash(a) == _hash(a.copy())
+    assert _hash(a) != _hash(a.astype('float32'))
+    assert _hash(a) != _hash(a.reshape(100, 100))
+    assert _hash(a[::2]) == _hash(numpy.ascontiguousarray(a[::2]))
+    assert _hash(numpy.int64(3)) == _hash(3)
+
+
+def test__hashing__pandas():
+    pandas = pytest.importorskip('pandas')
+    df = pandas.DataFrame({'a': range(1000), 'b': ['x'] * 1000})
+    df2 = df.copy()
+    df2.loc[500, 'b'] = 'y'
+
+    assert _hash(df) == _hash(df.copy())
+    assert _hash(df) != _hash(df2)
+    assert _hash(df) != _hash(df.rename(columns={'a': 'c'}))
+    assert _hash(df['a']) != _hash(df['a'].astype('float64'))
+
+
+def test__hashing__cache_key_and_encoders():
+    class Keyed:
+        def __init__(self, key):
+            self.key = key
+
+        def __cache_key__(self):
+            return self.key
+
+    class Registered:
+        def __init__(self, key):
+            self.key = key
+
+    _hashing.register_encoder(Registered, lambda x: x.key)
+
+    assert _hash(Keyed(1)) == _hash(Keyed(1))
+    assert _hash(Keyed(1)) != _hash(Keyed(2))
+    assert _hash(Registered(1)) == _hash(Registered(1))
+    assert _hash(Registered(1)) != _hash(Registered(2))
@@ -0,0 +1,78 @@
+from derpcache import _journal
+import os
+import pytest
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = str(tmp_path / 'index.journal')
+    _journal.write_index(path, {})
+    yield path
+    _journal.forget()
+
+
+def test__journal__add_and_remove(path):
+    _journal.add_entries(path, {'a': {'x': 1}, 'b': {'x': 2}})
+    _journal.remove_entries(path, ['a'])
+    _journal.forget()
+
+    assert _journal.read_index(path) == {'b': {'x': 2}}
+
+
+def test__journal__only_appends(path):
+    _journal.add_entries(path, {'a': {'x': 1}})
+    size1 = os.path.getsize(path)
+    _journal.add_entries(path, {'b': {'x': 2}})
+    size2 = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        f.seek(size1)
+        appended = f.read()
+
+    assert size2 > size1
+    assert appended == b'["+", "b", {"x": 2}]\n'
+
+
+def test__journal__replays_external_appends(path):
+    index1 = _journal.read_index(path)
+    with open(path, 'a') as f:
+        f.write('["+", "a", {"x": 1}]\n')
+    index2 = _journal.read_index(path)
+
+    assert index1 == {}
+    assert index2 == {'a': {'x': 1}}
+    assert index2 is not index1
+
+
+def test__journal__never_mutates_indexes_read(path):
+    _journal.add_entries(path, {'a': {'x': 1}})
+    index1 = _journal.read_index(path)
+    index2 = _journal.add_entries(path, {'b': {'x': 2}})
+    index3 = _journal.remove_entries(path, ['a'])
+
+    assert index1 == {'a': {'x': 1}}
+    assert index2 == {'a': {'x': 1}, 'b': {'x': 2}}
+    assert index3 == _journal.read_index(path) == {'b': {'x': 2}}
+    assert index3 is not index2
+
+
+def test__journal__torn_write_loses_one_record(path):
+    _journal.add_entries(path, {'a': {'x': 1}})
+    with open(path, 'a') as f:
+        f.write('["+", "b", {"x"')  # writer crashed mid-record
+    _journal.forget()
+    _journal.add_entries(path, {'c': {'x': 3}})
+    _journal.forget()
+
+    assert _journal.read_index(path) == {'a': {'x': 1}, 'c': {'x': 3}}
+
+
+def test__journal__compaction(path, monkeypatch):
+    monkeypatch.setattr(_journal, '_COMPACT_MIN_RECORDS', 10)
+    for i in range(20):
+        _journal.add_entries(path, {'a': {'x': i}})
+    with open(path) as f:
+        n_lines = len(f.readlines())
+    _journal.forget()
+
+    assert n_lines <= 10
+    assert _journal.read_index(path) == {'a': {'x': 19}}
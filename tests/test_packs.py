@@ -0,0 +1,67 @@
+from derpcache import _packs
+import os
+import pytest
+
+
+@pytest.fixture
+def pack_dir(tmp_path):
+    yield str(tmp_path / 'packs')
+    _packs.forget()
+
+
+def test__packs__append_and_read(pack_dir):
+    location1 = _packs.append(pack_dir, b'abc')
+    location2 = _packs.append(pack_dir, b'defg')
+
+    assert location1[0] == location2[0]
+    assert location2[1:] == (3, 4)
+    assert _packs.read(pack_dir, *location1) == b'abc'
+    assert _packs.read(pack_dir, *location2) == b'defg'
+    assert len(os.listdir(pack_dir)) == 1
+
+
+def test__packs__spill_writer(tmp_path):
+    path = tmp_path / 'spilled'
+    writer = _packs.SpillWriter(4, lambda: open(path, 'wb'))
+    writer.write(b'ab')
+
+    assert writer.buffer == b'ab'
+    writer.write(b'cd')
+    writer.write(b'ef')
+    writer.file.close()
+    assert writer.buffer is None
+    assert writer.tell() == 6
+    assert path.read_bytes() == b'abcdef'
+
+
+def test__packs__compact_only_sealed(pack_dir):
+    locations = {h: _packs.append(pack_dir, h.encode() * 10) for h in 'abcd'}
+    live = {'a': locations['a']}
+
+    assert _packs.compact(pack_dir, live) == {}  # still being appended to
+    _packs.forget()
+    moved = _packs.compact(pack_dir, live)
+
+    assert list(moved) == ['a']
+    assert moved['a'][0] != locations['a'][0]
+    assert _packs.read(pack_dir, *moved['a']) == b'a' * 10
+    assert not os.path.exists(os.path.join(pack_dir, locations['a'][0]))
+
+
+def test__packs__compact_keeps_mostly_live(pack_dir):
+    locations = {h: _packs.append(pack_dir, h.encode() * 10) for h in 'abc'}
+    _packs.forget()
+
+    assert _packs.compact(pack_dir, locations) == {}
+    assert _packs.read(pack_dir, *locations['b']) == b'b' * 10
+
+
+def test__packs__release(pack_dir):
+    locations = {h: _packs.append(pack_dir, h.encode() * 10) for h in 'abcd'}
+
+    assert not _packs.release(pack_dir, [locations['a'], locations['b']])  # active
+    _packs.forget()
+    assert not _packs.release(pack_dir, [])
+    assert _packs.release(pack_dir, [locations['c']])
+    _packs.compact(pack_dir, {'d': locations['d']})
+    assert not _packs.release(pack_dir, [locations['d']])  # since compacted
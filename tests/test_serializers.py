@@ -0,0 +1,51 @@
+from derpcache import _serializers
+import io
+import pytest
+
+
+@pytest.mark.parametrize(
+    'name, value',
+    [
+        ('pickle', {'a': [1, 2.5, None]}),
+        ('pickle-highest', {'a': [1, 2.5, None]}),
+        ('gzip', {'a': [1, 2.5, None]}),
+        ('bz2', {'a': [1, 2.5, None]}),
+        ('lzma', {'a': [1, 2.5, None]}),
+        ('json', {'a': [1, 2.5, None]}),
+        ('bytes', b'raw bytes'),
+    ],
+)
+def test__serializers__round_trip(name, value):
+    serializer = _serializers.get(name)
+    f = io.BytesIO()
+    serializer.dump(value, f)
+    f.seek(0)
+
+    assert serializer.load(f) == value
+
+
+@pytest.mark.parametrize('name', ['gzip', 'bz2', 'lzma'])
+def test__serializers__compression(name):
+    value = 'highly compressible ' * 10_000
+    f = io.BytesIO()
+    _serializers.get(name).dump(value, f)
+
+    assert len(f.getvalue()) < len(value) / 50
+
+
+def test__serializers__stream(monkeypatch):
+    monkeypatch.setattr(_serializers, 'STREAM_CHUNK_SIZE', 10)
+    serializer = _serializers.get('stream')
+    f = io.BytesIO()
+    serializer.dump((i for i in range(25)), f)
+    f.seek(0)
+
+    items = serializer.load(f)
+    assert next(items) == 0
+    assert f.tell() < len(f.getvalue())  # read a record at a time
+    assert list(items) == list(range(1, 25))
+
+
+def test__serializers__unknown():
+    with pytest.raises(ValueError):
+        _serializers.get('nope')
@@ -0,0 +1,122 @@
+from derpcache import _sqlite
+import datetime
+import pytest
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = str(tmp_path / 'index.sqlite')
+    _sqlite.init(path)
+    yield path
+    _sqlite.forget()
+
+
+def test__sqlite__round_trip(path):
+    entries = {
+        'a': {'callable': 'm.f', 'called_at': '2022-01-01T00:00:00'},
+        'b': {
+            'callable': 'm.g',
+            'called_at': '2022-01-02T00:00:00',
+            'expires_after': 1.5,
+            'annotation': 'note',
+            'other': [1, 2],
+        },
+    }
+    _sqlite.add_entries(path, entries)
+
+    assert _sqlite.read_index(path) == entries
+    assert _sqlite.lookup(path, 'b') == entries['b']
+    assert _sqlite.lookup(path, 'c') is None
+
+    _sqlite.remove_entries(path, ['a'])
+
+    assert list(_sqlite.read_index(path)) == ['b']
+
+
+def test__sqlite__remove_expired(path):
+    called_at = datetime.datetime(2022, 1, 1)
+    _sqlite.add_entries(
+        path,
+        {
+            'a': {'callable': 'm.f', 'called_at': called_at.isoformat()},
+            'b': {
+                'callable': 'm.f',
+                'called_at': called_at.isoformat(),
+                'expires_after': 60,
+            },
+        },
+    )
+
+    assert _sqlite.remove_expired(path, called_at) == {}
+    assert list(_sqlite.remove_expired(path, called_at.replace(minute=2))) == ['b']
+    assert list(_sqlite.read_index(path)) == ['a']
+
+
+def test__sqlite__iter_index(path):
+    # ties on `called_at` must neither be skipped nor repeated across pages
+    entries = {
+        f'{i:02}': {'callable': 'm.f', 'called_at': f'2022-01-0{1 + i // 3}T00:00:00'}
+        for i in range(8)
+    }
+    _sqlite.add_entries(path, dict(reversed(entries.items())))
+
+    for page_size in (1, 2, 3, 100):
+        assert dict(_sqlite.iter_index(path, page_size)) == entries
+        assert [h for h, _ in _sqlite.iter_index(path, page_size)] == list(entries)
+
+
+def test__sqlite__relocate_skips_moved_entries(path):
+    def _entry(segment, offset):
+        return {
+            'callable': 'm.f',
+            'called_at': '2022-01-01T00:00:00',
+            'segment': segment,
+            'offset': offset,
+            'length': 3,
+        }
+
+    _sqlite.add_entries(path, {'a': _entry('x', 0), 'b': _entry('x', 3)})
+    _sqlite.add_entries(path, {'b': _entry('y', 0)})  # refreshed meanwhile
+    _sqlite.relocate(
+        path,
+        {'a': (('x', 0, 3), ('z', 0, 3)), 'b': (('x', 3, 3), ('z', 3, 3))},
+    )
+
+    assert _sqlite.lookup(path, 'a') == _entry('z', 0)
+    assert _sqlite.lookup(path, 'b') == _entry('y', 0)
+
+
+def test__sqlite__usage_and_evict(path):
+    def _entry(day, size):
+        return {
+            'callable': 'm.f',
+            'called_at': f'2022-01-0{day}T00:00:00',
+            'size': size,
+        }
+
+    _sqlite.add_entries(path, {'a': _entry(1, 10), 'b': _entry(2, 20)})
+    _sqlite.add_entries(path, {'a': _entry(3, 5), 'c': _entry(4, 1)})
+
+    assert _sqlite.usage(path) == (3, 26)
+    assert list(_sqlite.evict(path, 'lru', None, 5, keep={'c'})) == ['b', 'a']
+    assert _sqlite.usage(path) == (1, 1)
+    assert list(_sqlite.read_index(path)) == ['c']
+
+
+def test__sqlite__usage_counts_shared_content_once(path):
+    def _entry(content, size):
+        return {
+            'callable': 'm.f',
+            'called_at': '2022-01-01T00:00:00',
+            'size': size,
+            **({'content': content} if content else {}),
+        }
+
+    _sqlite.add_entries(path, {'a': _entry('x', 10), 'b': _entry('x', 10)})
+    _sqlite.add_entries(path, {'c': _entry(None, 1)})
+
+    assert _sqlite.usage(path) == (3, 11)
+    _sqlite.remove_entries(path, ['a'])
+    assert _sqlite.usage(path) == (2, 11)
+    _sqlite.remove_entries(path, ['b'])
+    assert _sqlite.usage(path) == (1, 1)
@@ -0,0 +1,62 @@
+from derpcache import _stats
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def _auto_reset():
+    yield
+    _stats.reset()
+
+
+def test__stats__record_and_snapshot():
+    _stats.record('m.f', hits=1, load_seconds=0.5)
+    _stats.record('m.f', hits=1, misses=1)
+    _stats.record('m.g', misses=1, bytes_written=10)
+
+    stats = _stats.snapshot()
+
+    assert stats['callables']['m.f']['hits'] == 2
+    assert stats['callables']['m.f']['load_seconds'] == 0.5
+    assert stats['callables']['m.g']['bytes_written'] == 10
+    assert stats['total']['misses'] == 2
+    assert set(stats['total']) == set(_stats.COUNTERS)
+
+
+def test__stats__snapshot_is_a_copy():
+    _stats.record('m.f', hits=1)
+    stats = _stats.snapshot()
+    stats['callables']['m.f']['hits'] = 100
+
+    assert _stats.snapshot()['callables']['m.f']['hits'] == 1
+
+
+def test__stats__reset():
+    _stats.record('m.f', hits=1)
+    _stats.reset()
+
+    assert _stats.snapshot() == {
+        'total': dict.fromkeys(_stats.COUNTERS, 0),
+        'callables': {},
+    }
+
+
+def test__stats__hooks(caplog):
+    received = []
+
+    def _hook(counter, increment, callable):
+        received.append((counter, increment, callable))
+
+    def _broken_hook(counter, increment, callable):
+        raise KeyError('boom')
+
+    _stats.add_hook(_broken_hook)
+    _stats.add_hook(_hook)
+    try:
+        _stats.record('m.f', hits=1, bytes_read=3)
+    finally:
+        _stats.remove_hook(_hook)
+        _stats.remove_hook(_broken_hook)
+    _stats.record('m.f', hits=1)
+
+    assert received == [('hits', 1, 'm.f'), ('bytes_read', 3, 'm.f')]
+    assert any('stats hook' in m for m in caplog.messages)